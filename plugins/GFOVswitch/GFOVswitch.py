@@ -15,6 +15,7 @@ import dicom
 import os
 import numpy as np
 from dicompyler import guiutil, util
+from .frameindex import FrameIndex
 import logging
 logger = logging.getLogger('dicompyler.gfovswitch')
 
@@ -53,25 +54,21 @@ class plugin():
         #Wont need this check once Issue 72 is fixed.
         if self.data.has_key('rtdose'):
 
-            #Load RTPlan and first DICOM slice.
+            #Load RTDose.
             rtd = self.data['rtdose']
-            ct1 = self.data['images'][0]
-            #Number of slices.
-            N = len(self.data['images'])
 
-            #Get slice spacing t, use difference instead of tags to get direction.
-            t = self.data['images'][1].ImagePositionPatient[2]-self.data['images'][0].ImagePositionPatient[2]
-            zpos = ct1.ImagePositionPatient[2]
-            #Check current type of GFOV and switch.
+            #Check current type of GFOV and switch.  The frame positions come
+            #from the dose itself, so non-uniform spacing is kept.
             if rtd.has_key('GridFrameOffsetVector'):
-                if rtd.GridFrameOffsetVector[0] == 0.:
+                index = FrameIndex.from_dataset(rtd)
+                if index.gfov_type() == 'A':
                     logger.info("Found Type A - Relative Coordinates\nConverting to Type B - Absolute")
                     #Convert to Type B (Absolute)
-                    rtd.GridFrameOffsetVector = list(np.arange(zpos, zpos + t*N, t))
-                elif rtd.GridFrameOffsetVector[0] == zpos:
+                    rtd.GridFrameOffsetVector = index.absolute_offsets()
+                else:
                     logger.info("Found Type B - Absolute Coordinates\nConverting to Type A - Relative")
                     #Convert to Type A (Relative)
-                    rtd.GridFrameOffsetVector = list(np.arange(0., abs(t)*N,abs(t)))
+                    rtd.GridFrameOffsetVector = index.relative_offsets()
             else:
                 logger.info("GridFrameOffsetVector key not found in RT-Dose!")
 
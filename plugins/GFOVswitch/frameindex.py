@@ -0,0 +1,253 @@
+# frameindex.py
+# Frame geometry of RT Dose objects for the GFOV Switch plugin.
+# Copyright (c) 2012 Derek M. Tishler and dicompyler contributors.
+"""
+Index of the z positions of the frames of an RT Dose object, and the
+masks of structure planes on its grid, shared by the plugins that work on
+a dose plane by plane.
+"""
+# All rights reserved, released under a BSD license.
+#    See the file license.txt included with this distribution, available at:
+#    http://code.google.com/p/dicompyler-plugins/source/browse/plugins/gfovswitch/license.txt
+
+#Requires numpy, matplotlib for plane_mask and pydicom for the tests.
+#Does not require wxPython or dicompyler.
+import bisect
+import unittest
+import numpy as np
+try:
+    from matplotlib import path as mplpath
+except ImportError:
+    #Only needed to rasterize structures with plane_mask
+    mplpath = None
+
+class FrameIndex(object):
+    """Sorted absolute z positions of the frames of an RT Dose object.
+
+    The GridFrameOffsetVector is either Type A, offsets relative to the
+    ImagePositionPatient of the first frame and starting at 0, or Type B,
+    absolute z positions starting at the ImagePositionPatient.  Both, and
+    non-uniformly spaced frames, give the same index."""
+
+    def __init__(self, offsets, origin_z):
+
+        offsets = np.array([float(v) for v in offsets])
+        self.origin_z = float(origin_z)
+        #Type A vectors start at 0, Type B at the first frame position.
+        self.relative = len(offsets) > 0 and offsets[0] == 0.
+        if self.relative:
+            self.frame_z = offsets + self.origin_z
+        else:
+            self.frame_z = offsets
+        #Frames in order of increasing z, for lookups.
+        self.order = [int(f) for f in
+                      np.argsort(self.frame_z, kind='mergesort')]
+        self.z = self.frame_z[self.order]
+        self.sorted_z = list(self.z)
+
+    @classmethod
+    def from_dataset(cls, ds):
+        """Return the index of an RT Dose dataset."""
+
+        return cls(ds.GridFrameOffsetVector, ds.ImagePositionPatient[2])
+
+    def __len__(self):
+
+        return len(self.z)
+
+    def gfov_type(self):
+        """Return 'A' for a relative and 'B' for an absolute vector."""
+
+        return 'A' if self.relative else 'B'
+
+    def relative_offsets(self):
+        """Return the Type A GridFrameOffsetVector, in frame order."""
+
+        return [float(v) for v in self.frame_z - self.origin_z]
+
+    def absolute_offsets(self):
+        """Return the Type B GridFrameOffsetVector, in frame order."""
+
+        return [float(v) for v in self.frame_z]
+
+    def spacing(self, tolerance=1e-3):
+        """Return the frame spacing, or None if it is not uniform."""
+
+        if len(self.z) < 2:
+            return None
+        steps = np.diff(self.z)
+        if np.ptp(steps) > tolerance:
+            return None
+        return float(steps.mean())
+
+    def lookup(self, z, tolerance=1e-3):
+        """Return the frames on either side of z and the interpolation weight
+        of the second, or None if z is outside of the frames.
+
+        The search is a bisection of the sorted positions, so it takes
+        O(log n) time for n frames.  A position within tolerance of a frame
+        returns that frame twice with a weight of 0."""
+
+        n = len(self.sorted_z)
+        if not n or z < self.sorted_z[0] - tolerance or \
+           z > self.sorted_z[-1] + tolerance:
+            return None
+        i = bisect.bisect_left(self.sorted_z, z)
+        if i < n and abs(self.sorted_z[i] - z) <= tolerance:
+            return self.order[i], self.order[i], 0.
+        if i > 0 and abs(self.sorted_z[i - 1] - z) <= tolerance:
+            return self.order[i - 1], self.order[i - 1], 0.
+        z0, z1 = self.sorted_z[i - 1], self.sorted_z[i]
+        return self.order[i - 1], self.order[i], float(z - z0)/(z1 - z0)
+
+    def nearest(self, z, tolerance):
+        """Return the frame nearest to z, or None if there is none within
+        tolerance.  Like lookup, it takes O(log n) time for n frames."""
+
+        n = len(self.sorted_z)
+        if not n:
+            return None
+        i = bisect.bisect_left(self.sorted_z, z)
+        if i == n or (i > 0 and z - self.sorted_z[i - 1] <=
+                      self.sorted_z[i] - z):
+            i -= 1
+        if abs(self.sorted_z[i] - z) > tolerance:
+            return None
+        return self.order[i]
+
+def plane_mask(contours, x, y):
+    """Return the row and column bounds and the mask of the points of the
+    x, y grid inside the contours of a structure plane, or None if there
+    are none.
+
+    A point is inside the plane if it is inside an odd number of its
+    contours, so that inner contours are holes."""
+
+    polygons = []
+    for contour in contours:
+        #dicompyler has named the contour points both 'data' and
+        #'contourData'
+        points = contour.get('data', contour.get('contourData'))
+        points = np.array([point[0:2] for point in points], float)
+        if len(points) >= 3:
+            polygons.append(points)
+    if not polygons:
+        return None
+
+    low = np.min([points.min(0) for points in polygons], 0)
+    high = np.max([points.max(0) for points in polygons], 0)
+    i0, i1 = np.searchsorted(x, low[0], 'left'), \
+             np.searchsorted(x, high[0], 'right')
+    j0, j1 = np.searchsorted(y, low[1], 'left'), \
+             np.searchsorted(y, high[1], 'right')
+    if i0 >= i1 or j0 >= j1:
+        return None
+
+    grid_x, grid_y = np.meshgrid(x[i0:i1], y[j0:j1])
+    points = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+    mask = np.zeros(len(points), bool)
+    for polygon in polygons:
+        mask ^= mplpath.Path(polygon).contains_points(points)
+    if not mask.any():
+        return None
+
+    return j0, j1, i0, i1, mask.reshape(j1 - j0, i1 - i0)
+
+def make_test_rtdose(offsets, origin_z, rows=3, columns=4):
+    """Return an RT Dose dataset whose frames are at the given offsets, and
+    whose pixels are the z position of their frame in mm."""
+
+    #Only the tests need pydicom, the plugin is given its datasets.
+    from pydicom.dataset import Dataset
+    ds = Dataset()
+    ds.Modality = 'RTDOSE'
+    ds.ImagePositionPatient = [-10., -20., origin_z]
+    ds.GridFrameOffsetVector = [float(v) for v in offsets]
+    ds.NumberOfFrames = len(offsets)
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 32
+    ds.BitsStored = 32
+    ds.HighBit = 31
+    ds.PixelRepresentation = 0
+    z = np.array(offsets, float) + (origin_z if offsets[0] == 0. else 0.)
+    pixels = np.ones((len(offsets), rows, columns), np.uint32)
+    ds.PixelData = (pixels*np.uint32(z)[:, None, None]).tobytes()
+
+    return ds
+
+class FrameIndexTest(unittest.TestCase):
+
+    def frames(self, ds):
+        return np.frombuffer(ds.PixelData, np.uint32).reshape(
+            int(ds.NumberOfFrames), ds.Rows, ds.Columns)
+
+    def testTypesAgree(self):
+        #Non-uniform frames, in decreasing z as in feet first doses.
+        relative = make_test_rtdose([0., -2., -4., -8., -16.], 100.)
+        absolute = make_test_rtdose([100., 98., 96., 92., 84.], 100.)
+        a = FrameIndex.from_dataset(relative)
+        b = FrameIndex.from_dataset(absolute)
+
+        self.assertEqual(a.gfov_type(), 'A')
+        self.assertEqual(b.gfov_type(), 'B')
+        self.assertEqual(len(a), 5)
+        self.assertEqual(a.relative_offsets(), b.relative_offsets())
+        self.assertEqual(a.absolute_offsets(), b.absolute_offsets())
+        self.assertEqual(a.absolute_offsets(), [100., 98., 96., 92., 84.])
+        self.assertIsNone(a.spacing())
+        self.assertEqual(FrameIndex([0., 2.5, 5.], 0.).spacing(), 2.5)
+
+    def testLookup(self):
+        ds = make_test_rtdose([0., -2., -4., -8., -16.], 100.)
+        index = FrameIndex.from_dataset(ds)
+        pixels = self.frames(ds)
+
+        #Every frame is found at its own position.
+        for frame, z in enumerate(index.absolute_offsets()):
+            self.assertEqual(index.lookup(z), (frame, frame, 0.))
+            self.assertEqual(pixels[frame, 0, 0], z)
+            self.assertEqual(index.lookup(z + 1e-4), (frame, frame, 0.))
+
+        #Positions between frames interpolate the pixels to z.
+        for z in (99., 97.5, 93., 85., 90.):
+            f0, f1, w = index.lookup(z)
+            self.assertTrue(0. < w < 1.)
+            plane = pixels[f0]*(1. - w) + pixels[f1]*w
+            np.testing.assert_allclose(plane, z)
+
+        self.assertIsNone(index.lookup(100.5))
+        self.assertIsNone(index.lookup(83.))
+        self.assertIsNone(FrameIndex([], 0.).lookup(0.))
+
+    def testPlaneMask(self):
+        x = np.arange(6.)
+        y = np.arange(5.) + 10.
+        outer = [[0.5, 10.5, 0.], [4.5, 10.5, 0.], [4.5, 13.5, 0.],
+                 [0.5, 13.5, 0.]]
+        hole = [[1.5, 11.5, 0.], [2.5, 11.5, 0.], [2.5, 12.5, 0.],
+                [1.5, 12.5, 0.]]
+        j0, j1, i0, i1, mask = plane_mask([{'data': outer},
+                                           {'contourData': hole}], x, y)
+        self.assertEqual((j0, j1, i0, i1), (1, 4, 1, 5))
+        expected = np.ones((3, 4), bool)
+        expected[1, 1] = False
+        np.testing.assert_array_equal(mask, expected)
+        #Contours off the grid, or with too few points
+        self.assertIsNone(plane_mask([{'data': [[p[0] + 20, p[1], 0.]
+                                                for p in outer]}], x, y))
+        self.assertIsNone(plane_mask([{'data': outer[:2]}], x, y))
+
+    def testNearest(self):
+        #Absolute positions, such as those of structure planes, in any order
+        index = FrameIndex([4., -2., 10., 0.], 0.)
+        self.assertEqual(index.nearest(0.9, 1.), 3)
+        self.assertEqual(index.nearest(2.9, 3.), 0)
+        self.assertEqual(index.nearest(-3., 1.), 1)
+        self.assertEqual(index.nearest(12., 2.), 2)
+        self.assertEqual(index.nearest(10., 0.), 2)
+        self.assertIsNone(index.nearest(7., 2.5))
+        self.assertIsNone(index.nearest(-4., 1.))
+        self.assertIsNone(FrameIndex([], 0.).nearest(0., 1.))
@@ -0,0 +1,241 @@
+# gfovbatch.py
+# Headless batch GridFrameOffsetVector normalization for RT Dose archives.
+# Copyright (c) 2012 Derek M. Tishler and dicompyler contributors.
+"""
+Normalize the GridFrameOffsetVector of every RT Dose file in an archive.
+
+Usage: python gfovbatch.py [--type A|B] (--output-dir DIR | --in-place)
+                           [--workers N] PATH [PATH ...]
+
+Only the headers of the files are parsed, so CT and other files are passed
+over without reading their pixels.  The frame positions of each dose come
+from its own ImagePositionPatient and GridFrameOffsetVector (see
+frameindex.FrameIndex), so no CT series is needed.  The rewritten header
+is followed by the rest of the original file, from the PixelData element
+on, copied byte for byte and never decoded.
+"""
+# All rights reserved, released under a BSD license.
+#    See the file license.txt included with this distribution, available at:
+#    http://code.google.com/p/dicompyler-plugins/source/browse/plugins/gfovswitch/license.txt
+
+#Requires pydicom, numpy.  Does not require wxPython or dicompyler.
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from concurrent import futures
+
+import pydicom
+from pydicom.valuerep import DSfloat
+
+try:
+    from .frameindex import FrameIndex, make_test_rtdose
+except ImportError:
+    #Run as a script
+    from frameindex import FrameIndex, make_test_rtdose
+
+#Size of the blocks in which the pixel data is copied.
+COPY_BLOCK = 2**20
+
+def find_files(paths):
+    """Return (file, path relative to its input) pairs of the files given
+    and of those found in the directories given."""
+
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append((path, os.path.basename(path)))
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                filename = os.path.join(root, name)
+                files.append((filename, os.path.relpath(filename, path)))
+
+    return files
+
+def normalize_rtdose(source, target, gfov_type='A'):
+    """Write an RT Dose file to target with a GridFrameOffsetVector of the
+    given type.
+
+    Returns a (source, status, bytes) tuple, where status is 'converted',
+    'unchanged', 'skipped' for files that are not RT Doses with a vector,
+    or an error message."""
+
+    try:
+        with open(source, 'rb') as fp:
+            try:
+                ds = pydicom.dcmread(fp, stop_before_pixels=True)
+            except pydicom.errors.InvalidDicomError:
+                return source, 'skipped', 0
+            #The header stops at the PixelData element.
+            offset = fp.tell()
+            if ds.get('Modality') != 'RTDOSE' or \
+               'GridFrameOffsetVector' not in ds:
+                return source, 'skipped', 0
+            if ds.file_meta.TransferSyntaxUID == \
+               pydicom.uid.DeflatedExplicitVRLittleEndian:
+                return source, 'deflated files are not supported', 0
+
+            index = FrameIndex.from_dataset(ds)
+            folder = os.path.dirname(target)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder, exist_ok=True)
+            if index.gfov_type() == gfov_type:
+                if os.path.abspath(source) != os.path.abspath(target):
+                    fp.seek(0)
+                    write_copy(fp, target)
+                return source, 'unchanged', os.path.getsize(source)
+
+            if gfov_type == 'A':
+                offsets = index.relative_offsets()
+            else:
+                offsets = index.absolute_offsets()
+            ds.GridFrameOffsetVector = [DSfloat(v, auto_format=True)
+                                        for v in offsets]
+
+            temp = target + '.gfov'
+            with open(temp, 'wb') as out:
+                ds.save_as(out)
+                fp.seek(offset)
+                shutil.copyfileobj(fp, out, COPY_BLOCK)
+        os.replace(temp, target)
+    except Exception as e:
+        return source, 'error: %s' % e, 0
+
+    return source, 'converted', os.path.getsize(target)
+
+def write_copy(fp, target):
+    """Copy an open file to target, through a temporary file."""
+
+    temp = target + '.gfov'
+    with open(temp, 'wb') as out:
+        shutil.copyfileobj(fp, out, COPY_BLOCK)
+    os.replace(temp, target)
+
+def _normalize(job):
+    """Normalize one (source, target, type) job in a worker process."""
+
+    return normalize_rtdose(*job)
+
+class NormalizeTest(unittest.TestCase):
+
+    geometry = ['ImagePositionPatient', 'GridFrameOffsetVector',
+                'NumberOfFrames', 'Rows', 'Columns']
+
+    def writeDose(self, filename, transfer_syntax):
+        """Write a Type A RT Dose with non-uniform frames."""
+
+        ds = make_test_rtdose([0., 2.5, 5., 10., 12.125], -47.5)
+        ds.file_meta = pydicom.dataset.FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = transfer_syntax
+        ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.2'
+        ds.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.preamble = b'\0'*128
+        ds.save_as(filename, enforce_file_format=True)
+
+    def testRoundTrip(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for transfer_syntax in (pydicom.uid.ImplicitVRLittleEndian,
+                                    pydicom.uid.ExplicitVRLittleEndian):
+                source = os.path.join(directory, 'rtdose.dcm')
+                typeB = os.path.join(directory, 'B', 'rtdose.dcm')
+                typeA = os.path.join(directory, 'A', 'rtdose.dcm')
+                self.writeDose(source, transfer_syntax)
+
+                self.assertEqual(normalize_rtdose(source, typeB, 'B')[1],
+                                 'converted')
+                self.assertEqual(normalize_rtdose(typeB, typeA, 'A')[1],
+                                 'converted')
+                self.assertEqual(normalize_rtdose(typeA, typeA, 'A')[1],
+                                 'unchanged')
+
+                original = pydicom.dcmread(source)
+                converted = pydicom.dcmread(typeB)
+                restored = pydicom.dcmread(typeA)
+                self.assertEqual(converted.GridFrameOffsetVector,
+                                 [-47.5, -45., -42.5, -37.5, -35.375])
+                self.assertEqual(converted.file_meta.TransferSyntaxUID,
+                                 transfer_syntax)
+                self.assertEqual(restored.file_meta.TransferSyntaxUID,
+                                 transfer_syntax)
+                for keyword in self.geometry:
+                    self.assertEqual(restored[keyword].value,
+                                     original[keyword].value, keyword)
+                self.assertEqual(converted.PixelData, original.PixelData)
+                self.assertEqual(restored.PixelData, original.PixelData)
+        finally:
+            shutil.rmtree(directory)
+
+    def testSkipped(self):
+        directory = tempfile.mkdtemp()
+        try:
+            source = os.path.join(directory, 'notes.txt')
+            with open(source, 'w') as fp:
+                fp.write('Not a DICOM file')
+            target = os.path.join(directory, 'out', 'notes.txt')
+            self.assertEqual(normalize_rtdose(source, target),
+                             (source, 'skipped', 0))
+            self.assertFalse(os.path.exists(target))
+        finally:
+            shutil.rmtree(directory)
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='gfovbatch',
+        description="Normalize the GridFrameOffsetVector of RT Dose files "
+                    "without the dicompyler GUI.")
+    parser.add_argument('paths', nargs='+',
+        help="DICOM files, or directories searched recursively")
+    parser.add_argument('--type', choices=['A', 'B'], default='A',
+        help="A for relative and B for absolute offsets "
+             "(default: %(default)s)")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('-o', '--output-dir',
+        help="write the RT Dose files to this directory, keeping their "
+             "paths relative to each input directory")
+    output.add_argument('--in-place', action='store_true',
+        help="replace the RT Dose files that need converting")
+    parser.add_argument('--workers', type=int, default=0,
+        help="processes converting files, 0 for one per CPU")
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for source, relative in find_files(args.paths):
+        if args.in_place:
+            target = source
+        else:
+            target = os.path.join(args.output_dir, relative)
+        jobs.append((source, target, args.type))
+
+    start = time.time()
+    counts = {}
+    size = 0
+    with futures.ProcessPoolExecutor(max_workers=args.workers or None) \
+            as pool:
+        for source, status, nbytes in pool.map(_normalize, jobs,
+                                               chunksize=16):
+            if status not in ('converted', 'unchanged', 'skipped'):
+                print("GFOVswitch: %s: %s" % (source, status))
+                status = 'failed'
+            counts[status] = counts.get(status, 0) + 1
+            size += nbytes
+    elapsed = max(time.time() - start, 1e-9)
+
+    print("GFOVswitch: %d converted to Type %s, %d unchanged, %d skipped, "
+          "%d failed" % (counts.get('converted', 0), args.type,
+          counts.get('unchanged', 0), counts.get('skipped', 0),
+          counts.get('failed', 0)))
+    print("GFOVswitch: %.1f MB of RT Dose in %.2f s, %.1f MB/s" %
+          (size/2.**20, elapsed, size/2.**20/elapsed))
+
+    return 1 if counts.get('failed') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+# doseio.py
+# Dose file readers for the G4 RT-Dose plugin.
+# Copyright (c) 2011-2012 Derek M. Tishler, Brian P. Tonner, and dicompyler contributors.
+"""
+Read the dose files of the GmPSPrinter3ddose and GmPSPrinterG4cout printers
+into NumPy arrays.
+
+Usage: python doseio.py --benchmark [--size N] [--keep FILE]
+
+The benchmark writes a synthetic N^3 voxel 3ddose file (256^3 by default)
+and reads it with the bulk reader and with the original line by line
+parser.
+"""
+# All rights reserved, released under a BSD license.
+#    See the file license.txt included with this distribution, available at:
+#    http://code.google.com/p/dicompyler-plugins/source/browse/plugins/g4dose/license.txt
+
+#Requires numpy.  Does not require wxPython or dicompyler.
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import unittest
+import numpy as np
+
+#Size of the blocks of text that are parsed at a time.
+CHUNK_BYTES = 2**24
+#Lines that start and end the dose table of a GmPSPrinterG4cout file.
+ENTRIES_MARKER = b'Number of entries'
+SUM_MARKER     = b'SUM ALL'
+
+def read_values(fp, count, chunk=CHUNK_BYTES):
+    """Read count whitespace separated numbers from a binary file into a
+    float array, a block of lines at a time.
+
+    Each block is parsed by NumPy in one call, so no Python object is made
+    per value, and only one block of text is held in memory.  Numbers after
+    the first count are ignored."""
+
+    values = np.empty(count, float)
+    n    = 0
+    tail = b''
+    while n < count:
+        block = fp.read(chunk)
+        if block:
+            #Split after the last full line, keep the rest for the next block.
+            cut = block.rfind(b'\n') + 1
+            if not cut:
+                tail += block
+                continue
+            text, tail = tail + block[:cut], block[cut:]
+        else:
+            text, tail = tail, b''
+        parsed = np.fromstring(text, sep=' ')
+        take   = min(len(parsed), count - n)
+        values[n:n+take] = parsed[:take]
+        n += take
+        if not block:
+            break
+    if n < count:
+        raise ValueError('Expected {0:d} values, found {1:d}'.format(count, n))
+
+    return values
+
+def read_3ddose_header(fp):
+    """Read the header of a 3ddose file.
+
+    Returns the number of events, the [NX, NY, NZ] voxel dimensions and the
+    x, y and z voxel boundaries."""
+
+    #First line is the number of events.
+    NumEvents = float(fp.readline())
+    #Voxels is list [NX, NY, NZ]
+    [NX,NY,NZ] = [int(x) for x in fp.readline().split()]
+    #Get the coordinates of the x, y and z positions.
+    XVals = [float(x) for x in fp.readline().split()]
+    YVals = [float(x) for x in fp.readline().split()]
+    ZVals = [float(x) for x in fp.readline().split()]
+
+    return NumEvents, [NX,NY,NZ], [XVals, YVals, ZVals]
+
+def read_3ddose(doseFile, chunk=CHUNK_BYTES):
+    """Read a GmPSPrinter3ddose file.
+
+    Returns the number of events, the x, y and z voxel boundaries and the
+    (NX, NY, NZ) dose array.  The file lists the doses with x changing
+    fastest, so the values are reshaped in Fortran order."""
+
+    with open(doseFile, 'rb') as fp:
+        NumEvents, [NX,NY,NZ], vals = read_3ddose_header(fp)
+        DoseData = read_values(fp, NX*NY*NZ, chunk)
+
+    return NumEvents, vals, DoseData.reshape((NX,NY,NZ), order='F')
+
+def read_3ddose_rows(doseFile):
+    """Read a GmPSPrinter3ddose file a row at a time.
+
+    This is the original parser of the plugin, kept as a reference for
+    read_3ddose."""
+
+    with open(doseFile, 'r') as DoseFile:
+        NumEvents = float(DoseFile.readline())
+        [NX,NY,NZ] = [int(x) for x in DoseFile.readline().split()]
+        vals = [[float(x) for x in DoseFile.readline().split()]
+                for i in range(3)]
+
+        #Create and fill 3d dose array.
+        DoseData = np.zeros((NX,NY,NZ),float)
+        for iz in range(0,NZ,1):
+            for iy in range (0,NY,1):
+                #Read in one line of x values
+                temp = DoseFile.readline()
+                temp = temp.strip('\n')
+                row  = temp.split()
+                DoseData[:,iy,iz] = row
+
+    return NumEvents, vals, DoseData
+
+def find_line(fp, marker, chunk=CHUNK_BYTES):
+    """Return the first line of a binary file that contains marker, leaving
+    the file at the start of the next line, or None if there is none.
+
+    The file is searched a block at a time with bytes.find, and the end of
+    each block is kept in case the marker spans two blocks."""
+
+    start = fp.tell()
+    tail  = b''
+    while True:
+        block = fp.read(chunk)
+        if not block:
+            return None
+        text  = tail + block
+        found = text.find(marker)
+        if found >= 0:
+            break
+        tail   = text[-(len(marker) - 1):]
+        start += len(text) - len(tail)
+
+    lineStart = text.rfind(b'\n', 0, found) + 1
+    lineEnd   = text.find(b'\n', found)
+    while lineEnd < 0:
+        #The line continues into the next block.
+        block = fp.read(chunk)
+        if not block:
+            lineEnd = len(text)
+            break
+        text   += block
+        lineEnd = text.find(b'\n', found)
+    fp.seek(start + lineEnd + 1)
+
+    return text[lineStart:lineEnd]
+
+def read_g4cout(doseFile, chunk=CHUNK_BYTES):
+    """Read the dose table of a GmPSPrinterG4cout file.
+
+    The table is between the 'Number of entries' line, which gives its
+    length, and the 'SUM ALL' line.  The second and fourth columns of each
+    row are the voxel id and dose.  Rows are parsed a block at a time into
+    arrays preallocated from the number of entries, so memory is
+    proportional to the number of scored voxels.  Returns the (voxel id,
+    dose) arrays, which are empty if the file has no table."""
+
+    with open(doseFile, 'rb') as fp:
+        header = find_line(fp, ENTRIES_MARKER, chunk)
+        if header is None:
+            return np.empty(0, np.int64), np.empty(0, float)
+        #The count follows the marker, in some versions after an '='.
+        count  = header.split(ENTRIES_MARKER)[1].strip(b' =:\t\r')
+        numEnt = int(count.split()[0])
+        voxelIds = np.empty(numEnt, np.int64)
+        doses    = np.empty(numEnt, float)
+
+        n    = 0
+        tail = b''
+        done = False
+        while not done:
+            block = fp.read(chunk)
+            text  = tail + block
+            #Ends on return of Sum All.
+            end = text.find(SUM_MARKER)
+            if end >= 0:
+                text = text[:text.rfind(b'\n', 0, end) + 1]
+                done = True
+            elif not block:
+                tail = b''
+                done = True
+            else:
+                cut  = text.rfind(b'\n') + 1
+                #Keep the end of the block, in case the marker or a row is
+                #split across blocks.
+                text, tail = text[:cut], text[cut:]
+            if not text.strip():
+                continue
+            table = np.loadtxt(io.BytesIO(text), usecols=(1, 3), ndmin=2)
+            if n + len(table) > len(doses):
+                #More rows than entries, grow the arrays.
+                size = max(n + len(table), 2*len(doses))
+                voxelIds = np.resize(voxelIds, size)
+                doses    = np.resize(doses, size)
+            voxelIds[n:n+len(table)] = table[:, 0]
+            doses[n:n+len(table)]    = table[:, 1]
+            n += len(table)
+
+    return voxelIds[:n], doses[:n]
+
+def write_3ddose(doseFile, DoseData, NumEvents=1e6, spacing=0.1):
+    """Write a dose array to a 3ddose file, with voxels of the given size
+    in cm centred on the origin."""
+
+    NX,NY,NZ = DoseData.shape
+    with open(doseFile, 'w') as fp:
+        fp.write('{0:g}\n{1:d} {2:d} {3:d}\n'.format(NumEvents, NX, NY, NZ))
+        for n in (NX, NY, NZ):
+            bounds = (np.arange(n + 1) - n/2.)*spacing
+            fp.write(' '.join('{0:g}'.format(v) for v in bounds) + '\n')
+        #One line of x values for each y and z.
+        for iz in range(NZ):
+            np.savetxt(fp, DoseData[:,:,iz].T, fmt='%.6e')
+
+def benchmark(size=256, keep=None):
+    """Time read_3ddose against read_3ddose_rows on a synthetic size^3
+    voxel file, and check that both read the same doses."""
+
+    doseFile = keep or os.path.join(tempfile.mkdtemp(), 'dose.3ddose')
+    rng = np.random.RandomState(0)
+    start = time.time()
+    write_3ddose(doseFile, rng.random_sample((size, size, size)))
+    print('Wrote {0:d}^3 voxels, {1:.1f} MB, in {2:.2f} s'.format(
+        size, os.path.getsize(doseFile)/2.**20, time.time() - start))
+
+    try:
+        timings = []
+        for name, reader in (('read_3ddose', read_3ddose),
+                             ('read_3ddose_rows', read_3ddose_rows)):
+            start = time.time()
+            result = reader(doseFile)
+            elapsed = time.time() - start
+            timings.append((name, elapsed, result))
+            print('{0}: {1:.2f} s, {2:.3g} voxels/s'.format(
+                name, elapsed, size**3/elapsed))
+        if not np.array_equal(timings[0][2][2], timings[1][2][2]):
+            raise ValueError('The readers read different doses')
+        print('Speedup: {0:.1f}x'.format(timings[1][1]/timings[0][1]))
+    finally:
+        if not keep:
+            os.remove(doseFile)
+            os.rmdir(os.path.dirname(doseFile))
+
+class Read3ddoseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.doseFile = os.path.join(self.directory, 'dose.3ddose')
+        x, y, z = np.mgrid[0:7, 5:0:-1, 0:3]
+        self.dose = 1e-3*(x + 10*y + 100*z + 1)
+        write_3ddose(self.doseFile, self.dose, NumEvents=2.5e6, spacing=0.2)
+
+    def tearDown(self):
+        os.remove(self.doseFile)
+        os.rmdir(self.directory)
+
+    def testSmallChunks(self):
+        NumEvents, vals, expected = read_3ddose_rows(self.doseFile)
+        self.assertEqual(NumEvents, 2.5e6)
+        np.testing.assert_allclose(expected, self.dose, rtol=1e-6)
+
+        #Blocks shorter than a value or a line, up to the whole file.
+        for chunk in (1, 2, 3, 7, 64, CHUNK_BYTES):
+            result = read_3ddose(self.doseFile, chunk)
+            self.assertEqual(result[0], NumEvents)
+            self.assertEqual(result[1], vals)
+            self.assertEqual(result[2].shape, (7, 5, 3))
+            np.testing.assert_array_equal(result[2], expected)
+
+    def testTruncated(self):
+        with open(self.doseFile, 'rb') as fp:
+            text = fp.read()
+        with open(self.doseFile, 'wb') as fp:
+            fp.write(text[:text.rfind(b'\n', 0, -1)])
+        for chunk in (5, CHUNK_BYTES):
+            self.assertRaises(ValueError, read_3ddose, self.doseFile, chunk)
+
+class ReadG4coutTest(unittest.TestCase):
+
+    def writeG4cout(self, voxelIds, doses, entries=' '):
+        """Write a GmPSPrinterG4cout log with the given dose table."""
+
+        doseFile = os.path.join(self.directory, 'dose.out')
+        with open(doseFile, 'w') as fp:
+            fp.write('G4WT0 > Run terminated.\n'
+                     'G4WT0 > Number of events processed : 100000\n'
+                     'MultiFunctionalDetector: doseDet\n'
+                     'PrimitiveScorer: doseScorer\n')
+            fp.write('Number of entries{0}{1:d}\n'.format(entries, len(doses)))
+            for voxelId, dose in zip(voxelIds, doses):
+                fp.write('  index: {0:d}  dose: {1:.17g} Gy\n'.format(voxelId, dose))
+            fp.write('SUM ALL: {0:.17g} Gy\n'.format(sum(doses)))
+            fp.write('Number of entries 1\n  index: 1  dose: 5 Gy\n')
+
+        return doseFile
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.voxelIds = np.sort(rng.choice(100000, 50, replace=False))
+        self.doses = rng.random_sample(50)*1e-3
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def testSmallChunks(self):
+        for entries in (' ', ' = '):
+            doseFile = self.writeG4cout(self.voxelIds, self.doses, entries)
+            #Blocks shorter than the markers or a row, up to the whole file.
+            for chunk in (1, 2, 5, 16, 100, CHUNK_BYTES):
+                voxelIds, doses = read_g4cout(doseFile, chunk)
+                self.assertEqual(voxelIds.dtype, np.int64)
+                np.testing.assert_array_equal(voxelIds, self.voxelIds)
+                np.testing.assert_array_equal(doses, self.doses)
+
+    def testMoreRowsThanEntries(self):
+        doseFile = self.writeG4cout(self.voxelIds, self.doses)
+        with open(doseFile, 'rb') as fp:
+            text = fp.read()
+        with open(doseFile, 'wb') as fp:
+            fp.write(text.replace(b'entries 50', b'entries 3', 1))
+        for chunk in (7, CHUNK_BYTES):
+            voxelIds, doses = read_g4cout(doseFile, chunk)
+            np.testing.assert_array_equal(voxelIds, self.voxelIds)
+            np.testing.assert_array_equal(doses, self.doses)
+
+    def testNoTable(self):
+        doseFile = os.path.join(self.directory, 'empty.out')
+        with open(doseFile, 'w') as fp:
+            fp.write('G4WT0 > Run terminated.\n')
+        for chunk in (4, CHUNK_BYTES):
+            voxelIds, doses = read_g4cout(doseFile, chunk)
+            self.assertEqual(len(voxelIds), 0)
+            self.assertEqual(len(doses), 0)
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='doseio',
+        description="Benchmark the G4 RT-Dose dose file readers.")
+    parser.add_argument('--benchmark', action='store_true', required=True,
+        help="time the 3ddose readers on a synthetic file")
+    parser.add_argument('--size', type=int, default=256,
+        help="voxels along each axis (default: %(default)s)")
+    parser.add_argument('--keep',
+        help="write the synthetic file here and keep it")
+    args = parser.parse_args(argv)
+
+    benchmark(args.size, args.keep)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
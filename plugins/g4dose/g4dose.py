@@ -9,19 +9,27 @@ dose scoring with the GmPSPrinter3ddose or GmPSPrinterG4cout printers.
 #    See the file license.txt included with this distribution, available at:
 #    http://code.google.com/p/dicompyler-plugins/source/browse/plugins/g4dose/license.txt
 
-#Requires wxPython, pyDicom, numpy, PIL, dicompyler.
+#Requires wxPython, pyDicom, numpy, dicompyler.
 import wx
 from   wx.lib.pubsub import Publisher as pub
 import dicom
 from   dicom.dataset import Dataset, FileDataset
+from   dicom.UID import generate_uid
 import os
 import numpy as np
-from   PIL import Image
 from dicompyler import guiutil, util
 import fnmatch
 import logging
+from .doseio import read_3ddose, read_g4cout
+from .resample import upsample
+from .runmerge import file_type, merge_runs, SUMMARY_THRESHOLD
 logger = logging.getLogger('dicompyler.g4dose')
 
+#Dose table entries scattered between progress bar updates.
+SCATTER_ENTRIES = 2**18
+#Voxel to pixel interpolation, 'nearest' or 'linear'. See resample.upsample.
+UPSAMPLE_MODE = 'nearest'
+
 def pluginProperties():
 
     props = {}
@@ -63,19 +71,25 @@ class plugin():
     def pluginMenu(self, evt):
 
         #Input and main driver for creating RT Dose file from simulation output.
-        msg        = "Select Dose File."
+        msg        = "Select Dose File, or the Dose Files of several runs to merge."
         loop       = True
         runG4cout  = False
         g4CoutType = 0
         while loop:
             loop   = False
             #Select Dose file & Data.dat
-            dirdlg = wx.FileDialog(self.parent, msg, defaultFile='')
+            dirdlg = wx.FileDialog(self.parent, msg, defaultFile='', style=wx.FD_OPEN | wx.FD_MULTIPLE)
             if dirdlg.ShowModal() == wx.ID_OK:
                 #Get path to file and file's directory
-                pathDose   = dirdlg.GetPath()
+                pathDose   = dirdlg.GetPaths()[0]
                 patientDir = os.path.dirname(pathDose)
 
+                #Merge the runs of a simulation split over several seeds.
+                if len(dirdlg.GetPaths()) > 1:
+                    self.addElement(self.loadMergedRuns(patientDir, dirdlg.GetPaths(), self.data['images']))
+                    dirdlg.Destroy()
+                    break
+
                 #Open dose file to determine the printer for parsing.
                 checkG4Output = 0
                 lCount = 0
@@ -141,39 +155,14 @@ class plugin():
             dirdlg.Destroy()
 
     #Handle GmPSPrinter3ddose printer output
-    def loadGamos3ddose(self, ptPath, doseFile, ds):
-        
-        #Open DOSXYZ dose file for phantom w/ slices in z dir.
-        DoseFile = open(doseFile,'r')
+    def loadGamos3ddose(self, ptPath, doseFile, ds, DoseData=None):
         
-        #First line is the number of events.
-        NumEvents = float(DoseFile.readline())
-        #Voxels is list [NX, NY, NZ]
-        temp  = DoseFile.readline()  #Get Voxel dimensions
-        temp  = temp.strip('\n')     #Strip linefeed
-        [NX,NY,NZ] = [int(x) for x in temp.split()]
-        #Get the coordinates of the x positions.
-        temp  = DoseFile.readline()
-        temp  = temp.strip('\n')
-        XVals =[float(x) for x in temp.split()]
-        #Get the coordinates of the y positions.
-        temp  = DoseFile.readline()
-        temp  = temp.strip('\n')
-        YVals = [float(x) for x in temp.split()]
-        #Get the coordinates of the z positions.
-        temp  = DoseFile.readline()
-        temp  = temp.strip('\n')
-        ZVals = [float(x) for x in temp.split()]
-
-        #Create and fill 3d dose array.
-        DoseData = np.zeros((NX,NY,NZ),float)
-        for iz in range(0,NZ,1):
-            for iy in range (0,NY,1):
-                #Read in one line of x values
-                temp = DoseFile.readline()
-                temp = temp.strip('\n')
-                row  = temp.split()
-                DoseData[:,iy,iz] = row
+        #Read DOSXYZ dose file for phantom w/ slices in z dir, unless the
+        #(NX, NY, NZ) dose of merged runs is given. It is normalized in place.
+        #The doses are parsed in bulk, see doseio.read_3ddose.
+        if DoseData is None:
+            NumEvents, [XVals, YVals, ZVals], DoseData = read_3ddose(doseFile)
+        [NX,NY,NZ] = DoseData.shape
 
         #Image dimensions(Pixels). NY,NX represent voxel image dimensions.
         imageCol = ds[0].pixel_array.shape[0]
@@ -195,16 +184,17 @@ class plugin():
         doseGridScale = float(N/65535.)
 
 
-        #Copy DoseData array for uncompressing and masking.
-        DDVoxDimImage = np.uint32(DoseData/Max*65535.)*np.ones(np.shape(DoseData),np.uint32)
-        DDImgDimImage = np.ones((NZ,imageRow,imageCol),np.uint32)
-        
+        #Normalize DoseData in place for uncompressing and masking.
+        DoseData *= 65535./Max
+        DDVoxDimImage = DoseData.astype(np.uint32)
+        del DoseData
+
         #Uncompress dose image and position in FFS or HFS. Add more support!
-        for i in range(NZ):
-            DDImgDimImage[i,:,:] = np.array(Image.frombuffer('I',(NY,NX),DDVoxDimImage[:,:,i].tostring(),'raw','I',0,1)
-                                        .resize((imageCol, imageRow), Image.NEAREST)
-                                        .rotate(-90)
-                                        .transpose(Image.FLIP_LEFT_RIGHT),np.uint32)
+        #Each slice is the transpose of DDVoxDimImage[:,:,i], as the old
+        #PIL rotate(-90) and FLIP_LEFT_RIGHT gave, so the (z, y, x) view is
+        #upsampled for the whole volume at once.
+        DDImgDimImage = upsample(DDVoxDimImage.transpose(2,1,0), imageRow, imageCol, UPSAMPLE_MODE)
+        del DDVoxDimImage
         
         #Create RT-Dose File and copy info from CT
         rtDose, rtPlan = self.copyCTtoRTDose(ptPath, ds[0], DDImgDimImage, imageRow, imageCol, NZ, doseGridScale)
@@ -215,37 +205,26 @@ class plugin():
         return rtDose, rtPlan, rxDose
 
     #Handle GmPSPrinterG4cout printer output
-    def loadG4DoseGraph(self, fileType, ptPath, dataFile, doseFile, ds):
+    def loadG4DoseGraph(self, fileType, ptPath, dataFile, doseFile, ds, doseTable=None):
 
         #Load number of slices and compression value from data.dat.
         file = open(dataFile)
         compression = int(file.readline())
         sliceCount  = len(ds)
 
-        if fileType == 0:
+        if doseTable is not None:
+            #(voxel id, dose) arrays of merged runs.
+            voxelIds, doses = doseTable
+        elif fileType == 0:
             #Load dosegraph from dicom.out
-            doseTable = np.loadtxt(doseFile)
+            voxelIds, doses = np.loadtxt(doseFile, ndmin=2, unpack=True)
+            voxelIds = np.int64(voxelIds)
         else:
-            #Parse GmPSPrinterG4cout
-            Go = False
-            doseTable = []
-            for i in open(doseFile,'r'):
-                #Data begins after this line
-                if fnmatch.fnmatch(i, '*Number of entries*'):
-                    numEnt = i.strip('\n').split()[3]
-                    Go = True
-                #Ends on return of Sum All.
-                elif fnmatch.fnmatch(i, '*SUM ALL*'):
-                    sumAll = [3]
-                    break
-                #Save 2xN table from dose file.
-                elif Go:
-                    tempRow = i.strip('\n').split()
-                    doseTable.append([float(tempRow[1]),float(tempRow[3])])
-            doseTable = np.array(doseTable)
+            #Parse GmPSPrinterG4cout, streamed into (voxel id, dose) arrays.
+            voxelIds, doses = read_g4cout(doseFile)
                     
         #Exit if simulator had null output.
-        if len(doseTable) == 0:
+        if len(doses) == 0:
             msgE = 'dicom.out is empty!\nCheck simulation for errors.\nExiting'
             dial = wx.MessageDialog(None, msgE, 'Error', wx.OK | wx.ICON_ERROR)
             dial.ShowModal()
@@ -255,7 +234,7 @@ class plugin():
         guageCount = 0
         prog = [True,False]
         guage = wx.ProgressDialog("G4 RT-Dose","Building RT-Dose from GAMOS simulation\n",
-                                  len(doseTable)+sliceCount+1,style=wx.PD_REMAINING_TIME |
+                                  len(doses)+sliceCount+1,style=wx.PD_REMAINING_TIME |
                                   wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT)
 
         #image dimensions from images(DICOM dosegraph object)
@@ -269,27 +248,21 @@ class plugin():
         area     = voxelCol*voxelRow
         
         #G4 compression value error. See documentation.
-        if doseTable[-1][0] > voxelDim:
+        if voxelIds.max() >= voxelDim:
             msgE = 'Compression value error in data.dat!\nPlease delete binary files and re-run GEANT4.'
             dial = wx.MessageDialog(None, msgE, 'Error', wx.OK | wx.ICON_ERROR)
             dial.ShowModal()
             guage.Destroy()
             return
 
-        #Store images for resizing.
-        imageList = list()
-        for i in range(sliceCount):
-            imageList.append([])
-            imageList[i] = np.zeros((voxelCol,voxelRow),np.uint32)
+        #Store images for resizing, one (voxelCol, voxelRow) slice per frame.
+        imageList = np.zeros((sliceCount,voxelCol,voxelRow),np.uint32)
 
         #Create a new rescaled dose table.
-        Max = max(doseTable[:, 1])
+        Max = doses.max()
         #Normalize dose data and prepare for LUT in dicompyler.
-        scaleTable = np.ones((len(doseTable),2),np.float32)
         #4294967295,65535,255;2147483647,32767,127.
-        scaleTable[:, 1] = np.round((doseTable[:, 1]/Max)*65535.)
-        doseTableInt = np.ones((len(doseTable), 2), np.uint32)*np.uint32(scaleTable)
-        del scaleTable
+        doseInt = np.uint32(np.round((doses/Max)*65535.))
 
         #Ask for RxDose and normalze.
         N = Max
@@ -303,32 +276,31 @@ class plugin():
         doseGridScale = N/65535.
         rxDose        = 95.*N
        
-        #Unravel dose table into 3d dose array.
-        for index, vID in enumerate(doseTable[:, 0]):
-            #Unravel the index instead of search. GO NUMPY!
-            newIndex = np.unravel_index(int(vID), (sliceCount, voxelCol, voxelRow))
-            imageList[newIndex[0]][newIndex[1]][newIndex[2]] = doseTableInt[index][1]
+        #Scatter dose table into 3d dose array. Voxel ids are C order flat
+        #indices of the array, so a block of entries is written at once.
+        flatImages = imageList.reshape(-1)
+        for start in range(0, len(doses), SCATTER_ENTRIES):
+            stop = min(start + SCATTER_ENTRIES, len(doses))
             #Update progress bar & check for abort.
             if prog[0]:
-                guageCount += 1
+                flatImages[voxelIds[start:stop]] = doseInt[start:stop]
+                guageCount += stop - start
                 prog = guage.Update(guageCount,"Building RT-Dose from GEANT4 simulation")
             else:
                 guage.Destroy()
                 return
      
-        #Convert to array and uncompress the dose image.
-        pD3D = np.zeros((sliceCount,imageRow,imageCol),np.uint32)
-        for i in range(sliceCount):
-            #Use PIL to resize, Voxel to Pixel conversion.
-            pD3D[i] = np.array(Image.frombuffer('I', (voxelCol, voxelRow), imageList[i], 'raw', 'I', 0, 1)
-                                               .resize((imageCol, imageRow), Image.NEAREST), np.uint32)
-            #Update progress bar & check for abort.
-            if prog[0]:
-                guageCount += 1
-                prog = guage.Update(guageCount,"Building RT-Dose from GEANT4 simulation\nRe-sizing image: {0:n}".format(i+1))
-            else:
-                guage.Destroy()
-                return
+        #Uncompress the dose image, Voxel to Pixel conversion.
+        #Each slice buffer was read as a (voxelRow, voxelCol) image.
+        #Check for abort.
+        if not prog[0]:
+            guage.Destroy()
+            return
+        pD3D = upsample(imageList.reshape(sliceCount,voxelRow,voxelCol), imageRow, imageCol, UPSAMPLE_MODE)
+        del imageList, flatImages
+        #Update progress bar.
+        guageCount += sliceCount
+        prog = guage.Update(guageCount,"Building RT-Dose from GEANT4 simulation\nRe-sizing images")
 
         #Create RT-Dose File and copy info from CT.
         rtDose, rtPlan = self.copyCTtoRTDose(ptPath, ds[0], pD3D, imageRow, imageCol, sliceCount, doseGridScale)
@@ -343,11 +315,97 @@ class plugin():
         
         return rtDose, rtPlan, rxDose
 
+    #Merge the dose files of several runs of a simulation.
+    def loadMergedRuns(self, ptPath, doseFiles, ds):
+
+        #Image dimensions(Pixels).
+        imageCol   = ds[0].pixel_array.shape[0]
+        imageRow   = ds[0].pixel_array.shape[1]
+        sliceCount = len(ds)
+
+        #Dose tables need the voxel dimensions from Data.dat.
+        kind     = file_type(doseFiles[0])
+        dataFile = ptPath + '//Data.dat'
+        voxels   = None
+        if kind != '3ddose':
+            if not os.path.isfile(dataFile):
+                msgE = 'Data.dat is required with the dose files!'
+                dial = wx.MessageDialog(None, msgE, 'Error', wx.OK | wx.ICON_ERROR)
+                dial.ShowModal()
+                return
+            compression = int(open(dataFile).readline())
+            voxelCol = imageCol/compression
+            voxelRow = imageRow/compression
+            voxels   = voxelCol*voxelRow*sliceCount
+
+        #Merge the runs, weighted by their events, one at a time.
+        guage = wx.ProgressDialog("G4 RT-Dose","Merging simulation runs\n",
+                                  len(doseFiles),style=wx.PD_REMAINING_TIME |
+                                  wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT)
+        progress = lambda n: guage.Update(n,"Merging simulation runs\nRun {0:n} of {1:n}".format(n, len(doseFiles)))[0]
+        try:
+            merge, shape = merge_runs(doseFiles, voxels, progress=progress)
+        except ValueError as e:
+            guage.Destroy()
+            dial = wx.MessageDialog(None, str(e), 'Error', wx.OK | wx.ICON_ERROR)
+            dial.ShowModal()
+            return
+        guage.Destroy()
+        if merge is None:
+            return
+
+        #Standard error of the mean dose, normalized like the dose so that it
+        #shares its dose grid scaling.
+        Max      = merge.mean.max()
+        errorInt = np.uint32(np.round(merge.std_error()/Max*65535.))
+        maxRel, meanRel = merge.summary()
+        if kind == '3ddose':
+            errorImage = upsample(errorInt.reshape(shape).transpose(2,1,0), imageRow, imageCol, UPSAMPLE_MODE)
+            frames     = shape[2]
+            result     = self.loadGamos3ddose(ptPath, None, ds, merge.mean.reshape(shape))
+        else:
+            errorImage = upsample(errorInt.reshape(sliceCount,voxelRow,voxelCol), imageRow, imageCol, UPSAMPLE_MODE)
+            frames     = sliceCount
+            voxelIds   = np.flatnonzero(merge.mean)
+            result     = self.loadG4DoseGraph(1, ptPath, dataFile, None, ds, (voxelIds, merge.mean[voxelIds]))
+        del errorInt, merge
+        if not result:
+            return
+
+        #Create uncertainty RT-Dose. It is saved, so unlike the broadcast
+        #RT-Dose it needs its own instance and series, not those of the CT.
+        rtDose = result[0]
+        errorDose, errorPlan = self.copyCTtoRTDose(ptPath, ds[0], errorImage, imageRow, imageCol, frames, rtDose.DoseGridScaling)
+        errorDose.DoseType = 'ERROR'
+        errorDose.SOPInstanceUID    = generate_uid()
+        errorDose.SeriesInstanceUID = generate_uid()
+        errorDose.file_meta.MediaStorageSOPClassUID    = '1.2.840.10008.5.1.4.1.1.481.2' # RT Dose Storage
+        errorDose.file_meta.MediaStorageSOPInstanceUID = errorDose.SOPInstanceUID
+
+        #Ask where to save it, confirming before overwriting a file.
+        savedlg = wx.FileDialog(self.parent, "Save Uncertainty RT-Dose", ptPath, 'rtdose_uncertainty.dcm',
+                                "DICOM files (*.dcm)|*.dcm", style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if savedlg.ShowModal() == wx.ID_OK:
+            errorPath = savedlg.GetPath()
+            errorDose.save_as(errorPath)
+            msgS = 'Uncertainty RT-Dose saved to {0}'.format(errorPath)
+        else:
+            msgS = 'Uncertainty RT-Dose not saved.'
+        savedlg.Destroy()
+
+        msgI = ('Merged {0:n} runs.\nRelative uncertainty above {1:g}% of Max Dose:\n'
+                'max {2:.2%}, mean {3:.2%}\n{4}').format(
+                len(doseFiles), SUMMARY_THRESHOLD*100, maxRel, meanRel, msgS)
+        dial = wx.MessageDialog(None, msgI, 'G4 RT-Dose', wx.OK | wx.ICON_INFORMATION)
+        dial.ShowModal()
+
+        return result
+
     def copyCTtoRTDose(self, path, ds, doseData, imageRow, imageCol, sliceCount, dgs):
         
         # Create a RTDose file for broadcasting.
         file_meta = Dataset()
-        file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.2' # CT Image Storage
+        file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.2' # RT Dose Storage
         # Needs valid UID
         file_meta.MediaStorageSOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
         file_meta.ImplementationClassUID = ds.file_meta.ImplementationClassUID
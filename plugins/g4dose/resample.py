@@ -0,0 +1,144 @@
+# resample.py
+# Voxel to pixel resampling for the G4 RT-Dose plugin.
+# Copyright (c) 2011-2012 Derek M. Tishler, Brian P. Tonner, and dicompyler contributors.
+"""
+Upsample a dose volume from the voxel grid of a simulation to the pixel
+grid of the CT images, all frames at once.
+"""
+# All rights reserved, released under a BSD license.
+#    See the file license.txt included with this distribution, available at:
+#    http://code.google.com/p/dicompyler-plugins/source/browse/plugins/g4dose/license.txt
+
+#Requires numpy, and PIL for the tests.  Does not require wxPython or
+#dicompyler.
+import unittest
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+#Number of frames interpolated at a time in linear mode.
+SLAB_FRAMES = 8
+
+def nearest_indices(nIn, nOut):
+    """Return the source index of each of nOut pixels resampled from nIn.
+
+    Like PIL's NEAREST filter, each pixel takes the source pixel under its
+    centre, so for an integer compression c pixel x takes voxel x // c.
+    For other ratios a centre exactly on a voxel edge may be given the
+    other voxel than PIL's fixed point arithmetic gives."""
+
+    index = np.floor((np.arange(nOut) + 0.5)*(float(nIn)/nOut))
+    return np.minimum(index.astype(np.intp), nIn - 1)
+
+def linear_weights(nIn, nOut):
+    """Return the source indices on either side of each of nOut pixel
+    centres resampled from nIn, and the weight of the second."""
+
+    centre = (np.arange(nOut) + 0.5)*(float(nIn)/nOut) - 0.5
+    centre = np.clip(centre, 0., nIn - 1.)
+    i0 = np.minimum(np.floor(centre).astype(np.intp), nIn - 1)
+    i1 = np.minimum(i0 + 1, nIn - 1)
+
+    return i0, i1, centre - i0
+
+def upsample(volume, rows, cols, mode='nearest', slabFrames=SLAB_FRAMES):
+    """Resample the (frames, r, c) volume to (frames, rows, cols).
+
+    volume may be any view, such as a transpose or a reversed frame order,
+    and is only read.  In 'nearest' mode the result is gathered with one
+    pair of index arrays.  In 'linear' mode the rows and then the columns
+    are interpolated, a slab of frames at a time, and the result is
+    rounded if the volume is of an integer type.  Returns an array of the
+    type of the volume."""
+
+    frames, r, c = volume.shape
+    if mode == 'nearest':
+        #Integer compressions repeat each voxel, others gather the columns
+        #and then the rows.
+        if rows % r == 0 and cols % c == 0:
+            return np.repeat(np.repeat(volume, cols//c, axis=2),
+                             rows//r, axis=1)
+        return np.take(np.take(volume, nearest_indices(c, cols), axis=2),
+                       nearest_indices(r, rows), axis=1)
+    if mode != 'linear':
+        raise ValueError("Unknown upsampling mode '{0}'".format(mode))
+
+    r0, r1, rw = linear_weights(r, rows)
+    c0, c1, cw = linear_weights(c, cols)
+    rw = rw[:, None]
+    out = np.empty((frames, rows, cols), volume.dtype)
+    for k0 in range(0, frames, slabFrames):
+        slab = np.asarray(volume[k0:k0+slabFrames], float)
+        slab = np.take(slab, r0, axis=1)*(1. - rw) + \
+               np.take(slab, r1, axis=1)*rw
+        slab = np.take(slab, c0, axis=2)*(1. - cw) + \
+               np.take(slab, c1, axis=2)*cw
+        if np.issubdtype(volume.dtype, np.integer):
+            np.rint(slab, out=slab)
+        out[k0:k0+slabFrames] = slab
+
+    return out
+
+@unittest.skipIf(Image is None, "PIL is not installed")
+class UpsampleTest(unittest.TestCase):
+
+    def makeVolume(self, frames=3, r=8, c=6):
+        rng = np.random.RandomState(0)
+        return rng.randint(0, 65536, (frames, r, c)).astype(np.uint32)
+
+    def resizePIL(self, frame, rows, cols):
+        """Resize a frame with PIL's NEAREST filter, as the plugin did."""
+
+        image = Image.fromarray(np.int32(frame), 'I')
+        return np.array(image.resize((cols, rows), Image.NEAREST), np.uint32)
+
+    def testNearestMatchesPIL(self):
+        volume = self.makeVolume()
+        for rows, cols in ((8, 6), (32, 24), (64, 12), (24, 48)):
+            result = upsample(volume, rows, cols)
+            self.assertEqual(result.dtype, volume.dtype)
+            expected = [self.resizePIL(frame, rows, cols) for frame in volume]
+            np.testing.assert_array_equal(result, expected)
+
+    def testNearestIndices(self):
+        #The gathered path gives the repeated one for integer ratios.
+        volume = self.makeVolume()
+        gathered = np.take(np.take(volume, nearest_indices(6, 24), axis=2),
+                           nearest_indices(8, 32), axis=1)
+        np.testing.assert_array_equal(gathered, upsample(volume, 32, 24))
+        #Centres at 0.2, 0.6, 1.0, ... 3.8 voxels.
+        np.testing.assert_array_equal(nearest_indices(4, 10),
+                                      [0, 0, 1, 1, 1, 2, 2, 3, 3, 3])
+
+    def test3ddoseMatchesPIL(self):
+        #The (NX, NY, NZ) voxels of a 3ddose file on a square CT.
+        DoseData = self.makeVolume(8, 8, 4)
+        rows = cols = 32
+        result = upsample(DoseData.transpose(2, 1, 0), rows, cols)
+
+        for i in range(DoseData.shape[2]):
+            NX, NY = DoseData.shape[:2]
+            image = Image.frombuffer('I', (NY, NX),
+                np.int32(DoseData[:, :, i]).tobytes(), 'raw', 'I', 0, 1)
+            image = image.resize((cols, rows), Image.NEAREST) \
+                         .rotate(-90).transpose(Image.FLIP_LEFT_RIGHT)
+            np.testing.assert_array_equal(result[i], np.array(image, np.uint32))
+
+    def testLinear(self):
+        #A constant volume stays constant, and integers are rounded.
+        volume = np.full((5, 4, 3), 1000, np.uint32)
+        result = upsample(volume, 13, 11, 'linear', slabFrames=2)
+        self.assertEqual(result.dtype, np.uint32)
+        self.assertEqual(result.shape, (5, 13, 11))
+        self.assertTrue((result == 1000).all())
+
+        #A ramp along the rows is interpolated between the pixel centres.
+        ramp = np.arange(4.)[None, :, None]*np.ones((2, 4, 3))
+        result = upsample(ramp, 8, 3, 'linear')
+        np.testing.assert_allclose(result[0, :, 0],
+            [0., 0.25, 0.75, 1.25, 1.75, 2.25, 2.75, 3.])
+
+        self.assertRaises(ValueError, upsample, volume, 8, 6, 'cubic')
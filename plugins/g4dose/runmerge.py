@@ -0,0 +1,307 @@
+# runmerge.py
+# Multi-run Monte Carlo merging for the G4 RT-Dose plugin.
+# Copyright (c) 2011-2012 Derek M. Tishler, Brian P. Tonner, and dicompyler contributors.
+"""
+Merge the dose files of several runs of a simulation, such as runs with
+different seeds, into a mean dose and its statistical uncertainty.
+
+Usage: python runmerge.py [--voxels N] [--events E ...] [-o FILE.npz]
+                          DOSEFILE DOSEFILE [DOSEFILE ...]
+
+Each run is weighted by its number of events, read from the first line of
+3ddose files.  G4cout and plain dose tables have no event count, so they
+are weighted by --events, or equally, and need the number of voxels of the
+phantom.
+"""
+# All rights reserved, released under a BSD license.
+#    See the file license.txt included with this distribution, available at:
+#    http://code.google.com/p/dicompyler-plugins/source/browse/plugins/g4dose/license.txt
+
+#Requires numpy.  Does not require wxPython or dicompyler.
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import numpy as np
+
+try:
+    from .doseio import read_3ddose, read_g4cout, write_3ddose, ENTRIES_MARKER
+except ImportError:
+    #Run as a script
+    from doseio import read_3ddose, read_g4cout, write_3ddose, ENTRIES_MARKER
+
+#Fraction of the maximum mean dose above which the uncertainty is summarized.
+SUMMARY_THRESHOLD = 0.5
+
+class RunMerge(object):
+    """Weighted mean and variance of the dose of several runs, per voxel.
+
+    Runs are added one at a time with a weighted form of Welford's
+    algorithm, so only the mean and the weighted sum of squared deviations
+    are kept, whatever the number of runs."""
+
+    def __init__(self, size):
+
+        self.runs   = 0
+        self.events = 0.
+        self.mean   = np.zeros(size, float)
+        self.m2     = np.zeros(size, float)
+
+    def add(self, dose, events=1.):
+        """Add the dose array of a run of the given number of events."""
+
+        dose = np.ravel(dose)
+        if len(dose) != len(self.mean):
+            raise ValueError('A run has {0:d} voxels instead of {1:d}'.format(
+                len(dose), len(self.mean)))
+        if events <= 0:
+            raise ValueError('A run has no events')
+        self.runs   += 1
+        self.events += events
+        delta = dose - self.mean
+        self.mean += delta*(events/self.events)
+        delta *= dose - self.mean
+        delta *= events
+        self.m2 += delta
+
+    def std_error(self):
+        """Return the standard error of the mean dose of each voxel.
+
+        A run of N events estimates the dose with a variance of s^2/N, so
+        s^2 is estimated from the spread of the runs about the mean and the
+        error of the mean is s/sqrt(total events)."""
+
+        if self.runs < 2:
+            raise ValueError('At least two runs are needed for an uncertainty')
+        return np.sqrt(self.m2/((self.runs - 1)*self.events))
+
+    def summary(self, threshold=SUMMARY_THRESHOLD):
+        """Return the maximum and mean relative uncertainty of the voxels
+        above threshold times the maximum mean dose."""
+
+        peak = self.mean.max()
+        if peak <= 0:
+            return 0., 0.
+        high = self.mean >= threshold*peak
+        relative = self.std_error()[high]/self.mean[high]
+
+        return float(relative.max()), float(relative.mean())
+
+def file_type(doseFile, maxLines=1000):
+    """Return '3ddose', 'g4cout' or 'table' for a GmPSPrinter3ddose,
+    GmPSPrinterG4cout or plain 2xN dose file, or None.
+
+    The checks are those of the plugin menu: three voxel counts on the
+    second line, a 'Number of entries' line, or ten rows of two columns."""
+
+    tableRows = 0
+    with open(doseFile, 'rb') as fp:
+        for lCount, line in enumerate(fp):
+            columns = line.split()
+            if lCount == 1 and len(columns) == 3:
+                return '3ddose'
+            if ENTRIES_MARKER in line:
+                return 'g4cout'
+            tableRows = tableRows + 1 if len(columns) == 2 else 0
+            if tableRows >= 10:
+                return 'table'
+            if lCount >= maxLines:
+                break
+
+    return None
+
+def read_run(doseFile, kind, voxels=None):
+    """Return the number of events, or None if the file has none, and the
+    dose array of a run.  3ddose doses are (NX, NY, NZ), the doses of dose
+    tables are the flat array of voxels."""
+
+    if kind == '3ddose':
+        NumEvents, vals, DoseData = read_3ddose(doseFile)
+        return NumEvents, DoseData
+    if voxels is None:
+        raise ValueError('The number of voxels is needed for dose tables')
+    if kind == 'g4cout':
+        voxelIds, doses = read_g4cout(doseFile)
+    else:
+        voxelIds, doses = np.loadtxt(doseFile, ndmin=2, unpack=True)
+        voxelIds = np.int64(voxelIds)
+    DoseData = np.zeros(voxels, float)
+    DoseData[voxelIds] = doses
+
+    return None, DoseData
+
+def merge_runs(doseFiles, voxels=None, events=None, progress=None):
+    """Merge the dose files of several runs of a simulation.
+
+    Runs are read and added one at a time, so memory is proportional to the
+    number of voxels.  events optionally gives the number of events of each
+    run, for files that have none.  progress is called with the number of
+    runs merged so far, and merging stops, returning no RunMerge, if it
+    returns False.  Returns the RunMerge and the shape of the dose arrays."""
+
+    kinds = set(file_type(doseFile) for doseFile in doseFiles)
+    if len(kinds) != 1 or None in kinds:
+        raise ValueError('The runs must all be dose files of the same printer')
+    kind = kinds.pop()
+
+    merge = None
+    for i, doseFile in enumerate(doseFiles):
+        NumEvents, DoseData = read_run(doseFile, kind, voxels)
+        if events is not None:
+            NumEvents = events[i]
+        if merge is None:
+            shape = DoseData.shape
+            merge = RunMerge(DoseData.size)
+        elif DoseData.shape != shape:
+            raise ValueError('{0} has {1} voxels instead of {2}'.format(
+                doseFile, DoseData.shape, shape))
+        merge.add(DoseData, NumEvents or 1.)
+        del DoseData
+        if progress is not None and not progress(i + 1):
+            return None, shape
+
+    return merge, shape
+
+class RunMergeTest(unittest.TestCase):
+
+    def makeRuns(self, runs=5, shape=(6, 5, 4)):
+        """Return synthetic run doses, scattered about a smooth dose, and
+        their unequal numbers of events."""
+
+        rng = np.random.RandomState(0)
+        x, y, z = np.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
+        dose = 1. + np.sin(x/3.) + y/5. + z/7.
+        events = rng.randint(1000, 10000, runs).astype(float)
+        doses = [dose*(1. + rng.normal(0., 0.05, shape)) for n in events]
+
+        return doses, events
+
+    def expected(self, doses, events):
+        """Weighted mean and standard error of the runs with NumPy."""
+
+        flat = np.array([d.ravel() for d in doses])
+        mean = np.average(flat, axis=0, weights=events)
+        var  = np.sum(events[:, None]*(flat - mean)**2, axis=0)/(len(events) - 1)
+
+        return mean, np.sqrt(var/events.sum())
+
+    def testWeightedMerge(self):
+        doses, events = self.makeRuns()
+        merge = RunMerge(doses[0].size)
+        for dose, n in zip(doses, events):
+            merge.add(dose, n)
+        mean, error = self.expected(doses, events)
+
+        self.assertEqual(merge.runs, len(doses))
+        self.assertEqual(merge.events, events.sum())
+        np.testing.assert_allclose(merge.mean, mean, rtol=1e-12)
+        np.testing.assert_allclose(merge.std_error(), error, rtol=1e-10)
+
+        maxRel, meanRel = merge.summary()
+        high = mean >= SUMMARY_THRESHOLD*mean.max()
+        self.assertAlmostEqual(maxRel, (error/mean)[high].max())
+        self.assertAlmostEqual(meanRel, (error/mean)[high].mean())
+
+    def testEqualWeights(self):
+        doses, events = self.makeRuns()
+        merge = RunMerge(doses[0].size)
+        for dose in doses:
+            merge.add(dose)
+        flat = np.array([d.ravel() for d in doses])
+
+        np.testing.assert_allclose(merge.mean, flat.mean(axis=0), rtol=1e-12)
+        np.testing.assert_allclose(merge.std_error(),
+            flat.std(axis=0, ddof=1)/np.sqrt(len(doses)), rtol=1e-10)
+
+    def testInvalidRuns(self):
+        merge = RunMerge(10)
+        self.assertRaises(ValueError, merge.add, np.ones(9))
+        self.assertRaises(ValueError, merge.add, np.ones(10), 0)
+        merge.add(np.ones(10))
+        self.assertRaises(ValueError, merge.std_error)
+
+    def testMerge3ddose(self):
+        doses, events = self.makeRuns(runs=3)
+        directory = tempfile.mkdtemp()
+        try:
+            doseFiles = []
+            for i, (dose, n) in enumerate(zip(doses, events)):
+                doseFiles.append(os.path.join(directory, 'run{0:d}.3ddose'.format(i)))
+                write_3ddose(doseFiles[-1], dose, n)
+            calls = []
+            merge, shape = merge_runs(doseFiles,
+                progress=lambda n: calls.append(n) or True)
+            #Stop after the first run.
+            stopped, shape = merge_runs(doseFiles, progress=lambda n: False)
+        finally:
+            shutil.rmtree(directory)
+
+        #The files hold 7 significant digits.
+        mean, error = self.expected(doses, events)
+        self.assertEqual(shape, doses[0].shape)
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertIsNone(stopped)
+        np.testing.assert_allclose(merge.mean, mean, rtol=1e-6)
+        np.testing.assert_allclose(merge.std_error(), error, rtol=1e-4)
+
+    def testMergeTables(self):
+        doses, events = self.makeRuns(runs=3, shape=(2, 5, 4))
+        doses = [dose.ravel() for dose in doses]
+        directory = tempfile.mkdtemp()
+        try:
+            doseFiles = []
+            for i, dose in enumerate(doses):
+                doseFiles.append(os.path.join(directory, 'run{0:d}.txt'.format(i)))
+                #Voxel 0 is not scored.
+                np.savetxt(doseFiles[-1], np.column_stack(
+                    (np.arange(1, 40), dose[1:])), fmt=['%d', '%.17g'])
+            merge, shape = merge_runs(doseFiles, voxels=40, events=events)
+            self.assertRaises(ValueError, merge_runs, doseFiles)
+        finally:
+            shutil.rmtree(directory)
+
+        for dose in doses:
+            dose[0] = 0.
+        mean, error = self.expected(doses, events)
+        np.testing.assert_allclose(merge.mean, mean, rtol=1e-12)
+        np.testing.assert_allclose(merge.std_error()[1:], error[1:], rtol=1e-10)
+        self.assertEqual(merge.std_error()[0], 0.)
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='runmerge',
+        description="Merge the dose files of several G4 simulation runs.")
+    parser.add_argument('files', nargs='+', help="dose files of the runs")
+    parser.add_argument('--voxels', type=int,
+        help="number of voxels of the phantom, needed for G4cout files")
+    parser.add_argument('--events', type=float, nargs='+',
+        help="number of events of each run, instead of those in the files")
+    parser.add_argument('-o', '--output',
+        help="write the mean, standard error and events to this .npz file")
+    args = parser.parse_args(argv)
+
+    if len(args.files) < 2:
+        parser.error("give the dose files of at least two runs")
+    if args.events and len(args.events) != len(args.files):
+        parser.error("give the number of events of every run")
+
+    start = time.time()
+    merge, shape = merge_runs(args.files, args.voxels, args.events)
+    error = merge.std_error()
+    maxRel, meanRel = merge.summary()
+    print('G4 RT-Dose: Merged {0:d} runs, {1:g} events, in {2:.2f} s'.format(
+        merge.runs, merge.events, time.time() - start))
+    print('G4 RT-Dose: Relative uncertainty above {0:g}% of the maximum dose: '
+          'max {1:.2%}, mean {2:.2%}'.format(SUMMARY_THRESHOLD*100, maxRel,
+          meanRel))
+    if args.output:
+        np.savez(args.output, mean=merge.mean.reshape(shape),
+                 error=error.reshape(shape), events=merge.events)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
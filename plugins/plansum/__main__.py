@@ -0,0 +1,131 @@
+# __main__.py
+"""Headless plan sum: python -m plansum [options] RTDOSE [RTDOSE ...]
+
+Sums RT Dose files, or every RT Dose file in the given directories, with
+SumPlans and streams the summed frames to a new RT Dose file, with or
+without --workers.  Uncompressed inputs are memory mapped rather than
+decoded.  No wx or
+dicompyler is required, so it can run on machines without a display."""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pydicom
+
+from .plansum import (DoseSum, BiologicalDose, read_rtdose, write_rtdose,
+                      read_dvf, peak_rss, SLAB_FRAMES, resample_plans)
+
+
+def find_doses(paths):
+    """Returns the RT Dose files given, and those in the directories given,
+    in sorted order."""
+
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if not os.path.isfile(filename):
+                continue
+            try:
+                ds = pydicom.dcmread(filename, stop_before_pixels=True)
+            except Exception:
+                continue
+            if ds.get('Modality') == 'RTDOSE':
+                files.append(filename)
+
+    return files
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='plansum',
+        description="Sum RT Dose files without the dicompyler GUI.")
+    parser.add_argument('inputs', nargs='+',
+        help="RT Dose files, or directories containing RT Dose files")
+    parser.add_argument('-o', '--output', default='plansum.dcm',
+        help="summed RT Dose file to write (default: %(default)s)")
+    parser.add_argument('-w', '--weights', type=float, nargs='+',
+        help="one weight per input dose")
+    parser.add_argument('--slab-frames', type=int, default=SLAB_FRAMES,
+        help="frames resampled at a time (default: %(default)s)")
+    parser.add_argument('--interp-method', default='separable',
+        choices=['separable', 'trilinear'])
+    parser.add_argument('--workers', type=int,
+        help="processes resampling in parallel, 0 for one per CPU")
+    parser.add_argument('--float32', action='store_true',
+        help="resample and accumulate in float32 instead of float64")
+    parser.add_argument('--dvf', nargs='+',
+        help="one deformation field (DICOM REG, .npz or .npy) per input "
+             "dose, or - for a dose already on the first dose's anatomy")
+    parser.add_argument('--quantity', default='physical',
+        choices=['physical', 'BED', 'EQD2'],
+        help="sum physical dose or convert each dose voxel by voxel to BED "
+             "or EQD2 first (default: %(default)s)")
+    parser.add_argument('--fractions', type=int, nargs='+',
+        help="number of fractions of each input dose, for BED and EQD2")
+    parser.add_argument('--alpha-beta', type=float, default=3.,
+        help="alpha/beta ratio in Gy (default: %(default)s)")
+    parser.add_argument('--reference-fractions', type=int,
+        help="convert the summed BED back to physical dose in this many "
+             "fractions")
+    args = parser.parse_args(argv)
+
+    files = find_doses(args.inputs)
+    if len(files) < 2:
+        parser.error("at least two RT Dose files are required")
+    if args.weights and len(args.weights) != len(files):
+        parser.error("%d weights given for %d doses" %
+                     (len(args.weights), len(files)))
+    if args.quantity != 'physical' and \
+       (not args.fractions or len(args.fractions) != len(files)):
+        parser.error("--fractions is required for each dose with %s" %
+                     args.quantity)
+    if args.dvf and len(args.dvf) != len(files):
+        parser.error("%d deformation fields given for %d doses" %
+                     (len(args.dvf), len(files)))
+
+    start = time.time()
+    doses = [read_rtdose(filename) for filename in files]
+    dvfs = None
+    if args.dvf:
+        dvfs = [None if name == '-' else read_dvf(name, doses[0])
+                for name in args.dvf]
+    biological = None
+    if args.quantity != 'physical':
+        biological = BiologicalDose(args.fractions, args.alpha_beta,
+                                    args.quantity,
+                                    reference_fractions=args.reference_fractions)
+    dose_sum = DoseSum(doses, args.weights, args.slab_frames,
+                       args.interp_method, args.workers,
+                       np.float32 if args.float32 else np.float64, dvfs,
+                       biological=biological)
+    loaded = time.time()
+    print("PlanSum: Summing %d doses using %s" %
+          (len(files), dose_sum.method()))
+
+    #A copy with new UIDs, so that the output is never taken for an input
+    header = dose_sum.header(recycle=False)
+    write_rtdose(header, args.output, dose_sum.iter_slabs())
+    done = time.time()
+
+    voxels = header.Rows*header.Columns*header.NumberOfFrames
+    print("PlanSum: Wrote %s (%d x %d x %d)" % (args.output,
+          header.Columns, header.Rows, header.NumberOfFrames))
+    print("PlanSum: Read %.2f s, sum and write %.2f s, total %.2f s, "
+          "%.3g voxels/s" % (loaded - start, done - loaded, done - start,
+          voxels/max(done - loaded, 1e-9)))
+    print("PlanSum: Resampling plan cache %d hits, %d misses" %
+          (resample_plans.hits, resample_plans.misses))
+    rss = peak_rss()
+    if rss is not None:
+        print("PlanSum: Peak memory %.1f MB" % (rss/2.**20))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
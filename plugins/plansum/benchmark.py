@@ -0,0 +1,155 @@
+# benchmark.py
+"""Benchmarks for plansum on synthetic clinical-size dose grids.
+
+    python -m plansum.benchmark [--shape X Y Z] [--inputs N] [-o FILE]
+
+Synthetic RT Dose objects are generated in code, so no test data is
+needed.  SumPlans is timed on coincident, lattice-shifted, differently
+spaced and many-input sums, along with the trilinear reference path and
+trilinear_interp on its own.  The results, including peak memory, are
+written as JSON so that they can be compared between versions."""
+
+import argparse
+import contextlib
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+from .plansum import (DoseSum, SumPlans, make_test_dose, peak_memory, 
+                      peak_rss, pluginProperties, trilinear_interp, 
+                      SLAB_FRAMES)
+
+
+def synthetic_dose(shape, origin, spacing, seed=0):
+    """Returns an RTDose object of the given xyz shape holding a smooth,
+    clinically shaped dose: a few Gaussian high dose regions on a low dose
+    bath."""
+
+    rng = np.random.RandomState(seed)
+    x, y, z = [np.arange(n)*s + o for n, s, o in zip(shape, spacing, origin)]
+    extent = [n*s for n, s in zip(shape, spacing)]
+    dose = np.full((shape[2], shape[1], shape[0]), 0.5)
+    for n in range(3):
+        centre = [o + e*rng.uniform(0.3, 0.7)
+                  for o, e in zip(origin, extent)]
+        width = [e*rng.uniform(0.08, 0.15) for e in extent]
+        dose += rng.uniform(20., 60.) * (
+            np.exp(-((z - centre[2])/width[2])**2)[:, None, None] *
+            np.exp(-((y - centre[1])/width[1])**2)[None, :, None] *
+            np.exp(-((x - centre[0])/width[0])**2)[None, None, :])
+
+    return make_test_dose(dose, origin, spacing, scaling=1e-5)
+
+def cases(shape, inputs):
+    """Returns a list of (case name, function returning the doses to sum)"""
+
+    origin = [-s*2.5/2 for s in shape[:2]] + [-shape[2]*2.5/2]
+    spacing = [2.5, 2.5, 2.5]
+    shifted = [o + 3*s for o, s in zip(origin, spacing)]
+    coarse = [3., 3., 3.]
+    coarse_shape = [int(n*2.5/3.) for n in shape]
+
+    return [
+        ('coincident', lambda: [synthetic_dose(shape, origin, spacing, n)
+                                for n in range(2)]),
+        ('shifted-lattice', lambda: [
+            synthetic_dose(shape, origin, spacing, 0),
+            synthetic_dose(shape, shifted, spacing, 1)]),
+        ('different-spacing', lambda: [
+            synthetic_dose(shape, origin, spacing, 0),
+            synthetic_dose(coarse_shape, origin, coarse, 1)]),
+        ('many-input', lambda: [
+            synthetic_dose(shape, [o + n*0.7 for o in origin], spacing, n)
+            for n in range(inputs)]),
+    ]
+
+def measure(name, path, func, setup, voxels, repeat):
+    """Times func(*setup()), then runs it again to trace its peak memory.  
+    Returns a result record."""
+    
+    times = []
+    for n in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    result, peak = peak_memory(func, *setup())
+    seconds = min(times)
+    
+    print("%-18s %-38s %8.3f s %10.3g voxels/s %8.1f MB" % 
+          (name, path, seconds, voxels/seconds, peak/2.**20))
+    return {'case': name, 'path': path, 'seconds': seconds, 
+            'voxels': voxels, 'voxels_per_second': voxels/seconds, 
+            'peak_bytes': peak}
+
+def run(shape, inputs, repeat=1):
+    """Runs the benchmarks on grids of the given xyz shape and returns the 
+    results"""
+    
+    results = []
+    for name, make_doses in cases(shape, inputs):
+        dose_sum = DoseSum(make_doses())
+        voxels = int(np.prod(dose_sum.shape))
+        path = 'SumPlans (%s)' % dose_sum.method()
+        results.append(measure(name, path, lambda *doses: 
+            SumPlans(list(doses)), make_doses, voxels, repeat))
+        if name == 'different-spacing':
+            results.append(measure(name, 'SumPlans (float32)', 
+                lambda *doses: SumPlans(list(doses), precision=np.float32),
+                make_doses, voxels, repeat))
+            results.append(measure(name, 'SumPlans (trilinear)', 
+                lambda *doses: SumPlans(list(doses), 
+                                        interp_method='trilinear'), 
+                make_doses, voxels, repeat))
+    
+    #trilinear_interp on its own, over a slab's worth of random points
+    rng = np.random.RandomState(0)
+    array = synthetic_dose(shape, [0., 0., 0.], [1., 1., 1.]).pixel_array
+    array = np.swapaxes(array, 0, 2)
+    points = shape[0]*shape[1]*SLAB_FRAMES
+    indices = np.array([rng.uniform(0, n - 1, points) for n in shape])
+    results.append(measure('random-points', 'trilinear_interp', 
+        trilinear_interp, lambda: (array, indices), points, repeat))
+    
+    return results
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='plansum.benchmark',
+        description="Benchmark plansum on synthetic dose grids.")
+    parser.add_argument('--shape', type=int, nargs=3, default=[200, 200, 150],
+        metavar=('X', 'Y', 'Z'), help="voxels of the dose grids "
+        "(default: 200 200 150)")
+    parser.add_argument('--inputs', type=int, default=6,
+        help="doses in the many-input case (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=1,
+        help="timed runs of each benchmark, the fastest is reported")
+    parser.add_argument('-o', '--output',
+        help="JSON file to write the results to (default: stdout)")
+    args = parser.parse_args(argv)
+
+    #Progress goes to stderr so that stdout only carries the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.shape, args.inputs, args.repeat)
+    report = {'plansum_version': pluginProperties()['version'],
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'shape': args.shape,
+              'results': results,
+              'peak_rss_bytes': peak_rss()}
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,17 +4,61 @@ except ImportError:
     #Running as __main__, not as a plugin
     pass
 
-import wx
-from wx.lib.pubsub import pub
-from wx.xrc import XmlResource
+try:
+    import wx
+    from wx.lib.pubsub import pub
+    from wx.xrc import XmlResource
+except ImportError:
+    #Running headless, without the dicompyler GUI
+    wx = None
 import numpy as np
 import pydicom
-import matplotlib.mlab as mlab
 import numpy.testing as npt
     
 import unittest
 import os
+import sys
+import struct
+import tracemalloc
+import tempfile
+import copy
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource = None
+try:
+    from GFOVswitch.frameindex import FrameIndex, plane_mask
+except ImportError:
+    #Outside of dicompyler, import it from the GFOVswitch plugin's folder
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir, 'GFOVswitch'))
+    from frameindex import FrameIndex, plane_mask
 import threading, queue
+import time
+import collections
+from concurrent import futures
+from multiprocessing import shared_memory
+
+#Number of dose frames resampled and accumulated at a time by SumPlan
+SLAB_FRAMES = 8
+#Fraction of a voxel within which two dose grids are treated as sharing
+#the same lattice
+LATTICE_TOLERANCE = 1e-3
+#Memory budget, in bytes, of the cached resampling indices and weights
+PLAN_CACHE_BYTES = 64*2**20
+#(7FE0,0010) Pixel Data
+PIXEL_DATA_TAG = 0x7FE00010
+#(3004,0050) DVH Sequence
+DVH_SEQUENCE_TAG = 0x30040050
+#Factor by which the preview of a plan sum is coarser than the full sum
+PREVIEW_DECIMATION = 4
+#Width in Gy of the bins of summed DVHs
+DVH_BIN_WIDTH = 0.01
+#Largest uint32 pixel value of a summed dose
+MAX_PIXEL = 0xFFFFFFFF
+#ImageOrientationPatient of an axis-aligned deformation grid
+IDENTITY_ORIENTATION = [1., 0., 0., 0., 1., 0.]
 
 
 def pluginProperties():
@@ -65,9 +109,19 @@ class plugin:
         pub.subscribe(self.OnUpdatePatient, 'patient.updated.raw_data')
         pub.subscribe(self.OnUpdatePatient, 'patient.updated.parsed_data')
         
+        #State of the plan sum, which is refined in the background once its
+        #preview is published
+        self.cancel = None
+        self.sumDone = True
+        self.previewDose = None
+        self.previous = None
+        self.dlgProgress = None
+        self.dlgRefine = None
+        
     def OnUpdatePatient(self, msg):
         """Update and load the patient data."""
-        if 'rtdose' in msg:
+        #A published preview is never summed, so the patient dose is kept
+        if 'rtdose' in msg and msg['rtdose'] is not self.previewDose:
             self.rtdose = msg['rtdose']
         if 'rxdose' in msg:
             self.rxdose = msg['rxdose']
@@ -80,9 +134,25 @@ class plugin:
         """Unbind to all events before the plugin is destroyed."""
 
         pub.unsubscribe(self.OnUpdatePatient)
+        #Stop any plan sum still refining in the background
+        if self.cancel:
+            self.cancel.set()
+        if self.dlgRefine:
+            self.dlgRefine.Destroy()
+            self.dlgRefine = None
         
     def pluginMenu(self, evt):
         """Open a new RT Dose object and sum it with the current dose"""
+        #Only one plan sum runs at a time, so a refinement never publishes
+        #over a newer sum
+        if not self.sumDone:
+            dlg = wx.MessageDialog(self.parent, 
+                    "The previous plan sum is still being refined.\n"
+                    "Wait for it to finish or cancel it first.",
+                    "Cannot sum doses.", wx.OK | wx.ICON_WARNING)
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
         self.ptdata = ImportDicom(self.parent)
        
         if (self.ptdata['rtplan'].SeriesInstanceUID != \
@@ -96,140 +166,1347 @@ class plugin:
         
         old = self.rtdose
         new = self.ptdata['rtdose']
-        dlgProgress = guiutil.get_progress_dialog(
+        #The patient data that a cancelled refinement restores in place of
+        #its preview
+        self.previous = dict((key, getattr(self, key)) 
+                             for key in ('rtdose', 'rxdose', 'rtplan', 
+                                         'structures') 
+                             if getattr(self, key, None) is not None)
+        if 'rxdose' in self.ptdata and self.rxdose:
+            self.ptdata['rxdose'] = self.rxdose + self.ptdata['rxdose']
+        self.dlgProgress = guiutil.get_progress_dialog(
                 wx.GetApp().GetTopWindow(),
                 "Creating Plan Sum...")
-        q = queue.Queue()
-        threading.Thread(target=SumPlan, args=(old, new, q,
-                                        dlgProgress.OnUpdateProgress)).start()
-        dlgProgress.ShowModal()
-        dlgProgress.Destroy()
-        sumDicomObj = q.get()
-        if hasattr(sumDicomObj, 'DVHSequence'):
+        self.cancel = threading.Event()
+        self.previewed = False
+        self.sumDone = False
+        threading.Thread(target=self.SumThread, 
+                         args=(old, new, self.cancel)).start()
+        self.dlgProgress.ShowModal()
+        #The dialog closes when the preview is published.  Closing it 
+        #before then cancels the sum.
+        if not self.previewed:
+            self.cancel.set()
+        self.dlgProgress.Destroy()
+        self.dlgProgress = None
+        #The full resolution sum shows its progress, and can be cancelled,
+        #until it is published
+        if self.previewed and not self.sumDone:
+            self.dlgRefine = wx.ProgressDialog("Plan Sum", 
+                    "Refining the plan sum...", 100, 
+                    style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | 
+                          wx.PD_REMAINING_TIME)
+    
+    def SumThread(self, old, new, cancel):
+        """Sums the doses, publishing a coarse preview of the sum and then 
+        the full resolution sum once it has been refined"""
+        
+        sumDicomObj = None
+        error = None
+        try:
+            sumDicomObj = SumPlan(old, new, None, self.OnSumProgress, 
+                    cancel=cancel, preview=PREVIEW_DECIMATION, 
+                    previewFunc=lambda ds: wx.CallAfter(self.PublishSum, ds,
+                                                        cancel, True),
+                    structures=getattr(self, 'structures', None))
+        except Exception as e:
+            print("PlanSum: Failed: %s" % e)
+            error = e
+        finally:
+            #Always finish the sum, so that the next one is not refused
+            wx.CallAfter(self.OnSumDone, sumDicomObj, cancel, error)
+    
+    def OnSumProgress(self, num, length, message):
+        """Update the progress dialog, or that of the refinement once the 
+        preview is published"""
+        
+        if not self.previewed:
+            if self.dlgProgress:
+                self.dlgProgress.OnUpdateProgress(num, length, message)
+        else:
+            wx.CallAfter(self.OnRefineProgress, num, length, message)
+    
+    def OnRefineProgress(self, num, length, message):
+        """Update the refinement progress dialog, cancelling the sum if it 
+        was aborted"""
+        
+        if self.dlgRefine:
+            keepGoing = self.dlgRefine.Update(
+                            min(int(100.*num/max(length, 1)), 99), message)
+            if not keepGoing[0]:
+                self.cancel.set()
+    
+    def OnSumDone(self, sumDicomObj, cancel, error=None):
+        """Close the progress dialogs and publish the full resolution sum.
+        If the sum was cancelled or failed after its preview was published,
+        the dose that was there before is published again in its place."""
+        
+        self.sumDone = True
+        if self.dlgProgress:
+            self.dlgProgress.EndModal(0)
+        if self.dlgRefine:
+            self.dlgRefine.Destroy()
+            self.dlgRefine = None
+        if sumDicomObj is not None and not cancel.is_set():
+            self.previewDose = None
+            self.PublishSum(sumDicomObj, cancel)
+        elif self.previewDose is not None:
+            #A decimated preview never becomes the working dose
+            self.previewDose = None
+            ptdata = dict(self.ptdata)
+            ptdata.update(self.previous)
+            pub.sendMessage('patient.updated.raw_data', msg=ptdata)
+        self.previous = None
+        if error is not None:
+            dlg = wx.MessageDialog(self.parent, 
+                    "The plan sum failed:\n%s" % error,
+                    "Cannot sum doses.", wx.OK | wx.ICON_ERROR)
+            dlg.ShowModal()
+            dlg.Destroy()
+    
+    def PublishSum(self, sumDicomObj, cancel, preview=False):
+        """Publish a summed RT Dose object, or a preview of it, unless its 
+        sum was cancelled"""
+        
+        if cancel.is_set():
+            return
+        if preview:
+            self.previewed = True
+            self.previewDose = sumDicomObj
+            if self.dlgProgress:
+                self.dlgProgress.EndModal(0)
+        #Without structures the DVHs of the recycled dose are out of date
+        if not getattr(self, 'structures', None) and \
+           hasattr(sumDicomObj, 'DVHSequence'):
             del sumDicomObj.DVHSequence
-        self.ptdata['rtdose'] = sumDicomObj
-        if 'rxdose' in self.ptdata and self.rxdose:
-            self.ptdata['rxdose'] = self.rxdose + self.ptdata['rxdose']
-        pub.sendMessage('patient.updated.raw_data', msg=self.ptdata)
+        ptdata = dict(self.ptdata)
+        ptdata['rtdose'] = sumDicomObj
+        pub.sendMessage('patient.updated.raw_data', msg=ptdata)
         
         
-def SumPlan(old, new, q, progressFunc=None):
+def SumPlan(old, new, q, progressFunc=None, slab_frames=SLAB_FRAMES,
+            interp_method='separable', workers=None, precision=np.float64,
+            cancel=None, dvfs=None, preview=None, previewFunc=None,
+            biological=None, structures=None):
     """ Given two Dicom RTDose objects, returns a summed RTDose object"""
     """The summed RTDose object will consist of pixels inside the region of 
     overlap between the two pixel_arrays.  The pixel spacing will be the 
     coarser of the two objects in each direction.  The new DoseGridScaling
     tag will be the sum of the tags of the two objects.
     
-    interp_method: A string that is one of ['scipy','weave','python'].  
-        This forces SumPlan to use a particular interpolation method, even if 
-        the dose objects could be directly summed.  Used for unit testing."""
-    
-    #Recycle the new Dicom object to store the summed dose values
-    sum_dcm = new
-    
-    #Test if dose grids are coincident.  If so, we can directly sum the 
-    #pixel arrays.
-    if (old.ImagePositionPatient == new.ImagePositionPatient and
-        old.pixel_array.shape == new.pixel_array.shape and
-        old.PixelSpacing == new.PixelSpacing and
-        old.GridFrameOffsetVector == new.GridFrameOffsetVector):
-        print("PlanSum: Using direct summation")
-        if progressFunc:
-            wx.CallAfter(progressFunc, 0, 1, 'Using direct summation')
-        sum = old.pixel_array*old.DoseGridScaling + \
-                new.pixel_array*new.DoseGridScaling
-        
-    else:    
-        #Compute mapping from xyz (physical) space to ijk (index) space
-        scale_old = np.array([old.PixelSpacing[0],old.PixelSpacing[1],
-                    old.GridFrameOffsetVector[1]-old.GridFrameOffsetVector[0]])
-        
-        scale_new = np.array([new.PixelSpacing[0],new.PixelSpacing[1],
-                    new.GridFrameOffsetVector[1]-new.GridFrameOffsetVector[0]])
-        
-        scale_sum = np.maximum(scale_old,scale_new)
-        
-        #Find region of overlap
-        xmin = np.array([old.ImagePositionPatient[0],
-                         new.ImagePositionPatient[0]])
-        ymin = np.array([old.ImagePositionPatient[1],
-                         new.ImagePositionPatient[1]])
-        zmin = np.array([old.ImagePositionPatient[2],
-                         new.ImagePositionPatient[2]])
-        xmax = np.array([old.ImagePositionPatient[0] + 
-                         old.PixelSpacing[0]*old.Columns,
-                         new.ImagePositionPatient[0] + 
-                         new.PixelSpacing[0]*new.Columns])
-        ymax = np.array([old.ImagePositionPatient[1] + 
-                         old.PixelSpacing[1]*old.Rows,
-                         new.ImagePositionPatient[1] +
-                          new.PixelSpacing[1]*new.Rows])
-        zmax = np.array([old.ImagePositionPatient[2] + 
-                         scale_old[2]*len(old.GridFrameOffsetVector),
-                         new.ImagePositionPatient[2] + 
-                         scale_new[2]*len(new.GridFrameOffsetVector)])
-        x0 = xmin[np.argmin(abs(xmin))]
-        x1 = xmax[np.argmin(abs(xmax))]
-        y0 = ymin[np.argmin(abs(ymin))]
-        y1 = ymax[np.argmin(abs(ymax))]
-        z0 = zmin[np.argmin(abs(zmin))]
-        z1 = zmax[np.argmin(abs(zmax))]
-        
-        
-        sum_ip = np.array([x0,y0,z0])
-        
-        #Create index grid for the sum array
-        i,j,k = np.mgrid[0:int((x1-x0)/scale_sum[0]),
-                         0:int((y1-y0)/scale_sum[1]),
-                         0:int((z1-z0)/scale_sum[2])] 
-        
-        x_vals = np.arange(x0,x1,scale_sum[0])
-        y_vals = np.arange(y0,y1,scale_sum[1])
-        z_vals = np.arange(z0,z1,scale_sum[2])
-        
-        #Create a 3 x i x j x k array of xyz coordinates for the interpolation.
-        sum_xyz_coords = np.array([i*scale_sum[0] + sum_ip[0],
-                                      j*scale_sum[1] + sum_ip[1],
-                                      k*scale_sum[2] + sum_ip[2]])
+    See SumPlans for the slab_frames, interp_method, workers, precision, 
+    cancel, dvfs, preview, biological and structures options."""
+    
+    return SumPlans([old, new], q, progressFunc, slab_frames=slab_frames,
+                    interp_method=interp_method, workers=workers,
+                    precision=precision, cancel=cancel, dvfs=dvfs,
+                    preview=preview, previewFunc=previewFunc,
+                    biological=biological, structures=structures)
+
+def SumPlans(doses, q=None, progressFunc=None, weights=None, 
+             slab_frames=SLAB_FRAMES, interp_method='separable', 
+             workers=None, precision=np.float64, cancel=None, dvfs=None,
+             preview=None, previewFunc=None, biological=None, 
+             structures=None):
+    """ Given a list of Dicom RTDose objects, returns a summed RTDose object"""
+    """The summed RTDose object will consist of pixels inside the region of 
+    overlap of all of the pixel_arrays.  The pixel spacing will be the 
+    coarsest of the objects in each direction.  Each dose is resampled once,
+    directly onto the summed grid, and accumulated as floating point; the 
+    sum is only quantized to uint32 at the end.  The new DoseGridScaling 
+    tag will be the weighted sum of the tags of the objects.
+    
+    progressFunc is called with the progress of each stage and, while 
+    summing, after every slab with the elapsed time and throughput.
+    
+    cancel: An optional threading.Event.  If it is set the sum stops at the 
+        next slab, its memory is released, the doses are left unchanged and
+        None is returned (or put on q) instead of the summed object.
+    
+    preview: An optional decimation factor, such as 2 or 4.  The doses are 
+        first summed on a grid with that many times the spacing of the 
+        summed grid, and previewFunc is called with the result before the 
+        full resolution sum is computed.  The preview is a new RTDose 
+        object, so the doses are unchanged until the full sum is done.
+    
+    structures: An optional dict of dicompyler structures, with their 
+        contours in 'planes'.  If given, the cumulative DVH of each 
+        structure is computed from the summed dose and attached as a new 
+        DVHSequence, in place of that of the recycled dose.
+    
+    See DoseSum for the weights, slab_frames, interp_method, workers, 
+    precision, dvfs and biological options."""
+    
+    start = time.time()
+    
+    def progress(frames, total):
+        elapsed = max(time.time() - start, 1e-9)
+        voxels = frames*dose_sum.shape[0]*dose_sum.shape[1]
+        #The last step is left for writing the pixel data
+        report_progress(progressFunc, frames, total + 1, 
+            'Summing frame %d of %d: %.1f s, %.3g voxels/s' % 
+            (frames, total, elapsed, voxels/elapsed))
+    
+    try:
+        report_progress(progressFunc, 0, 1, 'Reading doses')
+        if preview:
+            preview_sum = DoseSum(doses, weights, slab_frames, 
+                                  interp_method, workers, precision, dvfs,
+                                  decimation=preview, biological=biological)
+            print("PlanSum: Previewing using %s" % preview_sum.method())
+            report_progress(progressFunc, 0, 1, 'Previewing')
+            preview_dcm = preview_sum.header(recycle=False)
+            preview_pixels = preview_sum.compute(cancel)
+            if structures:
+                preview_dcm.DVHSequence = preview_sum.dvh_sequence(
+                                            preview_pixels, structures)
+            preview_dcm.PixelData = preview_pixels.tobytes()
+            del preview_sum, preview_pixels
+            previewFunc(preview_dcm)
+            start = time.time()
         
-        #Dicom pixel_array objects seem to have the z axis in the first index
-        #(zyx).  The x and z axes are swapped before interpolation to coincide
-        #with the xyz ordering of ImagePositionPatient
-        sum = interpolate_image(np.swapaxes(old.pixel_array,0,2), scale_old, 
-            old.ImagePositionPatient, sum_xyz_coords,
-            progressFunc)*old.DoseGridScaling + \
-            interpolate_image(np.swapaxes(new.pixel_array,0,2), scale_new, 
-            new.ImagePositionPatient, sum_xyz_coords,
-            progressFunc)*new.DoseGridScaling
+        dose_sum = DoseSum(doses, weights, slab_frames, interp_method, 
+                           workers, precision, dvfs, biological=biological)
+        method = dose_sum.method()
+        print("PlanSum: Using %s" % method)
+        report_progress(progressFunc, 0, 1, 'Using %s' % method)
         
-        #Swap the x and z axes back
-        sum = np.swapaxes(sum, 0, 2)
-        sum_dcm.ImagePositionPatient = list(sum_ip)
-        sum_dcm.Rows = len(y_vals)
-        sum_dcm.Columns = len(x_vals)
-        sum_dcm.NumberOfFrames = len(z_vals)
-        sum_dcm.PixelSpacing = [scale_sum[0],scale_sum[1]]
-        sum_dcm.GridFrameOffsetVector = list(z_vals - sum_ip[2])
-                
-
-    sum_scaling = old.DoseGridScaling + new.DoseGridScaling
-    
-    sum = sum/sum_scaling
-    sum = np.uint32(sum)
-    
-    #sum_dcm.pixel_array = sum
-    sum_dcm.BitsAllocated = 32
-    sum_dcm.BitsStored = 32
-    sum_dcm.HighBit = 31
-    sum_dcm.PixelData = sum.tostring()
-    sum_dcm.DoseGridScaling = sum_scaling
-    if progressFunc:
-        wx.CallAfter(progressFunc, 1, 1, 'Done')
+        sum = dose_sum.compute(cancel, progress)
+    except SumCancelled:
+        print("PlanSum: Cancelled")
+        sum_dcm = None
+    else:
+        if structures:
+            frames = dose_sum.shape[2]
+            report_progress(progressFunc, frames, frames + 1, 
+                            'Computing DVHs')
+            dvhs = dose_sum.dvh_sequence(sum, structures)
+        report_progress(progressFunc, 1, 1, 'Writing pixel data')
+        sum_dcm = dose_sum.header()
+        if structures:
+            sum_dcm.DVHSequence = dvhs
+        sum_dcm.PixelData = sum.tobytes()
+        del sum
+        report_progress(progressFunc, 1, 1, 'Done')
+    
     if q:
         q.put(sum_dcm)
     else:
         return sum_dcm
+
+class DoseSum:
+    """The weighted sum of a list of RTDose objects, computed one slab of 
+    frames at a time."""
+    
+    def __init__(self, doses, weights=None, slab_frames=SLAB_FRAMES, 
+                 interp_method='separable', workers=None, 
+                 precision=np.float64, dvfs=None, decimation=1, 
+                 biological=None):
+        """Parameters:
+            doses: a list of Dicom RTDose objects.  The last one is recycled
+                to store the summed dose.
+            
+            weights: An optional list of finite, non-negative factors, one 
+                per dose, with a positive weighted DoseGridScaling, that each 
+                dose is multiplied by before it is added to the sum.
+            
+            slab_frames: The number of output frames (z planes) resampled 
+                and accumulated at a time.  Peak memory is proportional to 
+                the size of a slab rather than the whole volume.  None 
+                resamples the whole volume at once.
+            
+            interp_method: A string that is one of ['separable','trilinear'].
+                'separable' interpolates the axis-aligned grids with 
+                successive 1D passes.  'trilinear' uses the reference 
+                trilinear_interp at every output voxel.
+            
+            workers: The number of processes that resample the slabs in 
+                parallel, or 0 for one per CPU.  None or 1 sums in this 
+                process.  The result is identical to the serial sum.
+            
+            precision: The floating point type, np.float64 or np.float32, 
+                that the doses are resampled and accumulated in.  float32 
+                halves the memory traffic and temporaries at the cost of 
+                rounding well below the uint32 quantization of the sum.  
+                The reference 'trilinear' interpolation always works in 
+                float64.
+            
+            dvfs: An optional list of DeformationField objects, one per 
+                dose, or None for a dose that is already in the reference 
+                anatomy.  Each dose is pulled through its field onto the 
+                grid of the first dose, which is the reference.  Points 
+                outside of a dose, warped or not, receive none of it.  Warped
+                sums are computed in this process, one slab at a time.
+            
+            decimation: The factor by which the spacing of the summed grid
+                is coarsened, for a quick preview of the sum.
+            
+            biological: An optional BiologicalDose.  Each weighted dose is 
+                converted to BED voxel by voxel before it is summed, and the
+                DoseGridScaling is chosen from an upper bound of the 
+                converted sum."""
+        
+        if weights is None:
+            weights = [1.]*len(doses)
+        if len(weights) != len(doses):
+            raise ValueError("Expected %d weights, got %d" % 
+                             (len(doses), len(weights)))
+        weights = [float(w) for w in weights]
+        if not all(np.isfinite(w) and w >= 0 for w in weights):
+            raise ValueError("Weights must be finite and not negative, got "
+                             "%s" % weights)
+        if dvfs is not None and len(dvfs) != len(doses):
+            raise ValueError("Expected %d deformation fields, got %d" % 
+                             (len(doses), len(dvfs)))
+        if dvfs is not None and all(dvf is None for dvf in dvfs):
+            dvfs = None
+        
+        self.doses = doses
+        self.slab_frames = slab_frames
+        self.interp_method = interp_method
+        self.workers = workers
+        self.precision = precision
+        self.dvfs = dvfs
+        if dvfs is not None and slab_frames is None:
+            #The displaced coordinates are never built for the whole volume
+            self.slab_frames = SLAB_FRAMES
+        dose_scaling = [w*ds.DoseGridScaling for w, ds in zip(weights, doses)]
+        self.sum_scaling = float(np.sum(dose_scaling))
+        if not (np.isfinite(self.sum_scaling) and self.sum_scaling > 0):
+            #The summed pixels would divide by zero or wrap around
+            raise ValueError("The weighted DoseGridScaling must be positive, "
+                             "got %g" % self.sum_scaling)
+        
+        #Test if dose grids are coincident.  If so, we can directly sum the 
+        #pixel arrays on the grid of the first dose.
+        first = doses[0]
+        self.direct = dvfs is None and all(
+            ds.ImagePositionPatient == first.ImagePositionPatient and
+            pixel_volume(ds).shape == pixel_volume(first).shape and
+            ds.PixelSpacing == first.PixelSpacing and
+            ds.GridFrameOffsetVector == first.GridFrameOffsetVector
+            for ds in doses[1:])
+        if self.direct or dvfs is not None:
+            self.origin = np.array([float(v) 
+                                    for v in first.ImagePositionPatient])
+            self.scale = dose_scale(first)
+            self.shape = pixel_volume(first).shape[::-1]
+        else:
+            self.origin, self.scale, self.shape = sum_grid(doses)
+        if decimation > 1:
+            self.direct = False
+            self.scale = self.scale*decimation
+            self.shape = tuple((n - 1)//decimation + 1 for n in self.shape)
+        
+        self.sources = [(pixel_volume(ds), dose_scale(ds), 
+                         ds.ImagePositionPatient, scaling) 
+                        for ds, scaling in zip(doses, dose_scaling)]
+        
+        if biological is not None:
+            if len(biological.fractions) != len(doses):
+                raise ValueError("Expected %d fraction counts, got %d" % 
+                                 (len(doses), len(biological.fractions)))
+            if decimation > 1:
+                biological = biological.decimated(decimation)
+            if biological.labels is not None and \
+               biological.labels.shape != tuple(self.shape[::-1]):
+                raise ValueError("The label map does not match the summed "
+                                 "dose grid")
+            peaks = [float(np.max(source[0]))*source[3] 
+                     for source in self.sources]
+            bound = biological.upper_bound(peaks) or 1.
+            #Headroom for rounding of the converted sum
+            self.sum_scaling = bound*(1 + 1e-6)/MAX_PIXEL
+        self.biological = biological
+    
+    def method(self):
+        """Returns a description of how the doses are summed."""
+        
+        if self.direct:
+            return 'direct summation'
+        if self.dvfs is not None:
+            return 'deformable summation'
+        if all(lattice_offset(source[0].shape, source[1], source[2], 
+                              self.origin, self.scale, self.shape) is not None
+               for source in self.sources):
+            return 'lattice-aligned summation'
+        return '%s interpolation' % self.interp_method
+    
+    def header(self, recycle=True):
+        """Returns the recycled RTDose object with its tags describing the 
+        summed dose grid.  The PixelData is left to the caller."""
+        """If recycle is False a copy of the last RTDose object, without its
+        PixelData and DVHSequence and with new SOP Instance and Series 
+        UIDs, is returned and the doses are left unchanged."""
+        
+        if recycle:
+            sum_dcm = self.doses[-1]
+            #The recycled object no longer describes its mapped input pixels
+            sum_dcm._pixel_map = None
+        else:
+            last = self.doses[-1]
+            sum_dcm = pydicom.dataset.FileDataset('', {}, 
+                        file_meta=copy.deepcopy(last.file_meta), 
+                        preamble=b"\0"*128)
+            for elem in last:
+                if elem.tag not in (PIXEL_DATA_TAG, DVH_SEQUENCE_TAG):
+                    sum_dcm.add(copy.deepcopy(elem))
+            #The copy is a new object, so that it is never mistaken for the
+            #last dose when both are saved
+            sum_dcm.SOPInstanceUID = pydicom.uid.generate_uid()
+            sum_dcm.SeriesInstanceUID = pydicom.uid.generate_uid()
+            sum_dcm.file_meta.MediaStorageSOPInstanceUID = \
+                sum_dcm.SOPInstanceUID
+        if not self.direct:
+            z_vals = np.arange(self.shape[2])*self.scale[2] + self.origin[2]
+            sum_dcm.ImagePositionPatient = list(self.origin)
+            sum_dcm.Rows = self.shape[1]
+            sum_dcm.Columns = self.shape[0]
+            sum_dcm.NumberOfFrames = self.shape[2]
+            sum_dcm.PixelSpacing = [self.scale[0],self.scale[1]]
+            sum_dcm.GridFrameOffsetVector = list(z_vals - self.origin[2])
+        
+        sum_dcm.BitsAllocated = 32
+        sum_dcm.BitsStored = 32
+        sum_dcm.HighBit = 31
+        sum_dcm.DoseGridScaling = self.sum_scaling
+        sum_dcm.DoseSummationType = 'MULTI_PLAN'
+        if self.biological is not None:
+            sum_dcm.DoseComment = self.biological.description()
+        
+        return sum_dcm
+    
+    def dvh_sequence(self, pixels, structures):
+        """Returns a DVHSequence of the cumulative DVHs of the structures 
+        for the zyx uint32 summed pixels"""
+        """The structures are rasterized once onto the summed grid and every
+        DVH is accumulated in a single pass over the summed dose."""
+        
+        numbers, bits, bounds = rasterize_structures(structures, 
+                                    self.origin, self.scale, self.shape)
+        voxel_volume = np.prod(self.scale)/1000.
+        dvhs = structure_dvhs(pixels, self.sum_scaling, bits, bounds, 
+                              voxel_volume, self.slab_frames)
+        if self.biological is not None:
+            dose_type = 'EFFECTIVE'
+        else:
+            dose_type = 'PHYSICAL'
+        return dvh_sequence(numbers, dvhs, dose_type)
+    
+    def iter_slabs(self, cancel=None, progress=None):
+        """Yields the start frame, stop frame and uint32 summed pixels of 
+        each slab of the summed dose in turn.
+        
+        Before each slab SumCancelled is raised if the cancel event is 
+        set.  After each slab progress, if given, is called with the number
+        of frames summed so far and the total number of frames.  With 
+        workers the slabs are yielded in the order they are finished."""
+        
+        if self.workers is not None and self.workers != 1 and \
+           self.dvfs is None:
+            for k0, k1, slab in iter_parallel_slabs(self.sources, 
+                    self.origin, self.scale, self.shape, self.sum_scaling, 
+                    self.slab_frames, self.interp_method, self.workers, 
+                    self.precision, cancel, progress, self.biological):
+                yield k0, k1, slab
+            return
+        
+        for k0, k1 in slabs(self.shape[2], self.slab_frames):
+            check_cancelled(cancel)
+            slab = sum_slab(self.sources, self.origin, self.scale, 
+                            self.shape, k0, k1, self.sum_scaling, 
+                            self.interp_method, self.precision, self.dvfs,
+                            self.biological)
+            if progress:
+                progress(k1, self.shape[2])
+            yield k0, k1, slab
+    
+    def compute(self, cancel=None, progress=None):
+        """Returns the zyx uint32 summed pixels of the whole volume.  See 
+        iter_slabs for the cancel and progress arguments."""
+        
+        #The summed frames are preallocated and filled one slab of z planes
+        #at a time, so the coordinate and interpolation temporaries never 
+        #exist for the whole volume.
+        sum = np.empty(self.shape[::-1], np.uint32)
+        for k0, k1, slab in self.iter_slabs(cancel, progress):
+            sum[k0:k1] = slab
+        
+        return sum
+
+class SumCancelled(Exception):
+    """Raised between slabs when a plan sum is cancelled."""
+
+def check_cancelled(cancel):
+    """Raises SumCancelled if the cancel event is set"""
+    
+    if cancel is not None and cancel.is_set():
+        raise SumCancelled()
+
+def rasterize_structures(structures, origin, scale, shape):
+    """Rasterizes dicompyler structures onto a dose grid as a bitmask 
+    volume"""
+    """Each frame of the grid takes the contours of the nearest structure 
+    plane within half of the plane thickness.  A grid point is inside a 
+    plane if it is inside an odd number of its contours, so that inner 
+    contours are holes.  Returns the sorted ROI numbers, a (words, z, y, x)
+    uint8 array with bit i % 8 of word i // 8 set inside structure i, and 
+    the (k0, k1, j0, j1, i0, i1) frame, row and column bounds of each 
+    structure, or None for an empty structure."""
+    
+    numbers = sorted(structures)
+    bits = np.zeros(((len(numbers) + 7)//8, shape[2], shape[1], shape[0]), 
+                    np.uint8)
+    x = np.arange(shape[0])*scale[0] + origin[0]
+    y = np.arange(shape[1])*scale[1] + origin[1]
+    z = np.arange(shape[2])*scale[2] + origin[2]
+    
+    bounds = []
+    for index, number in enumerate(numbers):
+        structure = structures[number]
+        planes = structure.get('planes') or {}
+        keys = list(planes)
+        #The absolute z positions of the planes, indexed for nearest lookups
+        index_z = FrameIndex(keys, 0.)
+        thickness = structure.get('thickness')
+        if not thickness:
+            spacing = np.diff(np.unique(index_z.z))
+            thickness = spacing.min() if len(spacing) else scale[2]
+        
+        word = bits[index//8]
+        bit = np.uint8(1 << (index % 8))
+        masks = {}
+        box = None
+        for k in range(shape[2] if len(keys) else 0):
+            nearest = index_z.nearest(z[k], thickness/2.)
+            if nearest is None:
+                continue
+            key = keys[nearest]
+            if key not in masks:
+                masks[key] = plane_mask(planes[key], x, y)
+            if masks[key] is None:
+                continue
+            j0, j1, i0, i1, mask = masks[key]
+            word[k, j0:j1, i0:i1] |= mask*bit
+            if box is None:
+                box = [k, k + 1, j0, j1, i0, i1]
+            else:
+                box = [box[0], k + 1, min(box[2], j0), max(box[3], j1),
+                       min(box[4], i0), max(box[5], i1)]
+        bounds.append(box)
+    
+    return numbers, bits, bounds
+
+def structure_dvhs(pixels, dose_scaling, bits, bounds, voxel_volume, 
+                   slab_frames=SLAB_FRAMES):
+    """Returns the differential DVH, in cm3 per DVH_BIN_WIDTH bin, of each 
+    structure of a bitmask volume from rasterize_structures"""
+    """The zyx uint32 pixels are binned one slab of frames at a time and 
+    the bins inside each structure are counted with np.bincount."""
+    
+    counts = [np.zeros(0, np.int64) for box in bounds]
+    for k0, k1 in slabs(pixels.shape[0], slab_frames):
+        dose_bins = None
+        for index, box in enumerate(bounds):
+            if box is None or box[0] >= k1 or box[1] <= k0:
+                continue
+            if dose_bins is None:
+                dose_bins = np.multiply(pixels[k0:k1], 
+                                dose_scaling/DVH_BIN_WIDTH).astype(np.intp)
+            b0, b1 = max(k0, box[0]), min(k1, box[1])
+            j0, j1, i0, i1 = box[2:]
+            mask = bits[index//8, b0:b1, j0:j1, i0:i1] & \
+                   np.uint8(1 << (index % 8))
+            hist = np.bincount(
+                dose_bins[b0 - k0:b1 - k0, j0:j1, i0:i1][mask != 0])
+            if len(hist) > len(counts[index]):
+                hist[:len(counts[index])] += counts[index]
+                counts[index] = hist
+            else:
+                counts[index][:len(hist)] += hist
+    
+    return [count*voxel_volume for count in counts]
+
+def dvh_sequence(numbers, dvhs, dose_type='PHYSICAL'):
+    """Returns a DVHSequence of cumulative DVHs of the given ROI numbers 
+    from differential DVHs in cm3 per DVH_BIN_WIDTH bin"""
+    
+    sequence = []
+    for number, dvh in zip(numbers, dvhs):
+        if not len(dvh):
+            continue
+        cumulative = dvh[::-1].cumsum()[::-1]
+        data = np.empty(2*len(cumulative))
+        data[0::2] = DVH_BIN_WIDTH
+        data[1::2] = cumulative
+        doses = (np.arange(len(dvh)) + 0.5)*DVH_BIN_WIDTH
+        nonzero = np.nonzero(dvh)[0]
+        
+        roi = pydicom.dataset.Dataset()
+        roi.ReferencedROINumber = number
+        roi.DVHROIContributionType = 'INCLUDED'
+        item = pydicom.dataset.Dataset()
+        item.DVHReferencedROISequence = [roi]
+        item.DVHType = 'CUMULATIVE'
+        item.DoseUnits = 'GY'
+        item.DoseType = dose_type
+        item.DVHDoseScaling = 1.0
+        item.DVHVolumeUnits = 'CM3'
+        item.DVHNumberOfBins = len(cumulative)
+        item.DVHData = [float('%.6g' % value) for value in data]
+        item.DVHMinimumDose = float('%.6g' % doses[nonzero[0]])
+        item.DVHMaximumDose = float('%.6g' % doses[nonzero[-1]])
+        item.DVHMeanDose = float('%.6g' % (np.sum(doses*dvh)/dvh.sum()))
+        sequence.append(item)
+    
+    return pydicom.sequence.Sequence(sequence)
+
+def report_progress(progressFunc, num, length, message):
+    """Calls progressFunc with the progress of a sum, on the GUI thread when 
+    running under wx"""
+    
+    if not progressFunc:
+        return
+    if wx:
+        wx.CallAfter(progressFunc, num, length, message)
+    else:
+        progressFunc(num, length, message)
+
+def write_rtdose(ds, filename, frames):
+    """Writes an RTDose object to filename, streaming its pixel data"""
+    """The PixelData of ds is ignored.  Instead frames is iterated for 
+    (start frame, stop frame, uint32 pixels) tuples, such as those yielded 
+    by DoseSum.iter_slabs.  The pixel data is preallocated in the file and 
+    each slab is copied into a memory map of it as it arrives, so the whole
+    volume is never held in memory.  The file is written as uncompressed 
+    little endian."""
+    
+    header = pydicom.dataset.Dataset()
+    for elem in ds:
+        if elem.tag < PIXEL_DATA_TAG:
+            header.add(elem)
+    
+    file_meta = ds.file_meta
+    implicit = (file_meta.TransferSyntaxUID == 
+                pydicom.uid.ImplicitVRLittleEndian)
+    if not implicit:
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    header = pydicom.dataset.FileDataset(filename, header, 
+                file_meta=file_meta, preamble=b"\0"*128, 
+                is_implicit_VR=implicit, is_little_endian=True)
+    length = ds.Rows*ds.Columns*ds.NumberOfFrames*4
+    
+    with open(filename, 'wb') as fp:
+        header.save_as(fp, write_like_original=False)
+        if implicit:
+            fp.write(struct.pack('<HHI', 0x7FE0, 0x0010, length))
+        else:
+            fp.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OW', 0, 
+                                 length))
+        offset = fp.tell()
+        fp.truncate(offset + length)
+    
+    pixels = np.memmap(filename, '<u4', 'r+', offset, 
+                       (ds.NumberOfFrames, ds.Rows, ds.Columns))
+    try:
+        for k0, k1, slab in frames:
+            pixels[k0:k1] = slab
+        pixels.flush()
+    finally:
+        del pixels
+
+def read_rtdose(filename):
+    """Reads an RTDose file with its pixels mapped from disk"""
+    """For uncompressed little endian files the PixelData element is not 
+    read.  Instead the pixels are exposed, by their byte offset in the file,
+    as a read-only numpy memmap that pixel_volume returns in place of the 
+    pixel_array, so the volume is never decoded or fully resident.  Other 
+    files are read normally."""
+    
+    with open(filename, 'rb') as fp:
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+        syntax = ds.file_meta.TransferSyntaxUID
+        element = fp.read(8)
+        if (syntax in (pydicom.uid.ImplicitVRLittleEndian, 
+                       pydicom.uid.ExplicitVRLittleEndian) and
+            len(element) == 8 and
+            struct.unpack('<HH', element[:4]) == (0x7FE0, 0x0010)):
+            if syntax == pydicom.uid.ImplicitVRLittleEndian:
+                length = struct.unpack('<I', element[4:])[0]
+            else:
+                length = struct.unpack('<I', fp.read(4))[0]
+            offset = fp.tell()
+        else:
+            length = None
+    
+    dtype = '<%s%d' % ('i' if ds.get('PixelRepresentation') else 'u',
+                       ds.BitsAllocated//8)
+    shape = (int(ds.get('NumberOfFrames', 1)), ds.Rows, ds.Columns)
+    if length is None or length == 0xFFFFFFFF or ds.SamplesPerPixel != 1 or \
+       length < np.prod(shape)*np.dtype(dtype).itemsize:
+        return pydicom.dcmread(filename)
+    
+    ds._pixel_map = np.memmap(filename, dtype, 'r', offset, shape)
+    return ds
+
+def read_dvf(filename, reference=None):
+    """Reads a DeformationField from a DICOM Deformable Spatial 
+    Registration object or a NumPy file"""
+    """A .npz file holds 'vectors', a (z, y, x, 3) array of xyz 
+    displacements in mm, with the xyz 'origin' and 'spacing' of its grid.  
+    A .npy file holds only the vectors, which are then on the grid of the 
+    reference RTDose object."""
+    
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npz':
+        with np.load(filename) as data:
+            return DeformationField(data['vectors'], data['origin'], 
+                                    data['spacing'])
+    elif extension == '.npy':
+        if reference is None:
+            raise ValueError("A reference dose is required for the grid of "
+                             "%s" % filename)
+        vectors = np.load(filename, mmap_mode='r')
+        if vectors.shape[:3] != pixel_volume(reference).shape:
+            raise ValueError("The vectors in %s do not match the reference "
+                             "dose grid" % filename)
+        return DeformationField(vectors, reference.ImagePositionPatient, 
+                                dose_scale(reference))
+    
+    return DeformationField.from_dicom(pydicom.dcmread(filename))
+
+def pixel_volume(ds):
+    """Returns the zyx pixels of an RTDose object, from its memory map if it
+    was read by read_rtdose"""
+    
+    pixels = getattr(ds, '_pixel_map', None)
+    if pixels is not None:
+        return pixels
+    return ds.pixel_array
+
+def peak_rss():
+    """Returns the peak resident memory of this process in bytes, or None 
+    where it is not available"""
+    
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    #ru_maxrss is in kilobytes except on Mac OS X
+    return rss if sys.platform == 'darwin' else rss*1024
+
+def dose_scale(ds):
+    """Returns the xyz voxel spacing of an RTDose object"""
+    
+    return np.array([ds.PixelSpacing[0], ds.PixelSpacing[1],
+                     ds.GridFrameOffsetVector[1]-ds.GridFrameOffsetVector[0]])
+
+def sum_grid(doses):
+    """Returns the origin, spacing and xyz shape of the summed dose grid"""
+    """The summed grid covers the region of overlap of all of the doses, at
+    the coarsest of their pixel spacings in each direction."""
+    
+    #Compute mapping from xyz (physical) space to ijk (index) space
+    scales = np.array([dose_scale(ds) for ds in doses])
+    scale_sum = scales.max(axis=0)
+    
+    #Find region of overlap
+    mins = np.array([[float(v) for v in ds.ImagePositionPatient] 
+                     for ds in doses])
+    sizes = np.array([[ds.Columns, ds.Rows, len(ds.GridFrameOffsetVector)]
+                      for ds in doses])
+    maxs = mins + scales*sizes
+    x0, y0, z0 = mins.max(axis=0)
+    x1, y1, z1 = maxs.min(axis=0)
+    
+    sum_ip = np.array([x0,y0,z0])
+    sum_shape = (int((x1-x0)/scale_sum[0]),
+                 int((y1-y0)/scale_sum[1]),
+                 int((z1-z0)/scale_sum[2]))
+    
+    return sum_ip, scale_sum, sum_shape
+
+def slabs(frames, slab_frames):
+    """Yields (start, stop) frame ranges covering frames in steps of 
+    slab_frames.  A slab_frames of None yields a single range."""
+    
+    if not slab_frames:
+        slab_frames = max(frames, 1)
+    for k0 in range(0, frames, slab_frames):
+        yield k0, min(k0 + slab_frames, frames)
+
+def grid_coords(origin, scale, shape, k0, k1):
+    """Returns the xyz coordinates of frames k0 to k1 of a grid"""
+    """Following the scipy convention, the result is a 3 x i x j x k array
+    of the x, y and z values of each grid point."""
+    
+    #Create index grid for the slab
+    i,j,k = np.mgrid[0:shape[0], 0:shape[1], k0:k1]
+    
+    return np.array([i*scale[0] + origin[0],
+                     j*scale[1] + origin[1],
+                     k*scale[2] + origin[2]])
   
+def resample_dose(ds, origin, scale, shape, k0, k1, 
+                  interp_method='separable', progressFunc=None, 
+                  precision=np.float64):
+    """Resamples the pixel_array of an RTDose object onto frames k0 to k1 of
+    the grid with the given xyz origin, scale and shape.  Returns a zyx 
+    array of pixel values."""
+    
+    return resample_array(pixel_volume(ds), dose_scale(ds), 
+                          ds.ImagePositionPatient, origin, scale, shape, 
+                          k0, k1, interp_method, progressFunc, precision)
+
+def resample_array(input_array, input_scale, input_offset, origin, scale, 
+                   shape, k0, k1, interp_method='separable', 
+                   progressFunc=None, precision=np.float64):
+    """Resamples a zyx input_array, with the given xyz pixel spacing and 
+    origin, onto frames k0 to k1 of the grid with the given xyz origin, 
+    scale and shape.  Returns a zyx array, interpolated in the given 
+    floating point precision."""
+    
+    if interp_method not in ('separable', 'trilinear'):
+        raise ValueError("Unknown interpolation method: %s" % interp_method)
+    
+    #Lattice-aligned grids are sliced without interpolation, other grids use
+    #the cached separable indices and weights for this geometry
+    plan = resample_plans.get(input_array.shape, input_scale, input_offset,
+                              origin, scale, shape)
+    if plan.offset is not None or interp_method == 'separable':
+        return plan.resample(input_array, k0, k1, precision)
+    
+    else:
+        #Dicom pixel_array objects seem to have the z axis in the first index
+        #(zyx).  The x and z axes are swapped before interpolation to coincide
+        #with the xyz ordering of ImagePositionPatient
+        xyz_coords = grid_coords(origin, scale, shape, k0, k1)
+        output = interpolate_image(np.swapaxes(input_array, 0, 2),
+                    input_scale, input_offset, xyz_coords, progressFunc)
+        
+        #Swap the x and z axes back
+        return np.swapaxes(output, 0, 2)
+
+class ResamplePlan:
+    """Indices and weights that resample a source dose grid onto a target 
+    grid, precomputed for every frame of the target."""
+    
+    def __init__(self, input_shape, input_scale, input_offset, origin, scale,
+                 shape):
+        
+        self.shape = shape
+        self.offset = lattice_offset(input_shape, input_scale, input_offset,
+                                     origin, scale, shape)
+        self.axes = None
+        self.nbytes = 0
+        if self.offset is None:
+            self.axes = [axis_interp(input_shape[2-n], input_scale[n], 
+                             input_offset[n], 
+                             np.arange(shape[n])*scale[n] + origin[n])
+                         for n in range(3)]
+            self.nbytes = sum(a.nbytes for axis in self.axes for a in axis)
+    
+    def resample(self, input_array, k0, k1, precision=np.float64):
+        """Returns frames k0 to k1 of the zyx input_array resampled onto the 
+        target grid, interpolated in the given floating point precision"""
+        
+        if self.offset is not None:
+            i, j, k = self.offset
+            return input_array[k+k0:k+k1, j:j+self.shape[1], 
+                               i:i+self.shape[0]]
+        
+        x_axis, y_axis, z_axis = self.axes
+        return separable_interp(input_array, [x_axis, y_axis, 
+                                              [a[k0:k1] for a in z_axis]],
+                                precision)
+
+class ResamplePlanCache:
+    """Least recently used cache of ResamplePlans keyed on their source and 
+    target geometry, holding at most max_bytes of indices and weights."""
+    
+    def __init__(self, max_bytes=PLAN_CACHE_BYTES):
+        
+        self.max_bytes = max_bytes
+        self.clear()
+    
+    def clear(self):
+        """Remove all of the plans and reset the hit and miss counters."""
+        
+        self.plans = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, input_shape, input_scale, input_offset, origin, scale, 
+            shape):
+        """Returns the ResamplePlan for the given geometry, reusing a cached 
+        plan if there is one."""
+        
+        key = (tuple(input_shape), 
+               tuple(float(v) for v in input_scale),
+               tuple(float(v) for v in input_offset),
+               tuple(float(v) for v in origin), 
+               tuple(float(v) for v in scale), 
+               tuple(shape))
+        plan = self.plans.get(key)
+        if plan is not None:
+            self.hits += 1
+            self.plans.move_to_end(key)
+            return plan
+        
+        self.misses += 1
+        plan = ResamplePlan(input_shape, input_scale, input_offset, origin,
+                            scale, shape)
+        self.plans[key] = plan
+        self.nbytes += plan.nbytes
+        
+        #Evict the least recently used plans, but always keep the new one
+        while self.nbytes > self.max_bytes and len(self.plans) > 1:
+            key, evicted = self.plans.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        
+        return plan
+
+#Plans shared by every resampling caller in this process
+resample_plans = ResamplePlanCache()
+
+def lattice_offset(input_shape, input_scale, input_offset, origin, scale, 
+                   shape, tolerance=LATTICE_TOLERANCE):
+    """Returns the xyz index of the grid origin in a zyx input array if the 
+    grid points all lie on voxels of the input, otherwise None"""
+    """The grids are aligned if their pixel spacings match and their origins
+    differ by a whole number of voxels, to within tolerance of a voxel."""
+    
+    input_scale = np.asarray(input_scale, float)
+    if np.any(abs(np.asarray(scale) - input_scale) > tolerance*input_scale):
+        return None
+    indices = (np.asarray(origin) - 
+               np.array([float(v) for v in input_offset]))/input_scale
+    offset = np.round(indices).astype(np.intp)
+    if np.any(abs(indices - offset) > tolerance):
+        return None
+    
+    #The grid must also lie entirely inside the input
+    if (np.any(offset < 0) or 
+        np.any(offset + np.asarray(shape) > np.asarray(input_shape[::-1]))):
+        return None
+    
+    return offset
+
+class DeformationField:
+    """A displacement vector field on an axis-aligned grid"""
+    """The vector at each point of the reference anatomy is the xyz 
+    displacement, in mm, to the corresponding point of the source anatomy, 
+    so a source dose is pulled onto the reference grid by sampling it at the
+    displaced points.  The optional 4 x 4 pre and post deformation matrices
+    are applied before and after the displacement."""
+    
+    def __init__(self, vectors, origin, spacing, pre_matrix=None, 
+                 post_matrix=None):
+        """vectors is a (z, y, x, 3) array on the grid with the given xyz 
+        origin and spacing."""
+        
+        self.vectors = vectors
+        self.origin = np.array([float(v) for v in origin])
+        self.spacing = np.array([float(v) for v in spacing])
+        self.pre_matrix = pre_matrix
+        self.post_matrix = post_matrix
+    
+    @classmethod
+    def from_dicom(cls, ds, source_uid=None):
+        """Returns the field of a Deformable Spatial Registration object, 
+        for the given source Frame of Reference UID or the first one with a
+        deformation grid"""
+        
+        for item in ds.get('DeformableRegistrationSequence', []):
+            if 'DeformableRegistrationGridSequence' not in item:
+                continue
+            if source_uid is not None and \
+               item.SourceFrameOfReferenceUID != source_uid:
+                continue
+            grid = item.DeformableRegistrationGridSequence[0]
+            if not np.allclose([float(v) for v in 
+                                grid.ImageOrientationPatient],
+                               IDENTITY_ORIENTATION):
+                raise ValueError("Only axis-aligned deformation grids are "
+                                 "supported")
+            columns, rows, frames = grid.GridDimensions
+            vectors = np.frombuffer(grid.VectorGridData, '<f4').reshape(
+                                            frames, rows, columns, 3)
+            matrices = []
+            for name in ('PreDeformationMatrixRegistrationSequence',
+                         'PostDeformationMatrixRegistrationSequence'):
+                matrix = None
+                if name in item:
+                    matrix = np.array([float(v) for v in item.get(name)[0].
+                        FrameOfReferenceTransformationMatrix]).reshape(4, 4)
+                matrices.append(matrix)
+            return cls(vectors, grid.ImagePositionPatient, 
+                       grid.GridResolution, *matrices)
+        
+        raise ValueError("No deformation grid found in the registration")
+    
+    def transform(self, xyz_coords):
+        """Returns the source anatomy points of the reference xyz 
+        coordinates, a 3 x i x j x k array as given by grid_coords"""
+        
+        coords = apply_matrix(self.pre_matrix, xyz_coords)
+        #Points beyond the deformation grid take the nearest edge vector
+        upper = self.origin + (np.array(self.vectors.shape[2::-1]) - 1)*\
+                self.spacing
+        clipped = np.empty(coords.shape)
+        for axis in range(3):
+            np.clip(coords[axis], self.origin[axis], upper[axis], 
+                    out=clipped[axis])
+        displaced = np.empty(coords.shape)
+        for axis in range(3):
+            #The (z, y, x) vector components are transposed to xyz views
+            displaced[axis] = coords[axis] + interpolate_image(
+                self.vectors[..., axis].T, self.spacing, self.origin, 
+                clipped, None)
+        
+        return apply_matrix(self.post_matrix, displaced)
+
+def apply_matrix(matrix, xyz_coords):
+    """Applies a 4 x 4 homogeneous transformation matrix, if given, to a 
+    3 x i x j x k array of xyz coordinates"""
+    
+    if matrix is None:
+        return xyz_coords
+    points = xyz_coords.reshape(3, -1)
+    return (np.dot(matrix[:3, :3], points) + 
+            matrix[:3, 3:]).reshape(xyz_coords.shape)
+
+def warp_array(input_array, input_scale, input_offset, dvf, origin, scale, 
+               shape, k0, k1, precision=np.float64):
+    """Pulls a zyx input_array, with the given xyz pixel spacing and origin,
+    through a DeformationField onto frames k0 to k1 of the reference grid 
+    with the given xyz origin, scale and shape.  Returns a zyx array."""
+    """If dvf is None the input is sampled at the grid points themselves, 
+    for a dose that is already in the reference anatomy but does not cover
+    the reference grid."""
+    
+    xyz_coords = grid_coords(origin, scale, shape, k0, k1)
+    if dvf is not None:
+        xyz_coords = dvf.transform(xyz_coords)
+    input_offset = np.array([float(v) for v in input_offset])
+    input_scale = np.asarray(input_scale, float)
+    upper = input_offset + (np.array(input_array.shape[::-1]) - 1)*\
+            input_scale
+    tolerance = LATTICE_TOLERANCE*input_scale
+    
+    #Points pulled from outside the source grid receive no dose
+    inside = np.ones(xyz_coords.shape[1:], bool)
+    for axis in range(3):
+        inside &= (xyz_coords[axis] >= input_offset[axis] - tolerance[axis])
+        inside &= (xyz_coords[axis] <= upper[axis] + tolerance[axis])
+        np.clip(xyz_coords[axis], input_offset[axis], upper[axis], 
+                out=xyz_coords[axis])
+    
+    output = interpolate_image(np.swapaxes(input_array, 0, 2),
+                input_scale, input_offset, xyz_coords, None)
+    output[~inside] = 0
+    
+    return np.asarray(np.swapaxes(output, 0, 2), precision)
+
+def grid_inside(input_shape, input_scale, input_offset, origin, scale, 
+                shape, tolerance=LATTICE_TOLERANCE):
+    """Returns True if every point of the grid with the given xyz origin, 
+    scale and shape lies inside a zyx input array, to within tolerance of a
+    voxel"""
+    
+    input_offset = np.array([float(v) for v in input_offset])
+    input_scale = np.asarray(input_scale, float)
+    upper = input_offset + (np.array(input_shape[::-1]) - 1)*input_scale
+    low = np.asarray(origin, float)
+    high = low + (np.asarray(shape) - 1)*np.asarray(scale, float)
+    
+    return bool(np.all(low >= input_offset - tolerance*input_scale) and 
+                np.all(high <= upper + tolerance*input_scale))
+
+def sum_slab(sources, origin, scale, shape, k0, k1, sum_scaling,
+             interp_method='separable', precision=np.float64, dvfs=None,
+             biological=None):
+    """Returns frames k0 to k1 of the sum of the sources on the grid with 
+    the given xyz origin, scale and shape, in units of sum_scaling"""
+    """sources is a list of (zyx pixel array, xyz pixel spacing, xyz origin,
+    weighted DoseGridScaling) tuples.  dvfs is an optional list of 
+    DeformationField objects, or None, that the sources are pulled through.
+    biological is an optional BiologicalDose that the sources are converted
+    with before they are summed.  Serial and parallel sums both use this 
+    function, so they give bit-identical results."""
+    
+    if dvfs is None:
+        dvfs = [None]*len(sources)
+    if biological is not None:
+        alpha_beta = biological.slab_alpha_beta(k0, k1, precision)
+    slab = np.zeros((k1 - k0, shape[1], shape[0]), precision)
+    for index, ((input_array, input_scale, input_offset, scaling), dvf) in \
+        enumerate(zip(sources, dvfs)):
+        #In a deformable sum the grid is that of the reference dose, so a 
+        #dose without a field may not cover it.  It is masked like a warped
+        #dose, the points outside of it receiving no dose.
+        if dvf is not None or not grid_inside(input_array.shape, 
+                input_scale, input_offset, origin, scale, shape):
+            resampled = warp_array(input_array, input_scale, input_offset, 
+                            dvf, origin, scale, shape, k0, k1, precision)
+        else:
+            resampled = resample_array(input_array, input_scale, 
+                            input_offset, origin, scale, shape, k0, k1, 
+                            interp_method, precision=precision)
+        dose = np.asarray(resampled, precision)*precision(scaling)
+        if biological is not None:
+            dose = biological.bed(dose, index, alpha_beta)
+        slab += dose
+    
+    if biological is not None:
+        slab = biological.convert(slab, alpha_beta)
+    return np.uint32(slab/sum_scaling)
+
+class BiologicalDose:
+    """Voxel-wise conversion of the courses of a sum to BED or EQD2"""
+    """A course of physical dose D delivered in n fractions has a 
+    biologically effective dose BED = D*(1 + D/(n*a/b)), and an equivalent
+    dose in 2 Gy fractions EQD2 = BED/(1 + 2/(a/b)), where a/b is the 
+    alpha/beta ratio of the tissue.  The BED of the courses is summed and 
+    then converted to the requested quantity."""
+    
+    def __init__(self, fractions, alpha_beta=3., quantity='EQD2', 
+                 labels=None, label_alpha_beta=None, 
+                 reference_fractions=None):
+        """Parameters:
+            fractions: a list of the number of fractions of each course, 
+                one per dose.
+            
+            alpha_beta: The alpha/beta ratio, in Gy, of unlabelled voxels.
+            
+            quantity: A string that is one of ['BED','EQD2'].
+            
+            labels: An optional zyx integer label map on the summed grid,
+                such as a rasterized structure set.
+            
+            label_alpha_beta: A dict of the alpha/beta ratio of each label.
+                Label 0 and labels without a ratio use alpha_beta.
+            
+            reference_fractions: If given, the summed BED is converted back
+                to the physical dose that gives the same BED in this many 
+                fractions, instead of to quantity."""
+        
+        if quantity not in ('BED', 'EQD2'):
+            raise ValueError("Unknown biological quantity: %s" % quantity)
+        
+        self.fractions = [float(n) for n in fractions]
+        self.alpha_beta = float(alpha_beta)
+        self.quantity = quantity
+        self.labels = labels
+        self.label_alpha_beta = dict(label_alpha_beta or {})
+        self.reference_fractions = reference_fractions
+        self.lookup = None
+        if labels is not None:
+            size = max([int(np.max(labels))] + list(self.label_alpha_beta))
+            self.lookup = np.full(size + 1, self.alpha_beta)
+            for label, value in self.label_alpha_beta.items():
+                self.lookup[label] = value
+    
+    def decimated(self, decimation):
+        """Returns the conversion for a sum on a grid decimated by the given
+        factor"""
+        
+        labels = self.labels
+        if labels is not None:
+            labels = labels[::decimation, ::decimation, ::decimation]
+        return BiologicalDose(self.fractions, self.alpha_beta, 
+                              self.quantity, labels, self.label_alpha_beta,
+                              self.reference_fractions)
+    
+    def slab_alpha_beta(self, k0, k1, precision=np.float64):
+        """Returns the alpha/beta ratio of frames k0 to k1 of the summed 
+        grid, as a scalar or a zyx array"""
+        
+        if self.lookup is None:
+            return precision(self.alpha_beta)
+        return self.lookup.astype(precision)[self.labels[k0:k1]]
+    
+    def bed(self, dose, index, alpha_beta):
+        """Returns the BED of an array of physical dose, in Gy, of the 
+        course with the given index"""
+        
+        bed = dose*dose
+        bed /= alpha_beta*dose.dtype.type(self.fractions[index])
+        bed += dose
+        return bed
+    
+    def convert(self, bed, alpha_beta):
+        """Converts an array of summed BED to the requested quantity"""
+        
+        if self.reference_fractions:
+            #Positive root of D + D**2/(n*a/b) = BED
+            nab = alpha_beta*bed.dtype.type(self.reference_fractions)
+            return nab/2*(np.sqrt(1 + 4*bed/nab) - 1)
+        if self.quantity == 'EQD2':
+            return bed*alpha_beta/(alpha_beta + 2)
+        return bed
+    
+    def upper_bound(self, peaks):
+        """Returns an upper bound of the converted sum, given the peak 
+        weighted physical dose of each course"""
+        
+        if self.lookup is None:
+            low = high = self.alpha_beta
+        else:
+            values = self.lookup[np.unique(self.labels)]
+            low, high = values.min(), values.max()
+        #The BED of a course is largest for the smallest alpha/beta
+        bound = sum(peak + peak*peak/(n*low) 
+                    for peak, n in zip(peaks, self.fractions))
+        if self.reference_fractions:
+            #The physical dose is never more than its BED
+            return bound
+        if self.quantity == 'EQD2':
+            return bound*high/(high + 2)
+        return bound
+    
+    def description(self):
+        """Returns a short description for the DoseComment of the sum"""
+        
+        if self.reference_fractions:
+            quantity = 'Physical in %g fx' % self.reference_fractions
+        else:
+            quantity = self.quantity
+        if self.lookup is None:
+            return '%s sum, a/b %g Gy' % (quantity, self.alpha_beta)
+        return '%s sum, a/b %g Gy and per structure' % (quantity, 
+                                                        self.alpha_beta)
+
+def iter_parallel_slabs(sources, origin, scale, shape, sum_scaling, 
+                        slab_frames, interp_method='separable', workers=None,
+                        precision=np.float64, cancel=None, progress=None,
+                        biological=None):
+    """Yields the start frame, stop frame and uint32 summed pixels of each 
+    slab of the sum of the sources computed by sum_slab, with the slabs 
+    resampled in a pool of worker processes"""
+    """The source pixel arrays are placed in shared memory so that they are
+    not pickled to every worker.  The slabs are yielded as they are 
+    finished, and at most two slabs per worker are queued, so the summed 
+    volume is never held in memory.  workers is the number of processes in
+    the pool, or 0 for one per CPU.  See DoseSum.iter_slabs for the cancel 
+    and progress arguments; slabs that have not started are cancelled as 
+    soon as the cancel event is seen."""
+    
+    workers = workers or os.cpu_count() or 1
+    blocks = []
+    try:
+        specs = []
+        for input_array, input_scale, input_offset, scaling in sources:
+            block = shared_memory.SharedMemory(create=True, 
+                                               size=input_array.nbytes)
+            blocks.append(block)
+            shared = np.ndarray(input_array.shape, input_array.dtype, 
+                                buffer=block.buf)
+            shared[:] = input_array
+            specs.append((block.name, input_array.shape, input_array.dtype,
+                          tuple(input_scale), tuple(input_offset), scaling))
+        
+        waiting = iter(slabs(shape[2], slab_frames))
+        with futures.ProcessPoolExecutor(max_workers=workers, 
+                initializer=_init_sum_worker, 
+                initargs=(specs, tuple(origin), tuple(scale), shape,
+                          sum_scaling, interp_method, precision, 
+                          biological)) as pool:
+            jobs = {}
+            try:
+                summed = 0
+                while True:
+                    for frames in waiting:
+                        jobs[pool.submit(_sum_worker_slab, frames)] = frames
+                        if len(jobs) >= 2*workers:
+                            break
+                    if not jobs:
+                        break
+                    done = futures.wait(jobs, 
+                               return_when=futures.FIRST_COMPLETED)[0]
+                    for job in done:
+                        k0, k1 = jobs.pop(job)
+                        slab = job.result()
+                        check_cancelled(cancel)
+                        summed += k1 - k0
+                        if progress:
+                            progress(summed, shape[2])
+                        yield k0, k1, slab
+            finally:
+                #Cancelled, failed or abandoned by the caller
+                for pending in jobs:
+                    pending.cancel()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+#Shared memory blocks and grid of the sum handled by a worker process
+_sum_worker = {}
+
+def _init_sum_worker(specs, origin, scale, shape, sum_scaling,
+                     interp_method, precision, biological):
+    """Attach a worker process to the shared memory of a parallel sum"""
+    
+    blocks = []
+    sources = []
+    for name, array_shape, dtype, input_scale, input_offset, scaling in specs:
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        sources.append((np.ndarray(array_shape, dtype, buffer=block.buf),
+                        np.array(input_scale), input_offset, scaling))
+    
+    _sum_worker['blocks'] = blocks
+    _sum_worker['sources'] = sources
+    _sum_worker['grid'] = (origin, scale, shape, sum_scaling, interp_method,
+                           precision, biological)
+
+def _sum_worker_slab(frames):
+    """Returns one summed slab of frames of a parallel sum"""
+    
+    k0, k1 = frames
+    origin, scale, shape, sum_scaling, interp_method, precision, \
+        biological = _sum_worker['grid']
+    return sum_slab(_sum_worker['sources'], origin, scale, shape, k0, k1, 
+                    sum_scaling, interp_method, precision, 
+                    biological=biological)
+
+def axis_interp(size, scale, offset, coords):
+    """Returns the lower indices, upper indices and upper weights that 
+    linearly interpolate an axis of length size, with the given pixel 
+    spacing and origin, at the 1D coordinates given"""
+    
+    indices = (coords - offset)/scale
+    i0 = indices.astype(np.intp)
+    i1 = i0 + 1
+    
+    #Check if i1 is beyond array boundary:
+    i1[i1 == size] = size - 1
+    
+    return i0, i1, indices - i0
+
+def separable_interp(input_array, axes, precision=np.float64):
+    """Evaluate the zyx input_array data on an axis-aligned grid"""
+    """axes holds the (lower indices, upper indices, upper weights) returned 
+    by axis_interp for the x, y and z axes.  The grid is interpolated with 
+    three successive 1D passes, z first so that only the frames of the slab 
+    are carried through the x and y passes.  Gives the same result as 
+    trilinear_interp at every point of the grid.  The passes are computed 
+    in the given floating point precision."""
+    
+    (x0, x1, x), (y0, y1, y), (z0, z1, z) = axes
+    x = x.astype(precision)
+    y = y.astype(precision)[:, np.newaxis]
+    z = z.astype(precision)[:, np.newaxis, np.newaxis]
+    
+    output = (input_array[z0].astype(precision)*(1-z) + 
+              input_array[z1].astype(precision)*z)
+    output = output[:, y0]*(1-y) + output[:, y1]*y
+    output = output[:, :, x0]*(1-x) + output[:, :, x1]*x
+    
+    return output
+
 def interpolate_image(input_array, scale, offset, xyz_coords, progressFunc):
     """Interpolates an array at the xyz coordinates given"""
     """Parameters:
@@ -254,7 +1531,6 @@ def interpolate_image(input_array, scale, offset, xyz_coords, progressFunc):
     indices[1] = (xyz_coords[1] - offset[1])/scale[1]
     indices[2] = (xyz_coords[2] - offset[2])/scale[2]
     
-    print("PlanSum: Using trilinear_interp")
     return trilinear_interp(input_array, indices, progressFunc)
 
 
@@ -266,9 +1542,9 @@ def trilinear_interp(input_array, indices, progressFunc=None):
     y_indices = indices[1]
     z_indices = indices[2]
     
-    x0 = x_indices.astype(np.integer)
-    y0 = y_indices.astype(np.integer)
-    z0 = z_indices.astype(np.integer)
+    x0 = x_indices.astype(np.intp)
+    y0 = y_indices.astype(np.intp)
+    z0 = z_indices.astype(np.intp)
     x1 = x0 + 1
     y1 = y0 + 1
     z1 = z0 + 1
@@ -294,6 +1570,54 @@ def trilinear_interp(input_array, indices, progressFunc=None):
 
 
 
+def make_test_dose(dose, origin, spacing, scaling=1e-4):
+    """Returns an RTDose object holding a (z, y, x) array of dose in Gy"""
+    """Used to build synthetic dose grids for testing.  The dose is stored 
+    as uint32 pixels with the given DoseGridScaling, on a grid whose first 
+    voxel is at origin and whose xyz voxel spacing is given by spacing."""
+    
+    file_meta = pydicom.dataset.FileMetaDataset()
+    file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.2'
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    ds = pydicom.dataset.FileDataset('', {}, file_meta=file_meta,
+                                     preamble=b"\0"*128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'RTDOSE'
+    ds.ImagePositionPatient = [float(x) for x in origin]
+    ds.PixelSpacing = [float(spacing[0]), float(spacing[1])]
+    ds.GridFrameOffsetVector = [float(z) for z in 
+                                np.arange(dose.shape[0])*spacing[2]]
+    ds.NumberOfFrames = dose.shape[0]
+    ds.Rows = dose.shape[1]
+    ds.Columns = dose.shape[2]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 32
+    ds.BitsStored = 32
+    ds.HighBit = 31
+    ds.PixelRepresentation = 0
+    ds.DoseUnits = 'GY'
+    ds.DoseGridScaling = scaling
+    ds.PixelData = np.uint32(np.round(dose/scaling)).tobytes()
+    
+    return ds
+
+def peak_memory(func, *args, **kwargs):
+    """Calls func and returns its result and the peak memory, in bytes, 
+    allocated while it ran"""
+    
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    
+    return result, peak
+
+
 class PlanSumTest(unittest.TestCase):
     
     def testPlanSum(self):
@@ -318,6 +1642,34 @@ class PlanSumTest(unittest.TestCase):
         self.assertTrue(difference < delta,
                 "difference: %s is not less than %s" % (difference, delta))
         
+    def testFloat32Precision(self):
+        z, y, x = np.mgrid[0:30, 0:40, 0:35]
+        doses = [make_test_dose(2. + np.sin(x/7.) + np.cos(y/9.) + z/20., 
+                                [-70., -100., -30.], [4., 5., 2.]),
+                 make_test_dose(1. + np.cos(x/5.) * np.sin(z/11.) + y/30., 
+                                [-68., -97., -27.], [3., 3., 3.])]
+        directory = tempfile.mkdtemp()
+        filenames = []
+        for n, rtd in enumerate(doses):
+            filenames.append(os.path.join(directory, 'rtdose%d.dcm' % n))
+            rtd.save_as(filenames[-1], write_like_original=False)
+        
+        sums = []
+        for precision in (np.float64, np.float32):
+            rtd1, rtd2 = [pydicom.dcmread(filename) for filename in filenames]
+            sums.append(SumPlan(rtd1, rtd2, None, precision=precision))
+        for filename in filenames:
+            os.remove(filename)
+        
+        #float32 resampling must stay within one quantization step of the 
+        #float64 sum, DoseGridScaling Gy, here 0.2 mGy.  rtol only absorbs 
+        #the rounding of the conversion of the pixels to Gy.
+        doses = [sum.pixel_array*sum.DoseGridScaling for sum in sums]
+        atol = sums[0].DoseGridScaling
+        self.assertAlmostEqual(sums[1].DoseGridScaling, atol)
+        self.assertAlmostEqual(atol, 2e-4)
+        npt.assert_allclose(doses[1], doses[0], rtol=1e-12, atol=atol)
+        
 #    def testInterpolation(self):
 #        
 #        rtd = dicom.read_file('./testdata/rtdose1.dcm')
@@ -331,6 +1683,415 @@ class PlanSumTest(unittest.TestCase):
 #        npt.assert_equal(a.pixel_array,d.pixel_array)
         
                      
+class StreamingSumTest(unittest.TestCase):
+    
+    def makeDoses(self):
+        z, y, x = np.mgrid[0:40, 0:60, 0:50]
+        dose1 = 2. + np.sin(x/7.) + np.cos(y/9.) + z/20.
+        dose2 = 1. + np.cos(x/5.) * np.sin(z/11.) + y/30.
+        rtd1 = make_test_dose(dose1, [-100., -150., -40.], [4., 5., 2.])
+        rtd2 = make_test_dose(dose2, [-98., -147., -37.], [3., 3., 3.])
+        return rtd1, rtd2
+    
+    def testSlabsMatchWholeVolume(self):
+        whole, whole_peak = peak_memory(SumPlan, *self.makeDoses(), q=None,
+                                        slab_frames=None)
+        streamed, slab_peak = peak_memory(SumPlan, *self.makeDoses(), q=None,
+                                          slab_frames=2)
+        
+        print("\nPlanSum peak memory: whole volume %.1f MB, 2 frame slabs "
+              "%.1f MB, peak RSS %.1f MB" % (whole_peak/1e6, slab_peak/1e6,
+              (peak_rss() or 0)/1e6))
+        npt.assert_array_equal(streamed.pixel_array, whole.pixel_array)
+        self.assertEqual(streamed.GridFrameOffsetVector, 
+                         whole.GridFrameOffsetVector)
+        self.assertLess(slab_peak, whole_peak)
+        
+    def testSeparableMatchesTrilinear(self):
+        rtd1, rtd2 = self.makeDoses()
+        sum_ip, scale_sum, sum_shape = sum_grid([rtd1, rtd2])
+        for rtd in (rtd1, rtd2):
+            separable = resample_dose(rtd, sum_ip, scale_sum, sum_shape, 
+                                      0, sum_shape[2], 'separable')
+            trilinear = resample_dose(rtd, sum_ip, scale_sum, sum_shape, 
+                                      0, sum_shape[2], 'trilinear')
+            npt.assert_allclose(separable, trilinear, rtol=1e-9)
+        
+        separable = SumPlan(*self.makeDoses(), q=None)
+        trilinear = SumPlan(*self.makeDoses(), q=None, 
+                            interp_method='trilinear')
+        npt.assert_allclose(np.int64(separable.pixel_array), 
+                            trilinear.pixel_array, atol=1)
+        
+    def testSumPlans(self):
+        z, y, x = np.mgrid[0:30, 0:40, 0:35]
+        doses = [2. + np.sin(x/7.), 1. + np.cos(y/9.), 0.5 + z/20.]
+        origins = [[-70., -80., -30.], [-68., -79., -29.], [-71., -82., -31.]]
+        spacings = [[4., 4., 2.], [3., 3., 3.], [4., 5., 2.]]
+        weights = [1., 2., 0.5]
+        rtds = [make_test_dose(*args) for args in zip(doses, origins, spacings)]
+        
+        sum = SumPlans(rtds, weights=weights)
+        sum_ip, scale_sum, sum_shape = sum_grid(
+            [make_test_dose(*args) for args in zip(doses, origins, spacings)])
+        expected = np.zeros(sum_shape[::-1])
+        for args, weight in zip(zip(doses, origins, spacings), weights):
+            expected += weight*resample_dose(make_test_dose(*args), sum_ip, 
+                            scale_sum, sum_shape, 0, sum_shape[2])*1e-4
+        
+        self.assertEqual(sum.pixel_array.shape, sum_shape[::-1])
+        npt.assert_allclose(sum.pixel_array*sum.DoseGridScaling, expected,
+                            atol=sum.DoseGridScaling)
+        self.assertAlmostEqual(sum.DoseGridScaling, 3.5e-4)
+        self.assertRaises(ValueError, SumPlans, rtds, weights=[1., 2.])
+        
+    def testInvalidWeights(self):
+        z, y, x = np.mgrid[0:6, 0:8, 0:7]
+        rtds = [make_test_dose(1. + x/7., [0., 0., 0.], [2., 2., 2.]),
+                make_test_dose(1. + y/8., [1., 1., 1.], [3., 3., 3.])]
+        
+        for weights in ([1., -0.5], [1., np.nan], [np.inf, 1.], [0., 0.]):
+            self.assertRaises(ValueError, SumPlans, rtds, weights=weights)
+            self.assertRaises(ValueError, DoseSum, rtds, weights)
+        #A zero weight is allowed while the total is positive
+        sum = SumPlans(rtds, weights=[0., 1.])
+        self.assertGreater(sum.DoseGridScaling, 0)
+        
+    def testLatticeAlignedSum(self):
+        z, y, x = np.mgrid[0:20, 0:30, 0:25]
+        dose1 = 2. + np.sin(x/7.) + np.cos(y/9.) + z/20.
+        dose2 = 1. + np.cos(x/5.) * np.sin(z/11.) + y/30.
+        rtd1 = make_test_dose(dose1, [-50., -60., -20.], [2., 3., 2.5])
+        #Shifted by (3, 2, 4) voxels, with float noise in the origin
+        rtd2 = make_test_dose(dose2[:16, :24, :20], 
+                              [-44. + 1e-6, -54., -10. - 1e-6], [2., 3., 2.5])
+        
+        sum_ip, scale_sum, sum_shape = sum_grid([rtd1, rtd2])
+        npt.assert_array_equal(lattice_offset(rtd1.pixel_array.shape,
+                                   dose_scale(rtd1), rtd1.ImagePositionPatient,
+                                   sum_ip, scale_sum, sum_shape), [3, 2, 4])
+        self.assertEqual(sum_shape, (20, 24, 16))
+        
+        expected = (rtd1.pixel_array[4:, 2:26, 3:23]*1e-4 + 
+                    rtd2.pixel_array*1e-4)/2e-4
+        sum = SumPlan(rtd1, rtd2, None)
+        npt.assert_array_equal(sum.pixel_array, np.uint32(expected))
+        
+    def testResamplePlanCache(self):
+        z, y, x = np.mgrid[0:12, 0:20, 0:16]
+        rtds = [make_test_dose(1. + np.sin(x/(3.+n)) + z/10., 
+                               [-30., -40., -10.], [2., 2., 2.])
+                for n in range(3)]
+        rtds.append(make_test_dose(np.ones((8, 10, 10)), 
+                                   [-27., -33., -7.], [3., 3., 3.]))
+        
+        resample_plans.clear()
+        SumPlans(rtds, slab_frames=2)
+        #One plan for the three doses sharing a geometry, one for the fourth
+        self.assertEqual(resample_plans.misses, 2)
+        self.assertEqual(resample_plans.hits, 4*4 - 2)
+        
+        cache = ResamplePlanCache(max_bytes=0)
+        for n in range(3):
+            cache.get((5, 5, 5), (1., 1., 1.), (0., 0., 0.), 
+                      (0.5 + n, 0.5, 0.5), (1., 1., 1.), (3, 3, 3))
+        self.assertEqual(len(cache.plans), 1)
+        self.assertEqual(cache.misses, 3)
+        
+    def testWriteRTDose(self):
+        expected = SumPlan(*self.makeDoses(), q=None)
+        
+        dose_sum = DoseSum(self.makeDoses(), slab_frames=3)
+        filename = os.path.join(tempfile.mkdtemp(), 'sum.dcm')
+        write_rtdose(dose_sum.header(), filename, dose_sum.iter_slabs())
+        written = pydicom.dcmread(filename)
+        os.remove(filename)
+        
+        npt.assert_array_equal(written.pixel_array, expected.pixel_array)
+        self.assertAlmostEqual(written.DoseGridScaling, 
+                               expected.DoseGridScaling)
+        self.assertEqual(written.DoseSummationType, 'MULTI_PLAN')
+        
+        #A copied header is a new object, and the last dose is unchanged
+        doses = self.makeDoses()
+        uid = doses[-1].SOPInstanceUID
+        header = DoseSum(doses).header(recycle=False)
+        self.assertNotIn(header.SOPInstanceUID, 
+                         [ds.SOPInstanceUID for ds in doses])
+        self.assertEqual(header.file_meta.MediaStorageSOPInstanceUID, 
+                         header.SOPInstanceUID)
+        self.assertEqual(doses[-1].SOPInstanceUID, uid)
+        self.assertEqual(doses[-1].file_meta.MediaStorageSOPInstanceUID, uid)
+        self.assertNotIn('DoseSummationType', doses[-1])
+        
+    def testReadRTDose(self):
+        directory = tempfile.mkdtemp()
+        filenames = []
+        for n, rtd in enumerate(self.makeDoses()):
+            filenames.append(os.path.join(directory, 'rtdose%d.dcm' % n))
+            if n:
+                rtd.file_meta.TransferSyntaxUID = \
+                    pydicom.uid.ExplicitVRLittleEndian
+            rtd.save_as(filenames[-1], write_like_original=False)
+        
+        for filename in filenames:
+            mapped = read_rtdose(filename)
+            self.assertIsInstance(pixel_volume(mapped), np.memmap)
+            self.assertNotIn('PixelData', mapped)
+            npt.assert_array_equal(pixel_volume(mapped),
+                                   pydicom.dcmread(filename).pixel_array)
+        
+        expected = SumPlan(*self.makeDoses(), q=None)
+        sum = SumPlans([read_rtdose(filename) for filename in filenames])
+        npt.assert_array_equal(sum.pixel_array, expected.pixel_array)
+        
+        for filename in filenames:
+            os.remove(filename)
+        
+    def testProgressAndCancel(self):
+        calls = []
+        progressFunc = lambda num, length, message: calls.append(
+                                                    (num, length, message))
+        rtd1, rtd2 = self.makeDoses()
+        sum = SumPlans([rtd1, rtd2], progressFunc=progressFunc, 
+                       slab_frames=5)
+        frames = sum.NumberOfFrames
+        slab_calls = [call for call in calls if call[1] == frames + 1]
+        self.assertEqual([call[0] for call in slab_calls], 
+                         list(range(5, frames, 5)) + [frames])
+        self.assertIn('voxels/s', slab_calls[0][2])
+        self.assertEqual(calls[-1], (1, 1, 'Done'))
+        
+        cancel = threading.Event()
+        cancel.set()
+        rtd1, rtd2 = self.makeDoses()
+        rows = rtd2.Rows
+        self.assertIsNone(SumPlans([rtd1, rtd2], cancel=cancel))
+        self.assertEqual(rtd2.Rows, rows)
+        q = queue.Queue()
+        SumPlan(rtd1, rtd2, q, cancel=cancel, workers=2)
+        self.assertIsNone(q.get())
+        
+    def testDeformableSum(self):
+        #Linear doses and fields are interpolated exactly
+        f = lambda x, y, z: 1. + 0.05*x + 0.02*y + 0.03*z
+        source = f(*(np.mgrid[0:20, 0:20, 0:20][::-1]*2.5 - 10.))
+        source_dose = lambda: make_test_dose(source, [-10., -10., -10.],
+                                             [2.5, 2.5, 2.5])
+        
+        z, y, x = np.mgrid[0:6, 0:7, 0:8]*5. - 5.
+        vectors = np.float32(np.stack([0.1*x + 1., -2. + 0*y, 0.05*z], -1))
+        dvf = DeformationField(vectors, [-5., -5., -5.], [5., 5., 5.])
+        
+        z, y, x = np.mgrid[0:10, 0:12, 0:15]*2.
+        expected = f(1.1*x + 1., y - 2., 1.05*z)
+        reference = make_test_dose(0*z, [0., 0., 0.], [2., 2., 2.])
+        sum = SumPlans([reference, source_dose()], dvfs=[None, dvf], 
+                       slab_frames=3)
+        self.assertEqual(sum.pixel_array.shape, expected.shape)
+        npt.assert_allclose(sum.pixel_array*sum.DoseGridScaling, expected, 
+                            atol=sum.DoseGridScaling)
+        
+        #Points pulled from outside the source grid receive no dose
+        #The summed object is the recycled source, so it is made again
+        dvf.vectors = vectors + np.float32([30., 0., 0.])
+        reference = make_test_dose(0*z, [0., 0., 0.], [2., 2., 2.])
+        sum = SumPlans([reference, source_dose()], dvfs=[None, dvf], 
+                       slab_frames=None)
+        dose = sum.pixel_array*sum.DoseGridScaling
+        outside = 1.1*x + 31. > 37.5 + 1e-6
+        npt.assert_array_equal(dose[outside], 0)
+        self.assertTrue(np.all(dose[~outside] > 0))
+        
+    def testDeformableSumPartialCover(self):
+        #A dose without a field that covers only part of the reference grid
+        #adds dose only where it covers it, on either side
+        z, y, x = np.mgrid[0:10, 0:12, 0:15]*2.
+        reference = make_test_dose(1. + 0*z, [0., 0., 0.], [2., 2., 2.])
+        small = make_test_dose(2. + 0*z[:4, :5, :6], [9., 7., 5.], 
+                               [2., 2., 2.])
+        source = make_test_dose(0.5 + 0*z, [0., 0., 0.], [2., 2., 2.])
+        vectors = np.zeros((2, 2, 2, 3), np.float32)
+        dvf = DeformationField(vectors, [-50., -50., -50.], [200., 200., 200.])
+        
+        sum = SumPlans([reference, small, source], dvfs=[None, None, dvf],
+                       slab_frames=3)
+        dose = sum.pixel_array*sum.DoseGridScaling
+        inside = ((x >= 9.) & (x <= 19.) & (y >= 7.) & (y <= 15.) & 
+                  (z >= 5.) & (z <= 11.))
+        self.assertEqual(dose.shape, z.shape)
+        npt.assert_allclose(dose[inside], 3.5, atol=sum.DoseGridScaling)
+        npt.assert_allclose(dose[~inside], 1.5, atol=sum.DoseGridScaling)
+        
+        self.assertTrue(grid_inside((4, 5, 6), [2., 2., 2.], [9., 7., 5.],
+                                    [9., 7., 5.], [2., 2., 2.], (6, 5, 4)))
+        self.assertFalse(grid_inside((4, 5, 6), [2., 2., 2.], [9., 7., 5.],
+                                     [0., 0., 0.], [2., 2., 2.], (15, 12, 10)))
+        
+    def testReadDVF(self):
+        z, y, x = np.mgrid[0:3, 0:4, 0:5]
+        vectors = np.float32(np.stack([x, y*2., z*3.], -1))
+        matrix = np.eye(4)
+        matrix[:3, 3] = [1., 2., 3.]
+        
+        grid = pydicom.dataset.Dataset()
+        grid.ImagePositionPatient = [-1., -2., -3.]
+        grid.ImageOrientationPatient = IDENTITY_ORIENTATION
+        grid.GridDimensions = [5, 4, 3]
+        grid.GridResolution = [2., 3., 4.]
+        grid.VectorGridData = vectors.tobytes()
+        post = pydicom.dataset.Dataset()
+        post.FrameOfReferenceTransformationMatrix = list(matrix.ravel())
+        item = pydicom.dataset.Dataset()
+        item.SourceFrameOfReferenceUID = '1.2.3'
+        item.DeformableRegistrationGridSequence = [grid]
+        item.PostDeformationMatrixRegistrationSequence = [post]
+        reg = pydicom.dataset.Dataset()
+        reg.Modality = 'REG'
+        reg.DeformableRegistrationSequence = [pydicom.dataset.Dataset(), 
+                                              item]
+        
+        dvf = DeformationField.from_dicom(reg)
+        npt.assert_array_equal(dvf.vectors, vectors)
+        npt.assert_array_equal(dvf.origin, [-1., -2., -3.])
+        npt.assert_array_equal(dvf.spacing, [2., 3., 4.])
+        self.assertIsNone(dvf.pre_matrix)
+        point = np.array([1., 1., 5.]).reshape(3, 1, 1, 1)
+        npt.assert_allclose(dvf.transform(point).ravel(), 
+                            [1. + 1. + 1., 1. + 2. + 2., 5. + 6. + 3.])
+        self.assertRaises(ValueError, DeformationField.from_dicom, reg, 
+                          '4.5.6')
+        
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'dvf.npz')
+            np.savez(filename, vectors=vectors, origin=[-1., -2., -3.], 
+                     spacing=[2., 3., 4.])
+            npt.assert_allclose(read_dvf(filename).transform(point), 
+                                dvf.transform(point) - [[[[1.]]], [[[2.]]], 
+                                                        [[[3.]]]])
+            filename = os.path.join(folder, 'dvf.npy')
+            np.save(filename, vectors)
+            reference = make_test_dose(z*0., [-1., -2., -3.], [2., 3., 4.])
+            npt.assert_array_equal(read_dvf(filename, reference).vectors, 
+                                   vectors)
+            self.assertRaises(ValueError, read_dvf, filename)
+        finally:
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+            os.rmdir(folder)
+        
+    def testPreview(self):
+        previews = []
+        rtd1, rtd2 = self.makeDoses()
+        rows = rtd2.Rows
+        sum = SumPlans([rtd1, rtd2], previewFunc=lambda ds: previews.append(
+                       (ds, rtd2.Rows)), preview=2)
+        preview, preview_rows = previews[0]
+        self.assertEqual(len(previews), 1)
+        self.assertIsNot(preview, rtd2)
+        self.assertEqual(preview_rows, rows)
+        self.assertFalse(hasattr(preview, 'DVHSequence'))
+        npt.assert_allclose(preview.PixelSpacing, 
+                            np.array(sum.PixelSpacing)*2)
+        #The preview grid points are every other point of the full grid
+        npt.assert_array_equal(preview.pixel_array, 
+                               sum.pixel_array[::2, ::2, ::2])
+        
+    def testBiologicalSum(self):
+        z, y, x = np.mgrid[0:6, 0:8, 0:10]
+        dose1 = 20. + x + y*0.5
+        dose2 = 40. + z*2. + x*0.25
+        labels = np.uint8(x >= 5)
+        makeDoses = lambda: (make_test_dose(dose1, [0., 0., 0.], [2., 2., 2.]),
+                             make_test_dose(dose2, [0., 0., 0.], [2., 2., 2.]))
+        ab = np.where(labels, 10., 3.)
+        bed = dose1*(1 + dose1/(5*ab)) + dose2*(1 + dose2/(20*ab))
+        
+        biological = BiologicalDose([5, 20], 3., 'EQD2', labels, {1: 10.})
+        sum = SumPlans(list(makeDoses()), biological=biological)
+        npt.assert_allclose(sum.pixel_array*sum.DoseGridScaling, 
+                            bed*ab/(ab + 2), rtol=1e-6, 
+                            atol=sum.DoseGridScaling)
+        self.assertTrue(sum.DoseComment.startswith('EQD2'))
+        parallel = SumPlans(list(makeDoses()), biological=biological, 
+                            workers=2, slab_frames=2)
+        npt.assert_array_equal(parallel.pixel_array, sum.pixel_array)
+        
+        sum = SumPlans(list(makeDoses()), biological=BiologicalDose(
+                       [5, 20], 3., 'BED'))
+        bed = dose1*(1 + dose1/15.) + dose2*(1 + dose2/60.)
+        npt.assert_allclose(sum.pixel_array*sum.DoseGridScaling, bed, 
+                            rtol=1e-6, atol=sum.DoseGridScaling)
+        
+        #A course summed with no dose converts back to itself
+        rtd1, rtd2 = makeDoses()
+        sum = SumPlans([rtd1, rtd2], weights=[1., 0.], 
+                       biological=BiologicalDose([5, 20], 3., 
+                                                 reference_fractions=5))
+        npt.assert_allclose(sum.pixel_array*sum.DoseGridScaling, dose1, 
+                            rtol=1e-6, atol=sum.DoseGridScaling)
+        
+        self.assertRaises(ValueError, SumPlans, list(makeDoses()), 
+                          biological=BiologicalDose([5]))
+        self.assertRaises(ValueError, BiologicalDose, [5, 20], 
+                          quantity='LQ')
+        
+    def testSummedDVHs(self):
+        z, y, x = np.mgrid[0:6, 0:8, 0:10]*2.
+        rtd1 = make_test_dose(1. + x*0.5, [0., 0., 0.], [2., 2., 2.])
+        rtd2 = make_test_dose(2. + y*0.25 + z*0.1, [0., 0., 0.], 
+                              [2., 2., 2.])
+        square = lambda x0, x1, y0, y1, z: [[x0, y0, z], [x1, y0, z], 
+                                            [x1, y1, z], [x0, y1, z]]
+        planes = {}
+        for plane_z in [2., 4., 6., 8.]:
+            planes['%.2f' % plane_z] = [
+                {'data': square(1., 9., 1., 7., plane_z)},
+                {'data': square(3., 5., 3., 5., plane_z)}]
+        planes['4.00'] = [{'contourData': contour['data']} 
+                          for contour in planes['4.00']]
+        structures = {1: {'id': 1, 'name': 'PTV', 'planes': planes, 
+                          'thickness': 2.},
+                      2: {'id': 2, 'name': 'Empty', 'planes': {}}}
+        
+        sum = SumPlans([rtd1, rtd2], structures=structures)
+        self.assertEqual(len(sum.DVHSequence), 1)
+        dvh = sum.DVHSequence[0]
+        self.assertEqual(
+            dvh.DVHReferencedROISequence[0].ReferencedROINumber, 1)
+        
+        mask = (x >= 2) & (x <= 8) & (y >= 2) & (y <= 6) & \
+               (z >= 2) & (z <= 8) & ~((x == 4) & (y == 4))
+        self.assertEqual(mask.sum(), 44)
+        bins = np.multiply(sum.pixel_array, sum.DoseGridScaling/
+                           DVH_BIN_WIDTH).astype(np.intp)[mask]
+        expected = np.bincount(bins)[::-1].cumsum()[::-1]*0.008
+        npt.assert_allclose(dvh.DVHData[1::2], expected, rtol=1e-5)
+        npt.assert_allclose(dvh.DVHData[0::2], DVH_BIN_WIDTH)
+        self.assertEqual(dvh.DVHNumberOfBins, len(expected))
+        dose = sum.pixel_array[mask]*sum.DoseGridScaling
+        self.assertAlmostEqual(dvh.DVHMeanDose, dose.mean(), 
+                               delta=DVH_BIN_WIDTH)
+        self.assertAlmostEqual(dvh.DVHMaximumDose, dose.max(), 
+                               delta=DVH_BIN_WIDTH)
+        
+    def testParallelMatchesSerial(self):
+        serial = SumPlan(*self.makeDoses(), q=None, slab_frames=3)
+        parallel = SumPlan(*self.makeDoses(), q=None, slab_frames=3, 
+                           workers=2)
+        npt.assert_array_equal(parallel.pixel_array, serial.pixel_array)
+        
+        #The slabs are streamed, never more than slab_frames at a time
+        dose_sum = DoseSum(self.makeDoses(), slab_frames=3, workers=2)
+        frames = []
+        for k0, k1, slab in dose_sum.iter_slabs():
+            self.assertEqual(slab.shape[0], k1 - k0)
+            self.assertLessEqual(k1 - k0, 3)
+            npt.assert_array_equal(slab, serial.pixel_array[k0:k1])
+            frames.extend(range(k0, k1))
+        self.assertEqual(sorted(frames), list(range(serial.NumberOfFrames)))
+        
 if __name__ == '__main__':
     unittest.main()
-    
\ No newline at end of file
+    
\ No newline at end of file
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: ISO-8859-1 -*-
+# dvhcoverage.py
+"""Solves for the dose scaling that gives targets their coverage, from
+their cumulative DVHs."""
+# Copyright (c) 2010-2012 Aditya Panchal
+# This file is part of dicompyler, released under a BSD license.
+#    See the file license.txt included with this distribution, also
+#    available at http://code.google.com/p/dicompyler/
+#
+
+import unittest
+
+import numpy as np
+
+def cumulative_fractions(dvhs):
+    """Return the cumulative DVHs of dicompyler DVH dicts as a
+    (targets, bins) array of volume fractions, padded with zeros, and the
+    dose in cGy of one bin of each DVH."""
+
+    bins = max(len(dvh['data']) for dvh in dvhs) + 1
+    fractions = np.zeros((len(dvhs), bins))
+    for row, dvh in enumerate(dvhs):
+        data = np.asarray(dvh['data'], float)
+        if len(data) and data[0] > 0:
+            fractions[row, :len(data)] = data / data[0]
+    scalings = np.array([float(dvh.get('scaling', 1)) for dvh in dvhs])
+
+    return fractions, scalings
+
+def dose_at_volume(fractions, scalings, volume):
+    """Return the dose in cGy that the given fraction of the volume of each
+    DVH receives, interpolated between bins, for all the DVHs at once."""
+
+    volume = np.broadcast_to(np.asarray(volume, float), scalings.shape)
+    rows = np.arange(len(fractions))
+    # A cumulative DVH never increases, so the bins covering the volume are
+    # the first count bins of each row
+    count = np.sum(fractions >= volume[:, np.newaxis], axis=1)
+    i = np.clip(count - 1, 0, fractions.shape[1] - 2)
+    f0 = fractions[rows, i]
+    f1 = fractions[rows, i + 1]
+    step = np.where(f0 > f1, f0 - f1, 1.)
+    t = np.clip((f0 - volume) / step, 0., 1.)
+    t[count == 0] = 0.
+
+    return (i + t) * scalings
+
+def volume_at_dose(fractions, scalings, dose):
+    """Return the fraction of the volume of each DVH that receives at least
+    the given dose in cGy, interpolated between bins, for all the DVHs at
+    once."""
+
+    dose = np.broadcast_to(np.asarray(dose, float), scalings.shape)
+    rows = np.arange(len(fractions))
+    position = np.clip(dose / scalings, 0., fractions.shape[1] - 1)
+    i = np.minimum(position.astype(np.intp), fractions.shape[1] - 2)
+    t = position - i
+
+    return fractions[rows, i] * (1 - t) + fractions[rows, i + 1] * t
+
+def solve_coverage(dvhs, volume, dose):
+    """Return the factor that the dose must be scaled by so that every target
+    receives dose (cGy) to at least the given fraction of its volume, and
+    the factor each target alone would need.
+
+    dose and volume are scalars or one value per target.  Scaling the dose
+    grid scales the dose axis of every DVH, so each factor is dose / D(v) of
+    that target, and the largest one covers all of the targets."""
+
+    fractions, scalings = cumulative_fractions(dvhs)
+    current = dose_at_volume(fractions, scalings, volume)
+    with np.errstate(divide='ignore'):
+        factors = np.asarray(dose, float) / current
+
+    return float(np.max(factors)), factors
+
+def preview_coverage(dvhs, volume, dose, dosescale):
+    """Return the dose to the given fraction of the volume, and the fraction
+    of the volume receiving the given dose, of each target before and after
+    scaling the dose by dosescale, as a dict of arrays."""
+
+    fractions, scalings = cumulative_fractions(dvhs)
+    current = dose_at_volume(fractions, scalings, volume)
+    dose = np.asarray(dose, float)
+
+    return {'dose': current,
+            'scaleddose': current * dosescale,
+            'volume': volume_at_dose(fractions, scalings, dose),
+            'scaledvolume': volume_at_dose(fractions, scalings,
+                                           dose / dosescale)}
+
+class CoverageTest(unittest.TestCase):
+
+    def setUp(self):
+        # Cumulative DVHs in cm3, of 100 cGy and 50 cGy bins, and a target
+        # with no dose
+        self.dvhs = [{'data': [10., 10., 8., 4., 0.], 'scaling': 100.},
+                     {'data': [2., 2., 2., 1.5, 1., 0.5], 'scaling': 50.},
+                     {'data': [0., 0.], 'scaling': 100.}]
+
+    def testCumulativeFractions(self):
+        fractions, scalings = cumulative_fractions(self.dvhs)
+        self.assertEqual(fractions.shape, (3, 7))
+        np.testing.assert_array_equal(fractions[0],
+                                      [1., 1., .8, .4, 0., 0., 0.])
+        np.testing.assert_array_equal(fractions[1],
+                                      [1., 1., 1., .75, .5, .25, 0.])
+        np.testing.assert_array_equal(fractions[2], 0.)
+        np.testing.assert_array_equal(scalings, [100., 50., 100.])
+
+    def testDoseAtVolume(self):
+        fractions, scalings = cumulative_fractions(self.dvhs)
+        # At bin edges
+        np.testing.assert_allclose(
+            dose_at_volume(fractions, scalings, [.8, .5, .5]),
+            [200., 200., 0.])
+        np.testing.assert_allclose(
+            dose_at_volume(fractions, scalings, 1.), [100., 100., 0.])
+        # Between bin edges
+        np.testing.assert_allclose(
+            dose_at_volume(fractions, scalings, [.6, .625, .6]),
+            [250., 175., 0.])
+        np.testing.assert_allclose(
+            dose_at_volume(fractions, scalings, [.1, .1, .1]),
+            [375., 280., 0.])
+
+    def testVolumeAtDose(self):
+        fractions, scalings = cumulative_fractions(self.dvhs)
+        # At bin edges
+        np.testing.assert_allclose(
+            volume_at_dose(fractions, scalings, 200.), [.8, .5, 0.])
+        np.testing.assert_allclose(
+            volume_at_dose(fractions, scalings, 0.), [1., 1., 0.])
+        # Between bin edges, and past the last bin
+        np.testing.assert_allclose(
+            volume_at_dose(fractions, scalings, [250., 175., 250.]),
+            [.6, .625, 0.])
+        np.testing.assert_allclose(
+            volume_at_dose(fractions, scalings, 1e4), [0., 0., 0.])
+
+    def testSolveCoverage(self):
+        # D80 is 200 cGy and 140 cGy, so 280 cGy to 80% needs 1.4 and 2.
+        dosescale, factors = solve_coverage(self.dvhs[:2], .8, 280.)
+        np.testing.assert_allclose(factors, [1.4, 2.])
+        self.assertAlmostEqual(dosescale, 2.)
+        self.assertEqual(dosescale, max(factors))
+        # One dose and volume per target
+        dosescale, factors = solve_coverage(self.dvhs[:2], [.8, .5],
+                                            [300., 100.])
+        np.testing.assert_allclose(factors, [1.5, .5])
+        self.assertAlmostEqual(dosescale, 1.5)
+        # A target with no dose can never be covered
+        dosescale, factors = solve_coverage(self.dvhs, .8, 280.)
+        self.assertEqual(factors[2], float('inf'))
+        self.assertEqual(dosescale, float('inf'))
+
+    def testPreviewCoverage(self):
+        preview = preview_coverage(self.dvhs, .8, 280., 2.)
+        np.testing.assert_allclose(preview['dose'], [200., 140., 0.])
+        np.testing.assert_allclose(preview['scaleddose'], [400., 280., 0.])
+        np.testing.assert_allclose(preview['volume'], [.48, .1, 0.])
+        # 140 cGy before scaling
+        np.testing.assert_allclose(preview['scaledvolume'], [.92, .8, 0.])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: ISO-8859-1 -*-
+# regionscale.py
+"""Scales DICOM RT dose data inside or outside of a structure."""
+# Copyright (c) 2010-2012 Aditya Panchal
+# This file is part of dicompyler, released under a BSD license.
+#    See the file license.txt included with this distribution, also
+#    available at http://code.google.com/p/dicompyler/
+#
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pydicom
+
+try:
+    from GFOVswitch.frameindex import FrameIndex, plane_mask
+except ImportError:
+    # Outside of dicompyler, import it from the GFOVswitch plugin's folder
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir, 'GFOVswitch'))
+    from frameindex import FrameIndex, plane_mask
+
+# Number of dose frames scaled at a time
+SLAB_FRAMES = 8
+# Largest uint32 pixel value
+MAX_PIXEL = 0xFFFFFFFF
+
+def frame_positions(rtdose):
+    """Return the absolute z position of each frame of an RT Dose object,
+    from a Type A (relative) or Type B (absolute) GridFrameOffsetVector."""
+
+    return FrameIndex.from_dataset(rtdose).absolute_offsets()
+
+def structure_mask(structure, rtdose):
+    """Rasterize a structure onto the frames of an RT Dose object.
+
+    Returns a dict of the frames inside the structure, each with the row
+    and column bounds of the structure and its boolean mask within them.
+    Each frame takes the contours of the nearest structure plane within
+    half of the plane thickness, and contours within a plane are combined
+    with exclusive or so that inner contours are holes."""
+
+    planes = structure.get('planes') or {}
+    if not planes:
+        return {}
+    keys = list(planes)
+    # The absolute z positions of the planes, indexed for nearest lookups
+    index = FrameIndex(keys, 0.)
+    thickness = structure.get('thickness')
+    if not thickness:
+        spacing = np.diff(np.unique(index.z))
+        thickness = spacing.min() if len(spacing) else 0.
+
+    x = float(rtdose.ImagePositionPatient[0]) + \
+        np.arange(rtdose.Columns) * float(rtdose.PixelSpacing[1])
+    y = float(rtdose.ImagePositionPatient[1]) + \
+        np.arange(rtdose.Rows) * float(rtdose.PixelSpacing[0])
+
+    masks = {}
+    planemasks = {}
+    for frame, z in enumerate(frame_positions(rtdose)):
+        nearest = index.nearest(z, thickness / 2.)
+        if nearest is None:
+            continue
+        key = keys[nearest]
+        if key not in planemasks:
+            planemasks[key] = plane_mask(planes[key], x, y)
+        if planemasks[key] is not None:
+            masks[frame] = planemasks[key]
+
+    return masks
+
+def frame_factors(masks, k0, k1, shape, inside, dosescale):
+    """Return the factor of each pixel of frames k0 to k1."""
+
+    region = np.zeros((k1 - k0,) + shape, bool)
+    for frame in range(k0, k1):
+        if frame in masks:
+            j0, j1, i0, i1, mask = masks[frame]
+            region[frame - k0, j0:j1, i0:i1] = mask
+    if not inside:
+        region = ~region
+
+    return np.where(region, dosescale, 1.)
+
+def scale_region(rtdose, masks, dosescale, inside=True,
+                 slab_frames=SLAB_FRAMES):
+    """Scale the dose of an RT Dose object inside, or outside, of the frame
+    masks of a structure by dosescale.
+
+    The PixelData bytes are immutable, so they are copied once into a
+    writable buffer that replaces them.  The uint32 pixels are then changed
+    in place, a slab of frames at a time, so only slab sized temporaries
+    are made.  If a scaled pixel would overflow, the DoseGridScaling is
+    increased just enough for the largest one to fit and every pixel is
+    rescaled to it.  Returns the new scaling."""
+
+    if int(rtdose.BitsAllocated) != 32:
+        raise ValueError("Only 32 bit RT Dose pixels can be scaled")
+    frames = int(rtdose.get('NumberOfFrames', 1))
+    shape = (rtdose.Rows, rtdose.Columns)
+    # The buffer is the new PixelData, so the original bytes are released
+    buffer = memoryview(bytearray(rtdose.PixelData))
+    rtdose.PixelData = buffer
+    pixels = np.frombuffer(buffer, '<u4').reshape((frames,) + shape)
+
+    # Find the largest scaled pixel, to choose the new scaling
+    peak = 0.
+    for k0 in range(0, frames, slab_frames):
+        k1 = min(k0 + slab_frames, frames)
+        factors = frame_factors(masks, k0, k1, shape, inside, dosescale)
+        peak = max(peak, float(np.max(pixels[k0:k1] * factors)))
+    rescale = max(peak / MAX_PIXEL, 1.)
+
+    for k0 in range(0, frames, slab_frames):
+        k1 = min(k0 + slab_frames, frames)
+        factors = frame_factors(masks, k0, k1, shape, inside, dosescale)
+        factors /= rescale
+        slab = pixels[k0:k1] * factors
+        np.rint(slab, out=slab)
+        np.minimum(slab, MAX_PIXEL, out=slab)
+        pixels[k0:k1] = slab
+
+    del pixels
+    rtdose.DoseGridScaling = float(rtdose.DoseGridScaling) * rescale
+    # The stored DVHs no longer describe the dose
+    if 'DVHSequence' in rtdose:
+        del rtdose.DVHSequence
+
+    return rtdose.DoseGridScaling
+
+def make_test_rtdose(pixels, offsets, origin=(-10., -10., -10.), spacing=2.,
+                     bits=32):
+    """Return an RT Dose dataset of the (frames, rows, columns) pixels, with
+    frames at the given GridFrameOffsetVector and a DVH."""
+
+    ds = pydicom.dataset.Dataset()
+    ds.Modality = 'RTDOSE'
+    ds.ImagePositionPatient = list(origin)
+    ds.PixelSpacing = [spacing, spacing]
+    ds.GridFrameOffsetVector = list(offsets)
+    ds.NumberOfFrames, ds.Rows, ds.Columns = pixels.shape
+    ds.BitsAllocated = bits
+    ds.DoseGridScaling = 1e-3
+    ds.DVHSequence = [pydicom.dataset.Dataset()]
+    ds.PixelData = np.asarray(pixels, '<u4').tobytes()
+
+    return ds
+
+def square_structure(frame_z, low=-7., high=-3.):
+    """Return a dicompyler structure with a square contour from low to high
+    in x and y on each of the given planes."""
+
+    square = [[low, low], [high, low], [high, high], [low, high]]
+    planes = dict(('%.2f' % z, [{'data': [p + [z] for p in square]}])
+                  for z in frame_z)
+
+    return {'planes': planes, 'thickness': 2.5}
+
+class RegionScaleTest(unittest.TestCase):
+
+    def pixels(self, rtdose):
+        return np.frombuffer(rtdose.PixelData, '<u4').reshape(
+            int(rtdose.NumberOfFrames), rtdose.Rows, rtdose.Columns)
+
+    def testFramePositions(self):
+        pixels = np.zeros((3, 2, 2))
+        # Type A offsets are relative to the first frame, Type B absolute
+        relative = make_test_rtdose(pixels, [0., 2.5, 5.])
+        absolute = make_test_rtdose(pixels, [-10., -7.5, -5.])
+        self.assertEqual(frame_positions(relative), [-10., -7.5, -5.])
+        self.assertEqual(frame_positions(absolute), [-10., -7.5, -5.])
+        # Frames in decreasing z
+        decreasing = make_test_rtdose(pixels, [0., -2.5, -5.])
+        self.assertEqual(frame_positions(decreasing), [-10., -12.5, -15.])
+
+    def testScaleInsideOutside(self):
+        # The square covers the pixels at x and y of -6 and -4 on the
+        # middle three frames
+        region = np.zeros((5, 6, 6), bool)
+        region[1:4, 2:4, 2:4] = True
+        for inside in [True, False]:
+            rtdose = make_test_rtdose(np.full((5, 6, 6), 1000),
+                                      [0., 2.5, 5., 7.5, 10.])
+            structure = square_structure([-7.5, -5., -2.5])
+            masks = structure_mask(structure, rtdose)
+            self.assertEqual(sorted(masks), [1, 2, 3])
+
+            scaling = scale_region(rtdose, masks, 1.5, inside, slab_frames=2)
+            self.assertEqual(scaling, 1e-3)
+            self.assertNotIn('DVHSequence', rtdose)
+            scaled = region if inside else ~region
+            expected = np.where(scaled, 1500, 1000)
+            np.testing.assert_array_equal(self.pixels(rtdose), expected)
+
+    def testOverflowRescales(self):
+        pixels = np.full((3, 6, 6), 3000000000, np.uint32)
+        pixels[:, 0, 0] = 1000
+        rtdose = make_test_rtdose(pixels, [0., 2.5, 5.])
+        masks = structure_mask(square_structure([-10., -7.5, -5.]), rtdose)
+        dose = pixels * 1e-3
+
+        scaling = scale_region(rtdose, masks, 2.)
+        # The largest scaled pixel just fits
+        self.assertAlmostEqual(scaling, 6e9 / MAX_PIXEL * 1e-3)
+        self.assertEqual(rtdose.DoseGridScaling, scaling)
+        result = self.pixels(rtdose)
+        self.assertEqual(result.max(), MAX_PIXEL)
+        region = np.zeros(pixels.shape, bool)
+        region[:, 2:4, 2:4] = True
+        np.testing.assert_allclose(result * scaling,
+                                   np.where(region, 2 * dose, dose),
+                                   rtol=0, atol=scaling)
+
+    def testBitsAllocated(self):
+        rtdose = make_test_rtdose(np.zeros((1, 2, 2)), [0.], bits=16)
+        self.assertRaises(ValueError, scale_region, rtdose, {}, 2.)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: ISO-8859-1 -*-
+# rescale.py
+"""Scales DICOM RT Dose files on disk without decoding their pixel data.
+
+Usage: python rescale.py (--factor F | --old-rx CGY --new-rx CGY)
+                         [-o DIR] RTDOSE [RTDOSE ...]
+
+The DoseGridScaling and DVHDoseScaling elements are found by their byte
+offsets in the file.  When every new value fits in the length of the old
+one the file is patched in place, otherwise the header is rewritten to a
+copy and the rest of the file, from the PixelData element on, is streamed
+after it byte for byte."""
+# Copyright (c) 2010-2012 Aditya Panchal
+# This file is part of dicompyler, released under a BSD license.
+#    See the file license.txt included with this distribution, also
+#    available at http://code.google.com/p/dicompyler/
+#
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import pydicom
+
+# (3004,000E) Dose Grid Scaling
+DOSE_GRID_SCALING_TAG = 0x3004000E
+# (3004,0050) DVH Sequence
+DVH_SEQUENCE_TAG = 0x30040050
+# (3004,0052) DVH Dose Scaling
+DVH_DOSE_SCALING_TAG = 0x30040052
+# Size of the blocks in which the pixel data is copied
+COPY_BLOCK = 2**20
+# Significant digits kept of a scaled Decimal String
+DS_DIGITS = 12
+# Largest length of a Decimal String
+DS_LENGTH = 16
+
+def scaling_elements(ds, fp):
+    """Return the DoseGridScaling element and the DVHDoseScaling element of
+    each DVH in a dataset read from the file fp, as (dataset, raw element,
+    file offset of the value) tuples."""
+
+    raw = ds.get_item(DOSE_GRID_SCALING_TAG)
+    elements = [(ds, raw, raw.value_tell)]
+    if DVH_SEQUENCE_TAG in ds:
+        sequence = ds.get_item(DVH_SEQUENCE_TAG)
+        for item in ds.DVHSequence:
+            if DVH_DOSE_SCALING_TAG not in item:
+                continue
+            raw = item.get_item(DVH_DOSE_SCALING_TAG)
+            # Items are parsed from the value of the sequence, so their
+            # offsets may be relative to it
+            for tell in (sequence.value_tell + raw.value_tell,
+                         raw.value_tell):
+                fp.seek(tell)
+                if fp.read(raw.length) == raw.value:
+                    break
+            else:
+                raise ValueError("DVHDoseScaling not found in the file")
+            elements.append((item, raw, tell))
+
+    return elements
+
+def format_ds(value, length=DS_LENGTH):
+    """Return a Decimal String of a value rounded to DS_DIGITS significant
+    digits, that fits in length characters if it can.
+
+    The %g, compact exponent and no leading zero forms of each precision
+    are tried in turn, and the first that fits is returned, so the new
+    value fits in the field of the old one wherever it can and the file is
+    patched in place.  Otherwise the %g form is returned, or for a value
+    with no form of at most DS_LENGTH characters the most precise form
+    that fits."""
+
+    target = float('%.*g' % (DS_DIGITS, value))
+    forms = []
+    for digits in range(1, DS_DIGITS + 1):
+        text = '%.*g' % (digits, value)
+        mantissa, exponent = ('%.*e' % (digits - 1, value)).split('e')
+        if '.' in mantissa:
+            mantissa = mantissa.rstrip('0').rstrip('.')
+        forms += [text, '%se%d' % (mantissa, int(exponent))]
+        # A leading zero is optional, as in '.015'
+        if text.lstrip('-').startswith('0.'):
+            forms.append(text.replace('0.', '.', 1))
+    forms = [text for text in forms if len(text) <= DS_LENGTH]
+    exact = [text for text in forms if float(text) == target]
+    for text in exact:
+        if len(text) <= length:
+            return text
+    if exact:
+        return exact[0]
+    return forms[-1]
+
+def scale_rtdose(source, dosescale, target=None):
+    """Scale the dose of an RT Dose file by dosescale.
+
+    If target is None the file is patched in place when the new values fit,
+    and is otherwise replaced by a streamed copy.  If target is given the
+    scaled copy is written there and the source is unchanged.  Returns True
+    if the file was patched in place."""
+
+    with open(source, 'rb') as fp:
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+        # The header stops at the PixelData element
+        offset = fp.tell()
+        if DOSE_GRID_SCALING_TAG not in ds:
+            raise ValueError("%s has no DoseGridScaling" % source)
+        deflated = (ds.file_meta.TransferSyntaxUID ==
+                    pydicom.uid.DeflatedExplicitVRLittleEndian)
+
+        patches = []
+        for item, raw, tell in scaling_elements(ds, fp):
+            value = format_ds(float(item[raw.tag].value) * dosescale,
+                              raw.length)
+            patches.append((tell, raw.length, value))
+            item[raw.tag].value = value
+
+        if target is None and not deflated and \
+           all(len(value) <= length for tell, length, value in patches):
+            fp.close()
+            with open(source, 'r+b') as out:
+                for tell, length, value in patches:
+                    out.seek(tell)
+                    # Decimal Strings are padded with trailing spaces
+                    out.write(value.ljust(length).encode('ascii'))
+            return True
+
+        if deflated:
+            raise ValueError("%s is deflated and cannot be streamed" % source)
+        temp = (target or source) + '.scaled'
+        with open(temp, 'wb') as out:
+            ds.save_as(out)
+            fp.seek(offset)
+            shutil.copyfileobj(fp, out, COPY_BLOCK)
+    os.replace(temp, target or source)
+
+    return False
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='rescale',
+        description="Scale RT Dose files without the dicompyler GUI.")
+    parser.add_argument('files', nargs='+', help="RT Dose files")
+    parser.add_argument('--factor', type=float,
+        help="factor that the dose is multiplied by")
+    parser.add_argument('--old-rx', type=float,
+        help="original prescription dose")
+    parser.add_argument('--new-rx', type=float,
+        help="new prescription dose")
+    parser.add_argument('-o', '--output-dir',
+        help="write scaled copies to this directory instead of changing "
+             "the files")
+    args = parser.parse_args(argv)
+
+    if args.factor is not None:
+        dosescale = args.factor
+    elif args.old_rx and args.new_rx is not None:
+        dosescale = args.new_rx / args.old_rx
+    else:
+        parser.error("give --factor, or --old-rx and --new-rx")
+
+    start = time.time()
+    patched = copied = 0
+    for filename in args.files:
+        target = None
+        if args.output_dir:
+            if not os.path.isdir(args.output_dir):
+                os.makedirs(args.output_dir)
+            target = os.path.join(args.output_dir,
+                                  os.path.basename(filename))
+        if scale_rtdose(filename, dosescale, target):
+            patched += 1
+        else:
+            copied += 1
+
+    print("ScaleDose: Scaled %d files by %g, %d patched in place, "
+          "%d copied, in %.2f s" % (len(args.files), dosescale, patched,
+          copied, time.time() - start))
+
+    return 0
+
+def make_test_rtdose(filename, scaling, dvh_scaling, implicit=False):
+    """Write a small RT Dose file with a DVH for testing, and return the
+    offset of its PixelData element."""
+
+    file_meta = pydicom.dataset.FileMetaDataset()
+    if implicit:
+        file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+    else:
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.2'
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    ds = pydicom.dataset.FileDataset(filename, {}, file_meta=file_meta,
+                                     preamble=b"\0"*128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'RTDOSE'
+    ds.Rows = 3
+    ds.Columns = 4
+    ds.NumberOfFrames = 2
+    ds.BitsAllocated = 32
+    ds.DoseGridScaling = scaling
+    dvh = pydicom.dataset.Dataset()
+    dvh.DVHDoseScaling = dvh_scaling
+    dvh.DVHData = ['0', '100', '1', '50']
+    ds.DVHSequence = [dvh]
+    ds.PixelData = bytes(range(96))
+    ds.save_as(filename, enforce_file_format=True)
+
+    with open(filename, 'rb') as fp:
+        pydicom.dcmread(fp, stop_before_pixels=True)
+        return fp.tell()
+
+class RescaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'rtdose.dcm')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testFormatDS(self):
+        self.assertEqual(format_ds(0.000123456*1.5), '0.000185184')
+        self.assertEqual(format_ds(0.000123456*1.5, 10), '1.85184e-4')
+        self.assertEqual(format_ds(0.01*1.5, 4), '.015')
+        self.assertEqual(format_ds(3.14159*1.5), '4.712385')
+        self.assertEqual(format_ds(2.), '2')
+        self.assertEqual(format_ds(1./3), '0.333333333333')
+        for value in [1e-300/3, -1e200/7, 123456789012345.]:
+            text = format_ds(value)
+            self.assertTrue(len(text) <= DS_LENGTH)
+            self.assertAlmostEqual(float(text)/value, 1., 8)
+
+    def testPatchInPlace(self):
+        for implicit in [False, True]:
+            make_test_rtdose(self.filename, '0.000123456', '0.02', implicit)
+            with open(self.filename, 'rb') as fp:
+                original = fp.read()
+            self.assertTrue(scale_rtdose(self.filename, 1.5))
+            with open(self.filename, 'rb') as fp:
+                patched = fp.read()
+            # Only the values change, padded to the length of their fields
+            expected = original.replace(b'0.000123456 ', b'0.000185184 ')
+            expected = expected.replace(b'0.02', b'0.03')
+            self.assertNotEqual(expected, original)
+            self.assertEqual(patched, expected)
+
+    def testCopy(self):
+        for implicit in [False, True]:
+            offset = make_test_rtdose(self.filename, '0.5', '1', implicit)
+            with open(self.filename, 'rb') as fp:
+                original = fp.read()
+            target = os.path.join(self.folder, 'scaled.dcm')
+            self.assertFalse(scale_rtdose(self.filename, 1./3, target))
+            # The source is unchanged
+            with open(self.filename, 'rb') as fp:
+                self.assertEqual(fp.read(), original)
+            with open(target, 'rb') as fp:
+                ds = pydicom.dcmread(fp, stop_before_pixels=True)
+                # The pixel data is copied byte for byte
+                copied = fp.read()
+            self.assertEqual(ds.DoseGridScaling, '0.166666666667')
+            self.assertEqual(ds.DVHSequence[0].DVHDoseScaling,
+                             '0.333333333333')
+            self.assertEqual(copied, original[offset:])
+            with open(target, 'rb') as fp:
+                scaled = fp.read()
+            self.assertEqual(pydicom.dcmread(target).PixelData,
+                             bytes(range(96)))
+
+            # Without a target the values do not fit, so the file is
+            # replaced by a copy
+            self.assertFalse(scale_rtdose(self.filename, 1./3))
+            with open(self.filename, 'rb') as fp:
+                self.assertEqual(fp.read(), scaled)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,8 @@ from wx.xrc import XmlResource, XRCCTRL, XRCID
 from wx.lib.pubsub import Publisher as pub
 import os.path, threading
 from dicompyler import guiutil, util
+from dvhcoverage import solve_coverage, preview_coverage
+from regionscale import structure_mask, scale_region
 
 def pluginProperties():
     """Properties of the plugin."""
@@ -37,6 +39,9 @@ class plugin:
 
         # Set up pubsub
         pub.subscribe(self.OnUpdatePatient, 'patient.updated.raw_data')
+        pub.subscribe(self.OnUpdateParsedData, 'patient.updated.parsed_data')
+        self.structures = {}
+        self.dvhs = {}
 
         # Load the XRC file for our gui resources
         xrc = os.path.join(os.path.dirname(__file__), 'scaledose.xrc')
@@ -47,30 +52,56 @@ class plugin:
 
         self.data = msg.data
 
+    def OnUpdateParsedData(self, msg):
+        """Update the structures and DVHs used to scale to coverage."""
+
+        self.structures = msg.data.get('structures', {})
+        self.dvhs = msg.data.get('dvhs', {})
+
     def pluginMenu(self, evt):
         """Scale DICOM RT dose data."""
 
         dlgScaleDose = self.res.LoadDialog(self.parent, "ScaleDoseDialog")
-        dlgScaleDose.Init(self.data['rxdose'])
+        dlgScaleDose.Init(self.data['rxdose'], self.structures, self.dvhs)
 
         if dlgScaleDose.ShowModal() == wx.ID_OK:
             oldRxDose = dlgScaleDose.oldRxDose
             newRxDose = dlgScaleDose.newRxDose
+            region = dlgScaleDose.region
 
-            # Initialize and start the scale dose thread
-            self.t=threading.Thread(target=self.ScaleDoseDataThread,
-                args=(self.data, oldRxDose, newRxDose, self.UpdateData))
-            self.t.start()
+            # Only 32 bit dose pixels can be scaled within a structure
+            if region and int(self.data['rtdose'].BitsAllocated) != 32:
+                dlg = wx.MessageDialog(self.parent,
+                    "Only RT Dose data with 32 bit pixels can be scaled "
+                    "within a structure.",
+                    "Cannot scale dose.", wx.OK | wx.ICON_WARNING)
+                dlg.ShowModal()
+                dlg.Destroy()
+            else:
+                # Initialize and start the scale dose thread
+                self.t=threading.Thread(target=self.ScaleDoseDataThread,
+                    args=(self.data, oldRxDose, newRxDose, self.UpdateData,
+                          region))
+                self.t.start()
 
         else:
             pass
         dlgScaleDose.Destroy()
         return
 
-    def ScaleDoseDataThread(self, data, oldRxDose, newRxDose, finishedFunc):
-        """Scale the DICOM RT dose data."""
+    def ScaleDoseDataThread(self, data, oldRxDose, newRxDose, finishedFunc,
+                            region=None):
+        """Scale the DICOM RT dose data, or only the dose inside or outside
+        of a structure if region is a (structure, inside) tuple."""
 
         dosescale = float(newRxDose) / float(oldRxDose)
+        if region:
+            # The pixels of the region are scaled, so the Rx dose is kept
+            structure, inside = region
+            masks = structure_mask(structure, data['rtdose'])
+            scale_region(data['rtdose'], masks, dosescale, inside)
+            wx.CallAfter(finishedFunc, data)
+            return
         # Scale the Rx dose
         data['rxdose'] = int(data['rxdose'] * dosescale)
         rtdose = data['rtdose']
@@ -95,7 +126,7 @@ class ScaleDoseDialog(wx.Dialog):
         # the Create step is done by XRC.
         self.PostCreate(pre)
 
-    def Init(self, rxdose):
+    def Init(self, rxdose, structures=None, dvhs=None):
         """Method called after the dialog has been initialized."""
 
         # Set window icon
@@ -105,9 +136,21 @@ class ScaleDoseDialog(wx.Dialog):
         # Initialize controls
         self.txtOriginalRxDose = XRCCTRL(self, 'txtOriginalRxDose')
         self.txtNewRxDose = XRCCTRL(self, 'txtNewRxDose')
+        self.chkCoverage = XRCCTRL(self, 'chkCoverage')
+        self.txtCoverageDose = XRCCTRL(self, 'txtCoverageDose')
+        self.txtCoverageVolume = XRCCTRL(self, 'txtCoverageVolume')
+        self.lstTargets = XRCCTRL(self, 'lstTargets')
+        self.btnPreview = XRCCTRL(self, 'btnPreview')
+        self.txtCoveragePreview = XRCCTRL(self, 'txtCoveragePreview')
+        self.chkRegion = XRCCTRL(self, 'chkRegion')
+        self.choiceRegionSide = XRCCTRL(self, 'choiceRegionSide')
+        self.choiceRegionStructure = XRCCTRL(self, 'choiceRegionStructure')
 
         # Bind interface events to the proper methods
         wx.EVT_BUTTON(self, wx.ID_OK, self.OnOK)
+        wx.EVT_BUTTON(self, XRCID('btnPreview'), self.OnPreview)
+        wx.EVT_CHECKBOX(self, XRCID('chkCoverage'), self.OnToggleCoverage)
+        wx.EVT_CHECKBOX(self, XRCID('chkRegion'), self.OnToggleRegion)
 
         # Pre-select the text on the text controls due to a Mac OS X bug
         self.txtOriginalRxDose.SetSelection(-1, -1)
@@ -117,10 +160,107 @@ class ScaleDoseDialog(wx.Dialog):
         self.txtOriginalRxDose.SetValue(str(int(rxdose)))
         self.txtNewRxDose.SetValue(str(int(rxdose)/2))
 
+        # Structures with a DVH can be chosen as targets
+        self.targets = []
+        if structures and dvhs:
+            for id in sorted(structures):
+                if id in dvhs:
+                    self.targets.append((structures[id]['name'], dvhs[id]))
+        self.lstTargets.Set([name for name, dvh in self.targets])
+        self.txtCoverageDose.SetValue(str(int(rxdose)))
+        self.txtCoverageVolume.SetValue('95')
+        self.chkCoverage.Enable(len(self.targets) > 0)
+        self.OnToggleCoverage()
+
+        # Structures with contours can restrict the scaling
+        self.regions = []
+        if structures:
+            for id in sorted(structures):
+                if structures[id].get('planes'):
+                    self.regions.append(structures[id])
+        self.choiceRegionStructure.SetItems(
+            [structure['name'] for structure in self.regions])
+        if self.regions:
+            self.choiceRegionStructure.SetSelection(0)
+        self.chkRegion.Enable(len(self.regions) > 0)
+        self.OnToggleRegion()
+
+    def OnToggleRegion(self, evt=None):
+        """Enable the choice of structure to restrict the scaling to."""
+
+        region = self.chkRegion.IsChecked()
+        self.choiceRegionSide.Enable(region)
+        self.choiceRegionStructure.Enable(region)
+
+    def OnToggleCoverage(self, evt=None):
+        """Switch between a manual Rx dose and scaling to coverage."""
+
+        coverage = self.chkCoverage.IsChecked()
+        self.txtNewRxDose.Enable(not coverage)
+        for control in [self.txtCoverageDose, self.txtCoverageVolume,
+                        self.lstTargets, self.btnPreview,
+                        self.txtCoveragePreview]:
+            control.Enable(coverage)
+
+    def SolveCoverage(self):
+        """Return the dose scale that covers the checked targets, the
+        targets, the volume fraction and the dose, or None if there are no
+        valid targets."""
+
+        targets = [target for i, target in enumerate(self.targets)
+                   if self.lstTargets.IsChecked(i)]
+        try:
+            volume = float(self.txtCoverageVolume.GetValue()) / 100
+            dose = float(self.txtCoverageDose.GetValue())
+        except ValueError:
+            return None
+        if not targets or not (0 < volume <= 1) or dose <= 0:
+            return None
+        dosescale, factors = solve_coverage(
+            [dvh for name, dvh in targets], volume, dose)
+        # A target with no dose cannot be scaled to coverage
+        if not (0 < dosescale < float('inf')):
+            return None
+        return dosescale, targets, volume, dose
+
+    def OnPreview(self, evt):
+        """Show the coverage of every checked target after scaling."""
+
+        solution = self.SolveCoverage()
+        if solution is None:
+            self.txtCoveragePreview.SetValue(
+                "Check targets with dose and enter a dose and volume.")
+            return
+        dosescale, targets, volume, dose = solution
+        preview = preview_coverage([dvh for name, dvh in targets],
+                                   volume, dose, dosescale)
+        rxdose = int(self.txtOriginalRxDose.GetValue())
+        lines = ["Scale by %.4f, Rx %d -> %d cGy" %
+                 (dosescale, rxdose, int(rxdose * dosescale))]
+        for i, (name, dvh) in enumerate(targets):
+            lines.append("%s: D%g %d -> %d cGy, V%d %.1f%% -> %.1f%%" %
+                (name, volume * 100, preview['dose'][i],
+                 preview['scaleddose'][i], dose, preview['volume'][i] * 100,
+                 preview['scaledvolume'][i] * 100))
+        self.txtCoveragePreview.SetValue('\n'.join(lines))
+
     def OnOK(self, evt):
         """Return the options from the anonymize data dialog."""
 
         self.oldRxDose = int(self.txtOriginalRxDose.GetValue())
-        self.newRxDose  = int(self.txtNewRxDose.GetValue())
+        if self.chkCoverage.IsChecked():
+            solution = self.SolveCoverage()
+            if solution is None:
+                self.OnPreview(evt)
+                return
+            self.newRxDose = self.oldRxDose * solution[0]
+        else:
+            self.newRxDose  = int(self.txtNewRxDose.GetValue())
+
+        self.region = None
+        i = self.choiceRegionStructure.GetSelection()
+        if self.chkRegion.IsChecked() and i != wx.NOT_FOUND:
+            self.region = (self.regions[i],
+                           self.choiceRegionSide.GetSelection() == 0)
 
         self.EndModal(wx.ID_OK)